@@ -1,32 +1,328 @@
+import codecs
+import io
 import json
+import logging
+import re
+import tempfile
 import uuid
 import os
 import random
 
+from DataManagement import serializer
+
+logger = logging.getLogger(__name__)
+
 ADDON_DIR = os.path.dirname(__file__)
 RANDOM_WORDS_FILE_PATH = os.path.join(ADDON_DIR, "random_words")
 
+RECV_BUFFER_SIZE = 64 * 1024
+# Uploads bigger than this are spooled to a temporary file instead of being held in RAM
+SPOOL_MEMORY_SIZE = 8 * 1024 * 1024
+
+WHITESPACE = re.compile(r"[ \t\n\r]*")
+# Characters that can end a card outside of a string, and inside of one
+STRUCTURE = re.compile(r'[][{}",]')
+STRING_SPECIAL = re.compile(r'["\\]')
+
+
+class PayloadTooLarge(Exception):
+    pass
+
+
+class CardStreamDecoder:
+    """
+    Incremental decoder for a JSON array of cards or a JSON object of stable_uid -> card.
+    feed() takes the raw bytes as they arrive and returns the (stable_uid, card) pairs
+    completed so far, stable_uid is None for the cards of an array.
+
+    A card cut by the end of a chunk is scanned once, keeping the bracket depth and string
+    state across chunks, and only decoded once the ',' or bracket closing it arrived, so a
+    card spread over many chunks doesn't get parsed again from its start on each of them.
+    """
+
+    def __init__(self):
+        self.container = None
+        self.done = False
+        self._utf8 = codecs.getincrementaldecoder("utf-8")()
+        self._json = json.JSONDecoder()
+        self._closing = None
+        self._empty = True
+        # Text of the card being received, joined once it is complete
+        self._pieces = []
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+
+    def feed(self, data, final=False):
+        text = self._utf8.decode(data, final)
+        items = []
+        pos = self._scan(text, items) if not self.done else 0
+        if self.done:
+            pos = WHITESPACE.match(text, pos).end()
+            if pos < len(text):
+                raise ValueError(f"Unexpected {text[pos]!r} after the card payload")
+
+        if final and not self.done:
+            raise ValueError("Card payload ended before the closing bracket")
+        return items
+
+    def _scan(self, text, items):
+        """Decode the cards completed by text, returns the position after the payload once it is done"""
+        pos = 0
+        if self._closing is None:
+            pos = WHITESPACE.match(text).end()
+            if pos >= len(text):
+                return pos
+            if text[pos] not in "[{":
+                raise ValueError(f"Expected a JSON array or object of cards, got {text[pos]!r}")
+            self.container = list if text[pos] == "[" else dict
+            self._closing = "]" if text[pos] == "[" else "}"
+            pos += 1
+
+        start = pos
+        while pos < len(text):
+            if pos == start and not self._pieces:
+                # Cards arriving whole skip the scan
+                end = self._decode_whole(text, pos, items)
+                if end is not None:
+                    pos = start = end
+                    if self.done:
+                        return pos
+                    continue
+
+            if self._escape:
+                self._escape = False
+                pos += 1
+            elif self._in_string:
+                match = STRING_SPECIAL.search(text, pos)
+                if match is None:
+                    break
+                pos = match.end()
+                self._escape = match.group() == "\\"
+                self._in_string = self._escape
+            else:
+                match = STRUCTURE.search(text, pos)
+                if match is None:
+                    break
+                pos = match.end()
+                char = match.group()
+                if char == '"':
+                    self._in_string = True
+                elif char in "[{":
+                    self._depth += 1
+                elif self._depth:
+                    if char != ",":
+                        self._depth -= 1
+                else:
+                    self._pieces.append(text[start:pos - 1])
+                    start = pos
+                    self._end_card(char, items)
+                    if self.done:
+                        return pos
+        if start < len(text):
+            self._pieces.append(text[start:])
+        return len(text)
+
+    def _decode_whole(self, text, pos, items):
+        """Decode the card at pos if it is followed by its separator, returns the position after it"""
+        try:
+            stable_uid, card, end = self._decode_card(text, pos)
+        except ValueError:
+            return None
+        if end >= len(text) or text[end] not in (",", self._closing):
+            return None
+
+        self._empty = False
+        self.done = text[end] == self._closing
+        items.append((stable_uid, card))
+        return end + 1
+
+    def _end_card(self, separator, items):
+        text = "".join(self._pieces)
+        self._pieces = []
+        if separator not in (",", self._closing):
+            raise ValueError(f"Unexpected {separator!r} in card payload")
+        if separator == self._closing:
+            self.done = True
+            if self._empty and WHITESPACE.fullmatch(text):
+                return
+
+        stable_uid, card, end = self._decode_card(text, 0)
+        if end < len(text):
+            raise ValueError(f"Unexpected {text[end]!r} in card payload")
+        self._empty = False
+        items.append((stable_uid, card))
+
+    def _decode_card(self, text, pos):
+        """Returns (stable_uid, card, position of the next non-whitespace character)"""
+        pos = WHITESPACE.match(text, pos).end()
+        stable_uid = None
+        if self._closing == "}":
+            stable_uid, pos = self._json.raw_decode(text, pos)
+            pos = WHITESPACE.match(text, pos).end()
+            if text[pos:pos + 1] != ":":
+                raise ValueError(f"Expected ':' in card payload, got {text[pos:pos + 1]!r}")
+            pos = WHITESPACE.match(text, pos + 1).end()
+        card, pos = self._json.raw_decode(text, pos)
+        return stable_uid, card, WHITESPACE.match(text, pos).end()
+
+
+def recv_chunks(soc, buffer_size=RECV_BUFFER_SIZE):
+    """
+    Yield what arrives on the socket until the peer closes it. Every chunk is a view of the
+    same reusable buffer, so it is only valid until the next one is requested.
+    """
+    buffer = bytearray(buffer_size)
+    view = memoryview(buffer)
+    while True:
+        count = soc.recv_into(buffer)
+        if not count:
+            return
+        yield view[:count]
+
+
+def decode_cards(chunks):
+    """Decode a card payload into a list or dict of cards, None if nothing was received"""
+    decoder = CardStreamDecoder()
+    received = False
+    items = []
+    for chunk in chunks:
+        received = received or len(chunk) > 0
+        items.extend(decoder.feed(chunk))
+
+    if not received:
+        return None
+
+    items.extend(decoder.feed(b"", final=True))
+    if decoder.container is list:
+        return [card for _, card in items]
+    return {stable_uid: card for stable_uid, card in items}
+
+
+class PayloadSpool:
+    """
+    Temporary file for a received payload, held in memory up to max_memory bytes and written
+    to a named temporary file beyond, so that a worker process can open it by name. name is
+    None while the payload is in memory.
+    """
+
+    def __init__(self, max_memory=SPOOL_MEMORY_SIZE):
+        self.max_memory = max_memory
+        self._file = io.BytesIO()
+        self.name = None
+
+    def write(self, data):
+        if self.name is None and self._file.tell() + len(data) > self.max_memory:
+            self.rollover()
+        return self._file.write(data)
+
+    def rollover(self):
+        """Move the payload to a named file on disk"""
+        if self.name is not None:
+            return
+        file = tempfile.NamedTemporaryFile(prefix="payload-", suffix=".spool")
+        file.write(self._file.getbuffer())
+        self._file = file
+        self.name = file.name
+
+    def flush(self):
+        self._file.flush()
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        return self._file.seek(offset, whence)
+
+    def read(self, size=-1):
+        return self._file.read(size)
+
+    def readinto(self, buffer):
+        return self._file.readinto(buffer)
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def spool_payload(chunks, max_memory=SPOOL_MEMORY_SIZE, max_payload=None):
+    """Receive a whole payload into a PayloadSpool"""
+    spool = PayloadSpool(max_memory)
+    size = 0
+    try:
+        for chunk in chunks:
+            size += len(chunk)
+            if max_payload is not None and size > max_payload:
+                raise PayloadTooLarge(f"Payload exceeds the {max_payload} bytes limit")
+            spool.write(chunk)
+    except Exception:
+        spool.close()
+        raise
+
+    spool.seek(0)
+    return spool
+
+
+def read_file_chunks(file, buffer_size=RECV_BUFFER_SIZE):
+    buffer = bytearray(buffer_size)
+    view = memoryview(buffer)
+    while True:
+        count = file.readinto(buffer)
+        if not count:
+            return
+        yield view[:count]
+
+
+def parse_cards(data):
+    """Decode a whole card payload held in memory, None if it is empty"""
+    if not data:
+        return None
+    cards = serializer.loads(data)
+    if not isinstance(cards, (list, dict)):
+        raise ValueError(f"Expected a JSON array or object of cards, got {type(cards).__name__}")
+    return cards
+
+
+def decode_spool(spool, max_memory=SPOOL_MEMORY_SIZE):
+    """
+    Decode a spooled payload. Payloads that stayed in memory are parsed at once by the fast
+    serializer, the bigger ones card by card so they are never held whole.
+    """
+    size = spool.seek(0, os.SEEK_END)
+    spool.seek(0)
+    if size <= max_memory:
+        return parse_cards(spool.read())
+    return decode_cards(read_file_chunks(spool))
+
+
+def collect_upload(chunks, max_memory=SPOOL_MEMORY_SIZE, max_payload=None, decode=decode_spool):
+    """Spool a whole upload, then decode it into a list or dict of cards with decode(spool, max_memory)"""
+    with spool_payload(chunks, max_memory, max_payload) as spool:
+        cards = decode(spool, max_memory)
+
+    if cards is None:
+        logger.debug("No data received")
+    else:
+        logger.debug("Received %s cards", len(cards))
+    return cards
+
+
 def collect_cards(soc):
     try:
-        data_chunks = []
-        while True:
-            chunk = soc.recv(4096)
-            if not chunk:
-                break
-            data_chunks.append(chunk)
-
-        if not data_chunks:
-            print("No data received")
+        cards = decode_cards(recv_chunks(soc))
+
+        if cards is None:
+            logger.debug("No data received")
             return
 
-        decoded_data = b''.join(data_chunks).decode("utf-8")
-        cards = json.loads(decoded_data)
-        print(f"Received {len(cards)} cards")
+        logger.debug("Received %s cards", len(cards))
 
         return cards
 
     except Exception as e:
-        print(f"Error: {e}")
+        logger.error("Error: %s", e)
 
 
 def generate_stable_uid():
@@ -49,4 +345,4 @@ def generate_random_deck_code():
         selected_words = random.sample(words, 5)
         return "+".join(selected_words)
     except Exception as e:
-        print(f"Error generating random deck code: {str(e)}")
\ No newline at end of file
+        logger.error("Error generating random deck code: %s", e)
\ No newline at end of file
@@ -0,0 +1,30 @@
+"""
+The socket server keeps deck privileges in its own process, so membership changes made here
+(or by the socket server itself) rewrite a generation file that it checks on every lookup
+(see Server/auth_snapshot.py).
+"""
+import os
+import uuid
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from login.models import Deck, UserDeck
+
+
+def bump_privilege_generation():
+    # Written aside and renamed so readers never see a partial token
+    path = str(settings.PRIVILEGE_GENERATION_FILE)
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_path, "w") as f:
+        f.write(uuid.uuid4().hex)
+    os.replace(tmp_path, path)
+
+
+@receiver([post_save, post_delete], sender=UserDeck)
+@receiver([post_save, post_delete], sender=Deck)
+def invalidate_privileges(sender, **kwargs):
+    # The socket server rereads the memberships on the bump, so wait for the change to be committed
+    transaction.on_commit(bump_privilege_generation)
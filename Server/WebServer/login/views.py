@@ -1,4 +1,5 @@
 import json
+import logging
 import sys, os
 from django.contrib.auth import authenticate, login as auth_login, logout
 from django.contrib.auth.decorators import login_required
@@ -12,6 +13,8 @@ from DataManagement.cards_management import generate_random_deck_code
 from login.forms import SignUpForm, LoginForm, NewDeckForm
 from login.models import Deck, UserDeck
 
+logger = logging.getLogger(__name__)
+
 
 def login_view(request):
     if request.user.is_authenticated:
@@ -133,7 +136,7 @@ def deck_creation_form(request):
                 return redirect('my_decks')
 
             except Exception as e:
-                print(f"Error in deck creation process: {str(e)}")
+                logger.exception("Error in deck creation process: %s", e)
                 try:
                     if 'deck' in locals():
                         path = f"{project_root}/Server/Decks/{deck.deck_code}.json"
@@ -141,7 +144,7 @@ def deck_creation_form(request):
                             os.remove(path)
                         deck.delete()
                 except Exception as cleanup_error:
-                    print(f"Error during cleanup: {str(cleanup_error)}")
+                    logger.error("Error during cleanup: %s", cleanup_error)
 
                 messages.error(request, f"Error creating deck: {str(e)}")
     else:
@@ -199,29 +202,26 @@ def save_deck_user_privilege(username, deck_code, privilege):
     from django.contrib.auth.models import User
 
     try:
-        print(f"Creating relationship: username={username}, deck_code={deck_code}, privilege={privilege}")
+        logger.debug("Creating relationship: username=%s, deck_code=%s, privilege=%s", username, deck_code, privilege)
 
         user = User.objects.get(username=username)
-        print(f"Found user with ID: {user.id}")
-
         deck = Deck.objects.get(deck_code=deck_code)
-        print(f"Found deck with name: {deck.deck_name}")
         user_deck = UserDeck(
             user=user,
             deck=deck,
             privilege=privilege
         )
         user_deck.save()
-        print("User-deck relationship created successfully")
+        logger.debug("User-deck relationship created for user %s and deck %s", user.id, deck.deck_name)
         return True
     except User.DoesNotExist:
-        print(f"Error: User '{username}' not found")
+        logger.warning("User '%s' not found", username)
         return False
     except Deck.DoesNotExist:
-        print(f"Error: Deck with code '{deck_code}' not found")
+        logger.warning("Deck with code '%s' not found", deck_code)
         return False
     except Exception as e:
-        print(f"Error creating user-deck relationship: {str(e)}")
+        logger.exception("Error creating user-deck relationship: %s", e)
         return False
 
 
@@ -0,0 +1,362 @@
+"""
+asyncio implementation of the socket server. Serves the v1 protocol of server.Server
+(op 0 push, 1 delta pull by timestamp, 2 full deck pull, 3 delta pull by sequence number),
+but every connection is a coroutine instead of a thread. The framed v2/v3 protocol isn't
+implemented: clients opening with its handshake are answered version 1 and carry on in v1 on
+the same connection. The Django ORM privilege checks and the deck store work run in a
+bounded thread pool so they never block the event loop.
+
+Like the threaded server, every request phase runs under its deadline, connections over
+--max-connections are answered BUSY, the deck store and encoding work waits for a fair
+scheduler slot and every request is recorded in the metrics. Full deck downloads are not
+sent from snapshot files.
+
+Usage (from the Server directory):
+    python aio_server.py [--host localhost] [--port 9999] [--workers 32] [--max-connections 10000]
+"""
+import argparse
+import asyncio
+import contextvars
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# server sets up Django and the project root on sys.path, import it first
+from server import (
+    Server, check_for_privilege, new_deck_local, save_deck_user_privilege, retrieve_deck_name,
+    deck_cache, open_deck_store, warm_up, start_metrics, DECKS_DIR, OPS, PULL_TIMESTAMP_BUCKET,
+    deadlines, fair_scheduler, open_connections, request_costs, request_latency, request_errors,
+    request_bytes, response_bytes, push_failures, rejected_connections, schedule_wait
+)
+
+from protocol import encode_cards, CountedCards, DeadlineExceeded, ProtocolError, MAGIC, BUSY, \
+    MAX_UPLOAD_SIZE, UPLOAD_SPOOL_SIZE
+from DataManagement.cards_management import PayloadSpool, PayloadTooLarge, RECV_BUFFER_SIZE
+from offload import payload_pool
+from log_pipeline import setup_logging, request_id, new_connection_id
+
+logger = logging.getLogger("aio_server")
+
+MAX_CONNECTIONS = int(os.environ.get("AIO_MAX_CONNECTIONS", 10000))
+
+
+class StreamConnection:
+    """Reader and writer of a client connection, counting the bytes moved for the request metrics"""
+
+    # Responses are built for the v1 protocol, which has no compression
+    codec = None
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.bytes_received = 0
+        self.bytes_sent = 0
+
+    async def readexactly(self, size):
+        data = await self.reader.readexactly(size)
+        self.bytes_received += len(data)
+        return data
+
+    async def read(self, size):
+        data = await self.reader.read(size)
+        self.bytes_received += len(data)
+        return data
+
+    def write(self, data):
+        self.writer.write(data)
+        self.bytes_sent += len(data)
+
+    async def drain(self):
+        await self.writer.drain()
+
+
+class AsyncServer(Server):
+    def __init__(self, host="localhost", port=9999, store=None, workers=32, max_connections=MAX_CONNECTIONS):
+        # Server.__init__ runs the blocking accept loop, only the deck handling is shared
+        self.host = host
+        self.port = port
+        self.max_connections = max_connections
+        self.store = store or open_deck_store(DECKS_DIR, offload=payload_pool)
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="deck-worker")
+
+    def run(self):
+        try:
+            asyncio.run(self.serve_forever())
+        except KeyboardInterrupt:
+            logger.info("Closing server")
+        finally:
+            self.executor.shutdown(wait=False)
+
+    async def serve_forever(self):
+        server = await asyncio.start_server(self.handle_client, self.host, self.port)
+        logger.info("Async server listening on %s:%s", self.host, self.port)
+        asyncio.get_running_loop().run_in_executor(self.executor, warm_up)
+        start_metrics()
+        async with server:
+            await server.serve_forever()
+
+    async def run_blocking(self, function, *args):
+        """Run ORM and deck store calls in the worker pool, in the context of the request"""
+        loop = asyncio.get_running_loop()
+        context = contextvars.copy_context()
+        return await loop.run_in_executor(self.executor, context.run, function, *args)
+
+    @staticmethod
+    def held(turn, function, *args):
+        """Call function in the fair scheduler slot of the request, from a worker thread"""
+        with turn.hold():
+            return function(*args)
+
+    @staticmethod
+    async def within(phase, awaitable):
+        """Await under the deadline of a request phase, see protocol.Deadlines"""
+        seconds = getattr(deadlines, phase)
+        try:
+            return await asyncio.wait_for(awaitable, seconds)
+        except asyncio.TimeoutError as e:
+            if deadlines.on_expired is not None:
+                deadlines.on_expired(phase)
+            raise DeadlineExceeded(phase, seconds) from e
+
+    async def read_size_and_package(self, stream):
+        """Read a 64 byte size header followed by the data"""
+        size = await stream.readexactly(self.HEADER)
+        return (await stream.readexactly(int(size.decode("utf-8")))).decode("utf-8")
+
+    def write_size_and_package(self, stream, info):
+        info_encoded = str(info).encode("utf-8")
+        info_length = str(len(info_encoded)).encode("utf-8")
+        stream.write(info_length + b' ' * (self.HEADER - len(info_length)) + info_encoded)
+
+    async def handle_client(self, reader, writer):
+        # Every connection runs in its own task, so its context only holds this request id
+        request_id.set(str(new_connection_id()))
+        if len(open_connections) >= self.max_connections:
+            # Answered like a full queue of the threaded server, the client backs off
+            rejected_connections.inc(reason="queue_full")
+            logger.debug("Rejecting connection: queue_full")
+            writer.write(BUSY)
+            await self.close(writer)
+            return
+
+        stream = StreamConnection(reader, writer)
+        open_connections.add(stream)
+        try:
+            request = await self.within("handshake", self.read_request(stream))
+            await self.measure_request(stream, request)
+            await stream.drain()
+        except DeadlineExceeded as e:
+            logger.warning("Closing connection: %s", e)
+        except (asyncio.IncompleteReadError, ConnectionError) as e:
+            logger.info("Connection lost: %s", e)
+        except Exception as e:
+            logger.error("Error: %s", e)
+        finally:
+            open_connections.discard(stream)
+            await self.close(writer)
+
+    @staticmethod
+    async def close(writer):
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except ConnectionError:
+            pass
+
+    async def read_request(self, stream):
+        """Read the op and its arguments, answering the handshake of v2/v3 clients with version 1"""
+        op = await stream.readexactly(1)
+        if op == MAGIC:
+            await stream.readexactly(1)
+            stream.write(MAGIC + bytes([1]))
+            await stream.drain()
+            op = await stream.readexactly(1)
+
+        request = {"op": op.decode("utf-8")}
+        request["username"] = await self.read_size_and_package(stream)
+        request["deck_code"] = (await self.read_size_and_package(stream)).strip()
+        if request["op"] == "0":
+            request["deck_name"] = await self.read_size_and_package(stream)
+        return request
+
+    async def measure_request(self, stream, request):
+        """handle_request() recording its latency, errors and bytes in the metrics, see Server.measure_request()"""
+        op = request["op"] if request["op"] in OPS else "invalid"
+        deck_code = request["deck_code"]
+        start = time.perf_counter()
+        turn = fair_scheduler.turn(request["username"], self.estimate_cost(op, deck_code),
+                                   on_wait=lambda waited: schedule_wait.observe(waited, op=op))
+        try:
+            await self.handle_request(stream, request, turn)
+        except Exception:
+            request_errors.inc(op=op)
+            raise
+        finally:
+            request_latency.observe(time.perf_counter() - start, op=op)
+            request_bytes.inc(stream.bytes_received, op=op)
+            response_bytes.inc(stream.bytes_sent, op=op)
+            moved = stream.bytes_received + stream.bytes_sent
+            turn.charge(moved)
+            request_costs.record(op, deck_code, moved)
+
+    async def handle_request(self, stream, request, turn):
+        username = request["username"]
+        deck_code = request["deck_code"]
+
+        match request["op"]:
+            case "0":
+                deck_name = request["deck_name"]
+                new = not await self.run_blocking(self.store.exists, deck_code)
+
+                if new or await self.run_blocking(check_for_privilege, username, deck_code, ["c", "m", "w"]):
+                    stream.write(b"1")
+                    await stream.drain()
+                    stored = await self.add_cards_async(stream, deck_code, new, turn)
+                    stream.write(b"1" if stored else b"0")
+                    await stream.drain()
+
+                    if stored and new:
+                        await self.run_blocking(new_deck_local, deck_name, deck_code)
+                        await self.run_blocking(save_deck_user_privilege, username, deck_code, "c")
+                else:
+                    stream.write(b"0")
+
+            case "1" | "2" | "3":
+                if await self.run_blocking(check_for_privilege, username, deck_code, ["c", "m", "w", "r"]):
+                    stream.write(b"1")
+                    await self.send_cards_async(stream, request["op"], deck_code, turn)
+                else:
+                    stream.write(b"0")
+
+            case _:
+                logger.warning("Invalid op %r", request["op"])
+                raise ProtocolError(f"Invalid op {request['op']!r}")
+
+    async def spool_upload(self, stream):
+        """Read the pushed payload until the client half-closes, spooling big ones to a temp file"""
+        spool = PayloadSpool(UPLOAD_SPOOL_SIZE)
+        size = 0
+        try:
+            while chunk := await stream.read(RECV_BUFFER_SIZE):
+                size += len(chunk)
+                if size > MAX_UPLOAD_SIZE:
+                    raise PayloadTooLarge(f"Payload exceeds the {MAX_UPLOAD_SIZE} bytes limit")
+                spool.write(chunk)
+        except BaseException:
+            # Also when the upload deadline cancels the read
+            spool.close()
+            raise
+
+        spool.seek(0)
+        return spool
+
+    async def add_cards_async(self, stream, deck_code, new, turn):
+        """Read the pushed cards and store them, decoding runs in the worker pool"""
+        try:
+            with await self.within("upload", self.spool_upload(stream)) as spool:
+                cards = await self.run_blocking(payload_pool.decode_spool, spool, UPLOAD_SPOOL_SIZE)
+            logger.debug("Received %s cards", len(cards))
+            # Both take the slot themselves, after the deck writer lock
+            if new:
+                await self.run_blocking(self.create_deck, deck_code, cards, turn)
+            else:
+                await self.run_blocking(self.save_cards_to_json, deck_code, cards, turn)
+            return True
+        except DeadlineExceeded:
+            # The rest of the upload is still on the way, answering it is pointless
+            raise
+        except Exception as e:
+            logger.error("Push to deck %s failed: %s", deck_code, e)
+            push_failures.inc()
+            return False
+
+    async def send_cards_async(self, stream, op, deck_code, turn):
+        match op:
+            case "1":
+                timestamp = int(await self.within("handshake", self.read_size_and_package(stream)))
+                if PULL_TIMESTAMP_BUCKET:
+                    timestamp -= timestamp % PULL_TIMESTAMP_BUCKET
+                _, encoded = await self.run_blocking(self.held, turn, self.timestamp_response,
+                                                     stream, deck_code, timestamp)
+            case "3":
+                since_seq = int(await self.within("handshake", self.read_size_and_package(stream)))
+                high_seq, encoded = await self.run_blocking(self.held, turn, self.seq_response,
+                                                            stream, deck_code, since_seq)
+                self.write_size_and_package(stream, high_seq)
+            case _:
+                deck_name = await self.run_blocking(retrieve_deck_name, deck_code)
+                self.write_size_and_package(stream, deck_name)
+                version = await self.run_blocking(self.store.version, deck_code)
+                encoded = await self.run_blocking(self.held, turn, self.cached_deck_response,
+                                                  stream, deck_code, version)
+
+        if encoded is not None:
+            sent = await self.within("download", self.send_encoded(stream, encoded))
+        else:
+            # Decks missing from the cache are read and encoded in the slot one batch at a time
+            counted = CountedCards(self.store.iter_cards(deck_code))
+            await self.within("download", self.stream_from_worker(stream, turn.iterate(encode_cards(counted))))
+            sent = counted.count
+        logger.info("Sent %s cards of deck %s", sent, deck_code)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Deck cache: %s", deck_cache.stats())
+
+    async def send_encoded(self, stream, encoded):
+        """Send a response built by pull_response(), returns the number of cards sent"""
+        if encoded.complete:
+            for chunk in encoded.chunks:
+                stream.write(chunk)
+                await stream.drain()
+        else:
+            # The rest of a big response is encoded while it is sent
+            await self.stream_from_worker(stream, encoded.chunks)
+        return encoded.count
+
+    async def stream_from_worker(self, stream, chunks):
+        """
+        Run the chunk generator in a single worker thread (SQLite cursors can't move between
+        threads) and write the chunks as they come, with a small queue for backpressure.
+        """
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue(maxsize=4)
+        stopped = threading.Event()
+
+        def send(chunk):
+            asyncio.run_coroutine_threadsafe(queue.put(chunk), loop).result()
+
+        def produce():
+            try:
+                for chunk in chunks:
+                    if stopped.is_set():
+                        break
+                    send(chunk)
+            finally:
+                send(None)
+
+        producer = loop.run_in_executor(self.executor, produce)
+        try:
+            while (chunk := await queue.get()) is not None:
+                stream.write(chunk)
+                await stream.drain()
+        finally:
+            stopped.set()
+            # Keep the queue moving so the worker thread is released if the client went away
+            while not producer.done():
+                try:
+                    queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    await asyncio.sleep(0.01)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="asyncio card sync server")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=9999)
+    parser.add_argument("--workers", type=int, default=32)
+    parser.add_argument("--max-connections", type=int, default=MAX_CONNECTIONS)
+    args = parser.parse_args()
+
+    setup_logging()
+    AsyncServer(args.host, args.port, workers=args.workers, max_connections=args.max_connections).run()
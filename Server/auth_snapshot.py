@@ -0,0 +1,77 @@
+"""
+Read-only snapshot of the deck memberships, read straight from the Django SQLite database so
+the socket server can answer privilege checks without loading Django.
+"""
+import sqlite3
+import threading
+import time
+
+MEMBERSHIP_QUERY = """
+    SELECT auth_user.username, login_userdeck.deck_id, login_userdeck.privilege
+    FROM login_userdeck JOIN auth_user ON auth_user.id = login_userdeck.user_id
+"""
+
+
+def generation_token(path):
+    """Contents of the privilege generation file, they change on every membership change"""
+    try:
+        with open(path) as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+
+class MembershipSnapshot:
+    """
+    Maps (username, deck_code) to the privilege of the user on the deck. The snapshot is
+    reloaded when the privilege generation file changes (see login/signals.py) and at least
+    every refresh_interval seconds, the reload replaces the whole mapping at once.
+    """
+
+    def __init__(self, db_path, generation_path, refresh_interval=30):
+        self.db_path = db_path
+        self.generation_path = generation_path
+        self.refresh_interval = refresh_interval
+        self.lookups = 0
+        self.refreshes = 0
+
+        self._lock = threading.Lock()
+        self._memberships = None
+        self._generation = None
+        self._loaded_at = 0.0
+
+    def get(self, username, deck_code):
+        """Privilege of the user on the deck, None without access"""
+        token = generation_token(self.generation_path)
+        if (self._memberships is None or token != self._generation
+                or time.monotonic() - self._loaded_at > self.refresh_interval):
+            self.refresh(token)
+
+        self.lookups += 1
+        return self._memberships.get((username, deck_code))
+
+    def refresh(self, token=None):
+        with self._lock:
+            # Another thread may have reloaded it while this one waited for the lock
+            if (self._memberships is not None and token == self._generation
+                    and time.monotonic() - self._loaded_at <= self.refresh_interval):
+                return
+
+            conn = sqlite3.connect(f"file:{self.db_path}?mode=ro", uri=True)
+            try:
+                memberships = {(username, deck_code): privilege
+                               for username, deck_code, privilege in conn.execute(MEMBERSHIP_QUERY)}
+            finally:
+                conn.close()
+
+            self._memberships = memberships
+            self._generation = token
+            self._loaded_at = time.monotonic()
+            self.refreshes += 1
+
+    def stats(self):
+        return {
+            "memberships": len(self._memberships or ()),
+            "lookups": self.lookups,
+            "refreshes": self.refreshes,
+        }
@@ -0,0 +1,171 @@
+"""
+Micro-benchmarks of the core card paths without the network: deck creation
+(Server.create_deck), push merges (Server.save_cards_to_json), delta pulls by timestamp
+(Server.retrieve_cards_from_json, with the deck cached and after a cache miss) and reading a
+push from a socket (collect_cards and the spooled collect_upload of the server, fed through a
+socketpair). Decks are stored in a temporary directory with the store picked by --backend.
+
+Every case runs across the deck sizes and the shares of changed cards, reports the median and
+best time over --runs runs and the peak memory of one more run traced with tracemalloc.
+
+Usage (from the Server directory):
+    python benchmarks/bench_core.py [--sizes 100 1000 10000 100000 500000]
+                                    [--ratios 0.001 0.01 0.1 1] [--runs 5] [--save results.json]
+"""
+import argparse
+import gc
+import json
+import os
+import socket
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SERVER_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, SERVER_DIR)
+
+# Measure the merge itself, not the time a push waits for others to join its group commit
+os.environ.setdefault("GROUP_COMMIT_WINDOW_MS", "0")
+
+import server
+from DataManagement import serializer
+from DataManagement.cards_management import collect_cards, collect_upload, recv_chunks
+from deck_store import STORE_BACKENDS
+from protocol import UPLOAD_SPOOL_SIZE
+from synthetic import make_deck, touch_cards
+
+BASE_TIMESTAMP = 1_700_000_000
+
+
+def measure(fn, setup, runs):
+    """Time fn(setup()) over the runs, then trace one more run, returns (timings, peak bytes)"""
+    timings = []
+    for _ in range(runs):
+        argument = setup()
+        gc.collect()
+        start = time.perf_counter()
+        fn(argument)
+        timings.append(time.perf_counter() - start)
+
+    argument = setup()
+    gc.collect()
+    tracemalloc.start()
+    baseline = tracemalloc.get_traced_memory()[0]
+    fn(argument)
+    peak = tracemalloc.get_traced_memory()[1] - baseline
+    tracemalloc.stop()
+    return timings, peak
+
+
+def socket_feed(payload):
+    """A socketpair with the payload being written to the other end by a thread"""
+    reader, writer = socket.socketpair()
+
+    def send():
+        with writer:
+            writer.sendall(payload)
+
+    threading.Thread(target=send, daemon=True).start()
+    return reader
+
+
+def read_push(collect):
+    def run(sock):
+        with sock:
+            collect(sock)
+    return run
+
+
+class Bench:
+    def __init__(self, decks_dir, backend):
+        # Server.__init__ runs the accept loop, only the deck handling is needed
+        self.server = server.Server.__new__(server.Server)
+        self.server.store = server.open_deck_store(decks_dir, backend)
+        self.decks = 0
+
+    def new_deck_code(self):
+        self.decks += 1
+        return f"bench+core+{self.decks}"
+
+    def cases(self, size, ratio, cards):
+        """(name, fn, setup) of every case for a deck of the size and a share of changed cards"""
+        bench = self.server
+        changed = touch_cards(cards, ratio, BASE_TIMESTAMP + 1)
+        payload = serializer.dumps(changed)
+        pushes = iter(range(2, 1 << 62))
+
+        deck_code = self.new_deck_code()
+        bench.create_deck(deck_code, [dict(card) for card in cards])
+        bench.save_cards_to_json(deck_code, [dict(card) for card in changed])
+
+        def next_push():
+            # Every run pushes newer versions of the same cards, so they are always accepted
+            last_modified = BASE_TIMESTAMP + next(pushes)
+            return [dict(card, last_modified=last_modified) for card in changed]
+
+        def cached():
+            bench.load_deck(deck_code)
+            return BASE_TIMESTAMP
+
+        def cold():
+            server.deck_cache.invalidate(deck_code)
+            return BASE_TIMESTAMP
+
+        return [
+            ("create_deck", lambda new_cards: bench.create_deck(self.new_deck_code(), new_cards),
+             lambda: [dict(card) for card in cards]),
+            ("save_cards_to_json", lambda new_cards: bench.save_cards_to_json(deck_code, new_cards), next_push),
+            ("delta pull cached", lambda timestamp: bench.retrieve_cards_from_json(deck_code, timestamp), cached),
+            ("delta pull cold", lambda timestamp: bench.retrieve_cards_from_json(deck_code, timestamp), cold),
+            ("collect_cards", read_push(collect_cards), lambda: socket_feed(payload)),
+            ("collect_upload", read_push(lambda sock: collect_upload(recv_chunks(sock), UPLOAD_SPOOL_SIZE)),
+             lambda: socket_feed(payload)),
+        ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 1000, 10000, 100000, 500000])
+    parser.add_argument("--ratios", type=float, nargs="+", default=[0.001, 0.01, 0.1, 1.0],
+                        help="shares of the deck changed by a push and returned by a delta pull")
+    parser.add_argument("--backend", choices=sorted(STORE_BACKENDS), help="deck store, DECK_STORE by default")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--save", help="write the results to this JSON file")
+    args = parser.parse_args()
+
+    results = []
+    print(f"{'case':<20} {'cards':>7} {'changed':>8} {'median ms':>10} {'best ms':>10} {'peak MiB':>9}")
+    with tempfile.TemporaryDirectory() as decks_dir:
+        bench = Bench(decks_dir, args.backend)
+        for size in args.sizes:
+            cards = make_deck(size, last_modified=BASE_TIMESTAMP)
+            for ratio in args.ratios:
+                for name, fn, setup in bench.cases(size, ratio, cards):
+                    # Creating the deck doesn't depend on the share of changed cards
+                    if name == "create_deck" and ratio != args.ratios[0]:
+                        continue
+                    timings, peak = measure(fn, setup, args.runs)
+                    result = {
+                        "case": name,
+                        "cards": size,
+                        "ratio": ratio,
+                        "median_ms": round(statistics.median(timings) * 1000, 3),
+                        "best_ms": round(min(timings) * 1000, 3),
+                        "peak_mib": round(peak / 2 ** 20, 2),
+                    }
+                    results.append(result)
+                    print(f"{name:<20} {size:>7} {ratio:>8.1%} {result['median_ms']:>10.2f} "
+                          f"{result['best_ms']:>10.2f} {result['peak_mib']:>9.2f}")
+
+    if args.save:
+        with open(args.save, "w") as output:
+            json.dump({"backend": args.backend or os.environ.get("DECK_STORE", "log"),
+                       "json_backend": serializer.backend.name, "results": results}, output, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+"""
+Compares delta pull latency of the deck store backends.
+
+Usage (from the Server directory):
+    python benchmarks/bench_delta_pull.py [--sizes 1000 10000 100000] [--runs 20]
+"""
+import argparse
+import contextlib
+import io
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from deck_store import STORE_BACKENDS
+from synthetic import make_deck, touch_cards
+
+BASE_TIMESTAMP = 1_700_000_000
+
+
+def time_delta_pull(store, deck_code, timestamp, runs):
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            cards = store.retrieve(deck_code, timestamp)
+        timings.append(time.perf_counter() - start)
+    return timings, len(cards)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--backends", nargs="+", default=["json", "sqlite"], choices=sorted(STORE_BACKENDS))
+    parser.add_argument("--changed", type=float, default=0.01, help="share of cards changed since the pull timestamp")
+    parser.add_argument("--runs", type=int, default=20)
+    args = parser.parse_args()
+
+    print(f"{'backend':<8} {'cards':>8} {'changed':>8} {'median ms':>10} {'p95 ms':>10}")
+    for size in args.sizes:
+        cards = make_deck(size, last_modified=BASE_TIMESTAMP)
+        changed = touch_cards(cards, args.changed, BASE_TIMESTAMP + 60)
+
+        for backend in args.backends:
+            with tempfile.TemporaryDirectory() as decks_dir:
+                store = STORE_BACKENDS[backend](decks_dir)
+                with contextlib.redirect_stdout(io.StringIO()):
+                    store.create("bench", cards)
+                    store.merge("bench", changed)
+
+                timings, count = time_delta_pull(store, "bench", BASE_TIMESTAMP, args.runs)
+                timings.sort()
+                p95 = timings[min(len(timings) - 1, int(len(timings) * 0.95))]
+                print(f"{backend:<8} {size:>8} {count:>8} "
+                      f"{statistics.median(timings) * 1000:>10.2f} {p95 * 1000:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+"""
+Latency of small delta pulls while a few users download big decks, with and without the fair
+scheduler. --heavy clients, each with its own user, keep pulling a deck of --heavy-cards cards
+(op 2), while --light clients, one user each, pull the changes of small decks (op 1). The
+server runs in its own process once per --slots value, 0 disables the scheduler.
+
+The users and decks are created in a throwaway Django database and decks directory (see sandbox.py).
+
+Usage (from the Server directory):
+    python benchmarks/bench_fairness.py [--slots 0 2 8] [--heavy 4] [--light 32] [--seconds 10]
+"""
+import argparse
+import os
+import random
+import sys
+import threading
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+import load_test
+from load_test import prepare, start_server, delta_pull, open_request, percentile
+
+HEAVY_DECK = "load+test+deck+0"
+
+
+def download(port, username, deck_code):
+    """
+    Full pull that reads the response without parsing it. Parsing a big deck would hold the GIL
+    of this process, and the light clients' latencies would measure it instead of the server.
+    """
+    with open_request(port, "2", username, deck_code) as sock:
+        while sock.recv(1024 * 1024):
+            pass
+
+
+def client_loop(pull, stop, latencies, errors):
+    while not stop.is_set():
+        start = time.monotonic()
+        try:
+            pull()
+        except Exception as e:
+            errors.append(str(e))
+            continue
+        latencies.append(time.monotonic() - start)
+
+
+def run(args, slots):
+    # Deck 0 is the big one, the light clients pull the others
+    usernames, deck_uids = prepare(args.heavy + args.light, 1 + args.light_decks, args.light_cards)
+    prepare_heavy_deck(args.heavy_cards)
+    light_decks = [deck_code for deck_code in deck_uids if deck_code != HEAVY_DECK]
+
+    os.environ["FAIR_SLOTS"] = str(slots)
+    process = start_server(args.port)
+    stop = threading.Event()
+    results = {"heavy": ([], []), "light": ([], [])}
+    threads = []
+    try:
+        for number in range(args.heavy):
+            username = usernames[number]
+            pull = lambda username=username: download(args.port, username, HEAVY_DECK)
+            threads.append(threading.Thread(target=client_loop, args=(pull, stop, *results["heavy"])))
+        rng = random.Random(0)
+        for number in range(args.light):
+            username, deck_code = usernames[args.heavy + number], rng.choice(light_decks)
+            # Nothing changed since the deck was created, the responses are tiny
+            pull = lambda username=username, deck_code=deck_code: delta_pull(args.port, username, deck_code, 1)
+            threads.append(threading.Thread(target=client_loop, args=(pull, stop, *results["light"])))
+        for thread in threads:
+            thread.start()
+        time.sleep(args.seconds)
+        stop.set()
+        for thread in threads:
+            thread.join()
+    finally:
+        process.terminate()
+        process.wait()
+
+    for kind, (latencies, errors) in results.items():
+        if not latencies and not errors:
+            continue
+        print(f"slots {slots:>2}  {kind:<5} {len(latencies):>6} ops {len(latencies) / args.seconds:>8.1f} ops/s  "
+              f"p50 {percentile(latencies, 0.5):>8} ms  p99 {percentile(latencies, 0.99):>8} ms  "
+              f"errors {len(errors)}")
+
+
+def prepare_heavy_deck(cards):
+    from synthetic import make_realistic_card
+    store = load_test.server.open_deck_store(load_test.server.DECKS_DIR)
+    rng = random.Random(0)
+    store.create(HEAVY_DECK, [make_realistic_card(HEAVY_DECK, 1, rng) for _ in range(cards)])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--slots", type=int, nargs="+", default=[0, 2, 8], help="FAIR_SLOTS, 0 disables")
+    parser.add_argument("--heavy", type=int, default=4, help="clients downloading the big deck")
+    parser.add_argument("--heavy-cards", type=int, default=30000)
+    parser.add_argument("--light", type=int, default=32, help="clients pulling small deltas")
+    parser.add_argument("--light-decks", type=int, default=8)
+    parser.add_argument("--light-cards", type=int, default=200)
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--port", type=int, default=9960)
+    args = parser.parse_args()
+
+    for number, slots in enumerate(args.slots):
+        run(args, slots)
+        args.port += 1
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,161 @@
+"""
+Latency of small requests while a big deck is being imported, with the payload work done inline
+and in the offload process pool. Small clients keep pushing a few cards and pulling deltas on
+their own deck, first alone and then while another client pushes a deck of --import-cards cards
+in a loop. Every configuration runs the server in a fresh process.
+
+A bench user and its decks are created in a throwaway Django database and
+decks directory (see sandbox.py).
+
+Usage (from the Server directory):
+    python benchmarks/bench_offload.py [--workers 0 2] [--import-cards 100000] [--seconds 5]
+"""
+import argparse
+import contextlib
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SERVER_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, SERVER_DIR)
+
+from sandbox import use_sandbox, setup_database
+
+# The server reads its paths from the environment when it is imported
+use_sandbox()
+
+USERNAME = "offload_user"
+SMALL_DECK = "offload+bench+small"
+BIG_DECK = "offload+bench+big"
+IMPORT_PAYLOADS = 3
+
+
+def prepare_decks(server):
+    setup_database()
+    from django.contrib.auth.models import User
+    from login.models import Deck, UserDeck
+    from synthetic import make_deck
+
+    user, _ = User.objects.get_or_create(username=USERNAME)
+    store = server.open_deck_store(server.DECKS_DIR)
+    for deck_code in (SMALL_DECK, BIG_DECK):
+        deck, _ = Deck.objects.get_or_create(deck_code=deck_code, defaults={"deck_name": deck_code, "deck_desc": ""})
+        UserDeck.objects.update_or_create(user=user, deck=deck, defaults={"privilege": "w"})
+        store.create(deck_code, make_deck(100, deck_code, last_modified=0))
+
+
+def small_client(number, port, stop, latencies):
+    from stress_concurrency import Client
+    from synthetic import make_card
+
+    rng = random.Random(number)
+    client = Client(port)
+    since_seq = 0
+    pushes = 0
+    try:
+        while not stop.is_set():
+            start = time.perf_counter()
+            if rng.random() < 0.5:
+                cards = [make_card(SMALL_DECK, pushes + 1, rng, f"c{number}-{pushes}-{i}") for i in range(5)]
+                pushes += 1
+                client.push(SMALL_DECK, cards)
+            else:
+                since_seq, _ = client.pull(SMALL_DECK, since_seq)
+            latencies.append(time.perf_counter() - start)
+    finally:
+        client.close()
+
+
+def run_phase(port, clients, seconds, importer=None):
+    stop = threading.Event()
+    latencies = []
+    threads = [threading.Thread(target=small_client, args=(number, port, stop, latencies))
+               for number in range(clients)]
+    for thread in threads:
+        thread.start()
+    if importer is not None:
+        importer(stop)
+    else:
+        time.sleep(seconds)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    return latencies
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))] * 1000 if values else float("nan")
+
+
+def child(args):
+    import server
+    import stress_concurrency
+    from DataManagement import serializer
+    from protocol import send_message, expect_frame, STATUS
+    from synthetic import make_deck
+
+    stress_concurrency.USERNAME = USERNAME
+    prepare_decks(server)
+    payloads = [serializer.dumps(make_deck(args.import_cards, BIG_DECK, last_modified=n + 1))
+                for n in range(IMPORT_PAYLOADS)]
+    imports = []
+
+    def importer(stop):
+        client = stress_concurrency.Client(args.port)
+        for payload in payloads:
+            start = time.perf_counter()
+            client.request(op="0", deck_code=BIG_DECK, deck_name=BIG_DECK)
+            send_message(client.sock, payload)
+            expect_frame(client.sock, STATUS)
+            imports.append(time.perf_counter() - start)
+        client.close()
+
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        threading.Thread(target=server.Server, kwargs={"port": args.port}, daemon=True).start()
+        time.sleep(0.5)
+        phases = {
+            "idle": run_phase(args.port, args.clients, args.seconds),
+            "import": run_phase(args.port, args.clients, args.seconds, importer),
+        }
+        # Let the handler threads finish their last lines
+        time.sleep(0.5)
+
+    mb = len(payloads[0]) / 1024 / 1024
+    print(f"workers {server.payload_pool.workers}: {IMPORT_PAYLOADS} imports of {args.import_cards} cards "
+          f"({mb:.0f} MiB), {sum(imports) / len(imports):.2f} s each")
+    for name, latencies in phases.items():
+        print(f"  small requests {name:<7} {len(latencies):>6} ops  p50 {percentile(latencies, 0.5):>7.1f} ms  "
+              f"p99 {percentile(latencies, 0.99):>7.1f} ms  max {percentile(latencies, 1):>7.1f} ms")
+    print(f"  offload: {server.payload_pool.stats()}")
+    server.payload_pool.shutdown()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, nargs="+", default=[0, 2], help="offload workers, 0 runs inline")
+    parser.add_argument("--import-cards", type=int, default=100000)
+    parser.add_argument("--clients", type=int, default=8, help="small request clients")
+    parser.add_argument("--seconds", type=float, default=5, help="length of the idle phase")
+    parser.add_argument("--port", type=int, default=9980)
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    sys.path.insert(0, BENCH_DIR)
+    if args.child:
+        child(args)
+        return
+
+    for number, workers in enumerate(args.workers):
+        env = dict(os.environ, OFFLOAD_WORKERS=str(workers))
+        subprocess.run([sys.executable, __file__, "--child", "--import-cards", str(args.import_cards),
+                        "--clients", str(args.clients), "--seconds", str(args.seconds),
+                        "--port", str(args.port + number)], env=env, check=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+"""
+Peak memory and time to first byte of a full deck pull, comparing a single json.dumps of the
+deck with the streaming encoder (from the cached dict and straight from the SQLite store).
+The response goes through a socketpair drained by a reader thread.
+
+Usage (from the Server directory):
+    python benchmarks/bench_pull_memory.py [--cards 200000]
+"""
+import argparse
+import contextlib
+import gc
+import io
+import json
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SERVER_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, SERVER_DIR)
+sys.path.insert(0, os.path.dirname(SERVER_DIR))
+
+from deck_store import SqliteDeckStore
+from protocol import V1Connection
+from synthetic import make_deck
+
+
+class Drain:
+    """Reads the other end of the socketpair, recording when the first byte arrived"""
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.first_byte = None
+        self.received = 0
+        self.thread = threading.Thread(target=self.run)
+        self.thread.start()
+
+    def run(self):
+        buffer = bytearray(256 * 1024)
+        while True:
+            count = self.sock.recv_into(buffer)
+            if not count:
+                break
+            if self.first_byte is None:
+                self.first_byte = time.perf_counter()
+            self.received += count
+
+
+def measure(name, send):
+    server_side, client_side = socket.socketpair()
+    drain = Drain(client_side)
+
+    gc.collect()
+    tracemalloc.start()
+    baseline = tracemalloc.get_traced_memory()[0]
+    start = time.perf_counter()
+    send(server_side)
+    server_side.shutdown(socket.SHUT_WR)
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1] - baseline
+    tracemalloc.stop()
+
+    drain.thread.join()
+    server_side.close()
+    client_side.close()
+    print(f"{name:<14} {drain.received / 2 ** 20:>10.1f} {peak / 2 ** 20:>10.1f} "
+          f"{(drain.first_byte - start) * 1000:>10.1f} {elapsed * 1000:>10.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--cards", type=int, default=200000)
+    args = parser.parse_args()
+
+    cards = {card["stable_uid"]: card for card in make_deck(args.cards)}
+
+    with tempfile.TemporaryDirectory() as decks_dir:
+        store = SqliteDeckStore(decks_dir)
+        with contextlib.redirect_stdout(io.StringIO()):
+            store.create("bench", cards.values())
+
+        print(f"{'encoder':<14} {'sent MiB':>10} {'peak MiB':>10} {'first ms':>10} {'total ms':>10}")
+        measure("json.dumps", lambda sock: sock.sendall(json.dumps(cards).encode("utf-8")))
+        measure("stream-dict", lambda sock: V1Connection(sock, "2").send_cards(cards))
+        measure("stream-sqlite", lambda sock: V1Connection(sock, "2").send_cards(store.iter_cards("bench")))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+"""
+Encode and decode throughput of the JSON serializer backends on synthetic decks: a whole deck
+keyed by stable_uid (snapshot files, pull responses), a push of a few cards and the one card
+per line encoding of the log segments. Also prints the deck file size of the old indented
+json.dump next to the compact output.
+
+Usage (from the Server directory):
+    python benchmarks/bench_serializer.py [--cards 1000 10000 100000] [--repeat 5]
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SERVER_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, SERVER_DIR)
+sys.path.insert(0, os.path.dirname(SERVER_DIR))
+
+from DataManagement.serializer import available_backends
+from synthetic import make_deck
+
+PUSH_CARDS = 20
+
+
+def best_time(fn, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def payloads(size):
+    cards = make_deck(size)
+    deck = {card["stable_uid"]: card for card in cards}
+    return {
+        f"deck {size}": (deck, len(cards)),
+        f"push {PUSH_CARDS}": (cards[:PUSH_CARDS], PUSH_CARDS),
+        f"log lines {size}": (cards, len(cards)),
+    }
+
+
+def measure(backend, name, obj, count, repeat):
+    if name.startswith("log lines"):
+        encoded = [backend.dumps(card) for card in obj]
+        encode = lambda: b"".join(backend.dumps(card) + b"\n" for card in obj)
+        decode = lambda: [backend.loads(line) for line in encoded]
+        size = sum(len(line) + 1 for line in encoded)
+    else:
+        encoded = backend.dumps(obj)
+        encode = lambda: backend.dumps(obj)
+        decode = lambda: backend.loads(encoded)
+        size = len(encoded)
+
+    # Small payloads are timed in batches so the timer resolution doesn't dominate
+    loops = max(1, 10_000 // count)
+    encode_time = best_time(lambda: [encode() for _ in range(loops)], repeat) / loops
+    decode_time = best_time(lambda: [decode() for _ in range(loops)], repeat) / loops
+    mb = size / 1024 / 1024
+    print(f"  {backend.name:<8} {name:<16} encode {mb / encode_time:>8.1f} MB/s {count / encode_time:>11,.0f} cards/s"
+          f"   decode {mb / decode_time:>8.1f} MB/s {count / decode_time:>11,.0f} cards/s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--cards", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    backends = available_backends()
+    print(f"backends: {', '.join(backends)}")
+    for size in args.cards:
+        print(f"{size} cards")
+        for name, (obj, count) in payloads(size).items():
+            for backend in backends.values():
+                measure(backend, name, obj, count, args.repeat)
+
+        deck = payloads(size)[f"deck {size}"][0]
+        indented = len(json.dumps(deck, indent=4).encode("utf-8"))
+        compact = len(backends["json"].dumps(deck))
+        print(f"  deck file: indented {indented / 1024:,.0f} KiB, compact {compact / 1024:,.0f} KiB "
+              f"({compact / indented:.0%})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,161 @@
+"""
+Compares the thread-per-connection server with the asyncio server at a high number of
+concurrent connections. Every client opens a connection, asks for a delta pull (op 3) and
+parks before sending its cursor, so the servers hold all the connections at once. The
+benchmark then samples the server RSS, releases every client at the same time and measures
+the latency of each pull until the response is fully read.
+
+A benchmark user and deck are created in a throwaway Django database and
+decks directory (see sandbox.py).
+
+Usage (from the Server directory):
+    python benchmarks/bench_servers.py [--connections 1000] [--cards 200]
+"""
+import argparse
+import asyncio
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SERVER_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, SERVER_DIR)
+
+from sandbox import use_sandbox, setup_database
+
+# The server reads its paths from the environment when it is imported
+use_sandbox()
+
+from synthetic import make_deck
+
+HEADER = 64
+USERNAME = "benchmark_user"
+DECK_CODE = "benchmark+servers+deck+code+load"
+
+SERVERS = {
+    "threaded": lambda port: [sys.executable, "-c", f"from server import Server; Server(port={port})"],
+    "asyncio": lambda port: [sys.executable, "aio_server.py", "--port", str(port)],
+}
+
+
+def prepare_deck(cards):
+    """Create the benchmark user, deck and privilege, and store the deck cards"""
+    import server
+    setup_database()
+    from django.contrib.auth.models import User
+    from login.models import Deck, UserDeck
+
+    user, _ = User.objects.get_or_create(username=USERNAME)
+    deck, _ = Deck.objects.get_or_create(deck_code=DECK_CODE, defaults={"deck_name": "Benchmark", "deck_desc": ""})
+    UserDeck.objects.get_or_create(user=user, deck=deck, defaults={"privilege": "r"})
+    server.open_deck_store(server.DECKS_DIR).create(DECK_CODE, make_deck(cards))
+
+
+def package(info):
+    encoded = str(info).encode("utf-8")
+    size = str(len(encoded)).encode("utf-8")
+    return size + b' ' * (HEADER - len(size)) + encoded
+
+
+def rss_kib(pid):
+    with open(f"/proc/{pid}/status") as status:
+        for line in status:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1])
+    return 0
+
+
+def wait_for_port(port, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("localhost", port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f"Server on port {port} did not start")
+
+
+async def parked_pull(port, parked, release, latencies, failures):
+    try:
+        reader, writer = await asyncio.open_connection("localhost", port)
+        writer.write(b"3" + package(USERNAME) + package(DECK_CODE))
+        await writer.drain()
+        if await reader.readexactly(1) != b"1":
+            raise RuntimeError("privilege check failed")
+    except Exception:
+        failures.append(1)
+        parked.release()
+        return
+
+    parked.release()
+    await release.wait()
+
+    start = time.perf_counter()
+    try:
+        writer.write(package(0))
+        await writer.drain()
+        await reader.read()
+        latencies.append(time.perf_counter() - start)
+    except Exception:
+        failures.append(1)
+    finally:
+        writer.close()
+
+
+async def run_clients(port, pid, connections):
+    parked = asyncio.Semaphore(0)
+    release = asyncio.Event()
+    latencies, failures = [], []
+
+    tasks = [asyncio.create_task(parked_pull(port, parked, release, latencies, failures))
+             for _ in range(connections)]
+    for _ in range(connections):
+        await parked.acquire()
+
+    parked_rss = rss_kib(pid)
+    release.set()
+    await asyncio.gather(*tasks)
+    return parked_rss, latencies, failures
+
+
+def bench(name, port, connections):
+    process = subprocess.Popen(SERVERS[name](port), cwd=SERVER_DIR,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_for_port(port)
+        idle_rss = rss_kib(process.pid)
+        parked_rss, latencies, failures = asyncio.run(run_clients(port, process.pid, connections))
+    finally:
+        process.terminate()
+        process.wait()
+
+    latencies.sort()
+    p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] if latencies else float("nan")
+    per_connection = (parked_rss - idle_rss) / connections
+    print(f"{name:<9} {connections:>6} {len(failures):>6} {idle_rss / 1024:>9.1f} {parked_rss / 1024:>9.1f} "
+          f"{per_connection:>9.1f} {statistics.median(latencies) * 1000 if latencies else float('nan'):>9.1f} "
+          f"{p99 * 1000:>9.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--connections", type=int, default=1000)
+    parser.add_argument("--cards", type=int, default=200, help="cards in the benchmark deck")
+    parser.add_argument("--port", type=int, default=9990)
+    parser.add_argument("--servers", nargs="+", default=list(SERVERS), choices=list(SERVERS))
+    args = parser.parse_args()
+
+    prepare_deck(args.cards)
+
+    print(f"{'server':<9} {'conns':>6} {'failed':>6} {'idle MiB':>9} {'busy MiB':>9} "
+          f"{'KiB/conn':>9} {'p50 ms':>9} {'p99 ms':>9}")
+    for offset, name in enumerate(args.servers):
+        bench(name, args.port + offset, args.connections)
+
+
+if __name__ == "__main__":
+    main()
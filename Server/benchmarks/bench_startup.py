@@ -0,0 +1,82 @@
+"""
+Startup time of the socket server: the import time of the server module from
+`python -X importtime`, with the slowest imports, and the time from launching the server
+process until it accepts a connection. Exits with status 1 when the time to accept exceeds
+--max-ms, so it can run as a check before deploys. The server runs in a throwaway decks
+directory and Django database (see sandbox.py).
+
+Usage (from the Server directory):
+    python benchmarks/bench_startup.py [--runs 5] [--top 10] [--max-ms 1000]
+"""
+import argparse
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SERVER_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, SERVER_DIR)
+
+from sandbox import use_sandbox
+
+# The server processes started below inherit the sandbox through the environment
+use_sandbox()
+
+
+def import_times(module):
+    """Returns {module: cumulative microseconds} parsed from -X importtime"""
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                            cwd=SERVER_DIR, capture_output=True, text=True, check=True)
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        times[name.strip()] = int(cumulative)
+    return times
+
+
+def time_to_accept(port, timeout=60):
+    start = time.perf_counter()
+    process = subprocess.Popen([sys.executable, "-c", f"from server import Server; Server(port={port})"],
+                               cwd=SERVER_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        while time.perf_counter() - start < timeout:
+            try:
+                socket.create_connection(("localhost", port), timeout=1).close()
+                return time.perf_counter() - start
+            except OSError:
+                time.sleep(0.005)
+        raise RuntimeError(f"Server on port {port} did not start")
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=10, help="slowest imports to list")
+    parser.add_argument("--port", type=int, default=9995)
+    parser.add_argument("--max-ms", type=float, default=1000, help="fail above this median time to accept")
+    args = parser.parse_args()
+
+    times = import_times("server")
+    print(f"import server: {times['server'] / 1000:.1f} ms")
+    for name, cumulative in sorted(times.items(), key=lambda item: item[1], reverse=True)[1:args.top + 1]:
+        print(f"  {name:<45} {cumulative / 1000:>8.1f} ms")
+
+    accept = [time_to_accept(args.port) for _ in range(args.runs)]
+    median = statistics.median(accept) * 1000
+    print(f"time to accept: median {median:.1f} ms, max {max(accept) * 1000:.1f} ms over {args.runs} runs")
+
+    if median > args.max_ms:
+        print(f"Startup is slower than {args.max_ms:.0f} ms")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,355 @@
+"""
+End-to-end load test of the socket server. Starts the server in its own process, creates
+--users synthetic users with write access to --decks decks of --cards cards each (long tailed
+card sizes, see synthetic.make_realistic_card), then runs --clients simulated clients for
+--seconds. Every client speaks the original protocol, one connection per request with 64 byte
+headers, and draws its next request from --mix:
+
+    push   op 0, a few edited and new cards
+    delta  op 1, the cards modified since the client's last pull of the deck
+    full   op 2, the whole deck
+
+Reports the throughput, the p50/p95/p99 latency per op and the server RSS and CPU time. --save
+writes the results as a JSON baseline, --compare prints the change against a saved one and exits
+with status 1 when the throughput or a p99 latency got worse by more than --tolerance.
+
+The users and decks are created in a throwaway Django database and decks directory (see sandbox.py).
+
+Usage (from the Server directory):
+    python benchmarks/load_test.py [--clients 32] [--seconds 30] [--mix push=0.2,delta=0.7,full=0.1]
+                                   [--save baseline.json] [--compare baseline.json]
+"""
+import argparse
+import itertools
+import json
+import os
+import platform
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SERVER_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, SERVER_DIR)
+
+from sandbox import use_sandbox, setup_database
+
+# The server reads its paths from the environment when it is imported
+use_sandbox()
+
+# server puts the project root on sys.path, import it first
+import server
+from bench_servers import package, rss_kib, wait_for_port, HEADER
+from protocol import recv_exactly, BUSY
+from synthetic import make_realistic_card
+from DataManagement import serializer
+
+OPS = {"push": "0", "delta": "1", "full": "2"}
+# Share of the pushed cards that edit cards already in the deck, the rest are new
+EDIT_SHARE = 0.8
+
+# Source of last_modified values and delta pull cursors, always increasing across clients
+clock = itertools.count(2)
+
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(","):
+        name, _, weight = part.partition("=")
+        if name not in OPS:
+            raise argparse.ArgumentTypeError(f"Unknown op '{name}', expected one of {', '.join(OPS)}")
+        mix[name] = float(weight)
+    return mix
+
+
+def prepare(users, decks, cards):
+    """Create the users, decks and privileges, store the decks and return their card uids"""
+    setup_database()
+    from django.contrib.auth.models import User
+    from login.models import Deck, UserDeck
+
+    usernames = [f"load_user_{number}" for number in range(users)]
+    accounts = [User.objects.get_or_create(username=username)[0] for username in usernames]
+    store = server.open_deck_store(server.DECKS_DIR)
+    deck_uids = {}
+    for number in range(decks):
+        deck_code = f"load+test+deck+{number}"
+        deck, _ = Deck.objects.get_or_create(deck_code=deck_code, defaults={"deck_name": deck_code, "deck_desc": ""})
+        for account in accounts:
+            UserDeck.objects.update_or_create(user=account, deck=deck, defaults={"privilege": "w"})
+        rng = random.Random(number)
+        initial = [make_realistic_card(deck_code, 1, rng) for _ in range(cards)]
+        store.create(deck_code, initial)
+        deck_uids[deck_code] = [card["stable_uid"] for card in initial]
+    return usernames, deck_uids
+
+
+def open_request(port, op, username, deck_code, *fields):
+    """Send a request and wait for the privilege check, returns the socket"""
+    sock = socket.create_connection(("localhost", port))
+    sock.sendall(op.encode("utf-8") + package(username) + package(deck_code)
+                 + b"".join(package(field) for field in fields))
+    status = recv_exactly(sock, 1)
+    if status != b"1":
+        sock.close()
+        raise RuntimeError("server busy" if status == BUSY else f"op {op} on {deck_code} refused")
+    return sock
+
+
+def recv_to_end(sock):
+    chunks = []
+    while chunk := sock.recv(65536):
+        chunks.append(chunk)
+    return b"".join(chunks)
+
+
+def push(port, username, deck_code, cards):
+    with open_request(port, "0", username, deck_code, deck_code) as sock:
+        sock.sendall(serializer.dumps(cards))
+        sock.shutdown(socket.SHUT_WR)
+        if recv_exactly(sock, 1) != b"1":
+            raise RuntimeError(f"push to {deck_code} failed")
+
+
+def delta_pull(port, username, deck_code, timestamp):
+    with open_request(port, "1", username, deck_code) as sock:
+        sock.sendall(package(timestamp))
+        return serializer.loads(recv_to_end(sock))
+
+
+def full_pull(port, username, deck_code):
+    with open_request(port, "2", username, deck_code) as sock:
+        size = int(recv_exactly(sock, HEADER).decode("utf-8"))
+        recv_exactly(sock, size)
+        return serializer.loads(recv_to_end(sock))
+
+
+class Results:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {op: [] for op in OPS}
+        self.errors = {op: 0 for op in OPS}
+        self.messages = []
+
+    def record(self, op, latency):
+        with self.lock:
+            self.latencies[op].append(latency)
+
+    def fail(self, op, message):
+        with self.lock:
+            self.errors[op] += 1
+            self.messages.append(message)
+
+
+def client_loop(number, args, username, deck_uids, measure_from, deadline, results):
+    rng = random.Random(number)
+    ops, weights = zip(*args.mix.items())
+    deck_codes = list(deck_uids)
+    # Clients start in sync with the initial decks
+    synced = {deck_code: 1 for deck_code in deck_codes}
+    pushes = 0
+
+    while time.monotonic() < deadline:
+        op = rng.choices(ops, weights)[0]
+        deck_code = rng.choice(deck_codes)
+        start = time.monotonic()
+        try:
+            match op:
+                case "push":
+                    last_modified = next(clock)
+                    edits = int(args.push_cards * EDIT_SHARE)
+                    cards = [make_realistic_card(deck_code, last_modified, rng, uid)
+                             for uid in rng.sample(deck_uids[deck_code], edits)]
+                    cards += [make_realistic_card(deck_code, last_modified, rng, f"load-{number}-{pushes}-{i}")
+                              for i in range(args.push_cards - edits)]
+                    pushes += 1
+                    push(args.port, username, deck_code, cards)
+                case "delta":
+                    cursor = next(clock)
+                    delta_pull(args.port, username, deck_code, synced[deck_code])
+                    synced[deck_code] = cursor
+                case "full":
+                    full_pull(args.port, username, deck_code)
+        except Exception as e:
+            if start >= measure_from:
+                results.fail(op, f"client {number} {op} {deck_code}: {e}")
+        else:
+            if start >= measure_from:
+                results.record(op, time.monotonic() - start)
+
+        if args.think_ms:
+            time.sleep(rng.expovariate(1000 / args.think_ms))
+
+
+def cpu_seconds(pid):
+    """User plus system CPU time of the process"""
+    with open(f"/proc/{pid}/stat") as stat:
+        fields = stat.read().rsplit(")", 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+def sample_rss(pid, stop, samples):
+    while not stop.wait(0.25):
+        samples.append(rss_kib(pid))
+
+
+def start_server(port):
+    env = dict(os.environ, METRICS_PORT=os.environ.get("METRICS_PORT", "0"),
+               LOG_LEVEL=os.environ.get("LOG_LEVEL", "WARNING"))
+    code = f"from log_pipeline import setup_logging; setup_logging(); from server import Server; Server(port={port})"
+    process = subprocess.Popen([sys.executable, "-c", code], cwd=SERVER_DIR, env=env, stdout=subprocess.DEVNULL)
+    wait_for_port(port)
+    return process
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return round(values[min(len(values) - 1, int(len(values) * fraction))] * 1000, 2) if values else None
+
+
+def run(args):
+    usernames, deck_uids = prepare(args.users, args.decks, args.cards)
+    process = start_server(args.port)
+    results = Results()
+    rss_samples = []
+    stop = threading.Event()
+    try:
+        idle_rss = rss_kib(process.pid)
+        start = time.monotonic()
+        measure_from = start + args.warmup
+        deadline = measure_from + args.seconds
+        clients = [threading.Thread(target=client_loop,
+                                    args=(number, args, usernames[number % len(usernames)], deck_uids,
+                                          measure_from, deadline, results))
+                   for number in range(args.clients)]
+        for thread in clients:
+            thread.start()
+
+        time.sleep(args.warmup)
+        cpu_start = cpu_seconds(process.pid)
+        sampler = threading.Thread(target=sample_rss, args=(process.pid, stop, rss_samples))
+        sampler.start()
+        for thread in clients:
+            thread.join()
+        elapsed = time.monotonic() - measure_from
+        cpu = cpu_seconds(process.pid) - cpu_start
+        stop.set()
+        sampler.join()
+        end_rss = rss_kib(process.pid)
+    finally:
+        stop.set()
+        process.terminate()
+        process.wait()
+
+    total = sum(len(latencies) for latencies in results.latencies.values())
+    return {
+        "config": {name: value for name, value in vars(args).items() if name not in ("save", "compare", "tolerance")},
+        "environment": {
+            "python": platform.python_version(),
+            "cpus": os.cpu_count(),
+            "deck_store": os.environ.get("DECK_STORE", "log"),
+            "json_backend": serializer.backend.name,
+        },
+        "seconds": round(elapsed, 2),
+        "throughput": round(total / elapsed, 1),
+        "ops": {
+            op: {
+                "count": len(latencies),
+                "errors": results.errors[op],
+                "ops_per_s": round(len(latencies) / elapsed, 1),
+                "p50_ms": percentile(latencies, 0.5),
+                "p95_ms": percentile(latencies, 0.95),
+                "p99_ms": percentile(latencies, 0.99),
+                "max_ms": percentile(latencies, 1),
+            }
+            for op, latencies in results.latencies.items() if op in args.mix
+        },
+        "server": {
+            "rss_idle_mib": round(idle_rss / 1024, 1),
+            "rss_peak_mib": round(max(rss_samples + [end_rss]) / 1024, 1),
+            "rss_end_mib": round(end_rss / 1024, 1),
+            "cpu_seconds": round(cpu, 2),
+            "cpu_ms_per_op": round(cpu / total * 1000, 3) if total else None,
+        },
+        "error_samples": results.messages[:10],
+    }
+
+
+def report(result):
+    print(f"{result['throughput']:.1f} ops/s over {result['seconds']} s")
+    print(f"{'op':<6} {'ops':>7} {'errors':>6} {'ops/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+    for op, stats in result["ops"].items():
+        print(f"{op:<6} {stats['count']:>7} {stats['errors']:>6} {stats['ops_per_s']:>8} "
+              + " ".join(f"{stats[key] if stats[key] is not None else '-':>8}"
+                         for key in ("p50_ms", "p95_ms", "p99_ms", "max_ms")))
+    print("server: " + ", ".join(f"{name} {value}" for name, value in result["server"].items()))
+    for message in result["error_samples"]:
+        print(f"error: {message}")
+
+
+def compare(baseline, result, tolerance):
+    """Print the change of every metric against the baseline, returns the regressions"""
+    # (name, baseline value, current value, True when higher is better)
+    metrics = [("throughput", baseline["throughput"], result["throughput"], True)]
+    for op, stats in result["ops"].items():
+        before = baseline["ops"].get(op)
+        if before is None:
+            continue
+        metrics.append((f"{op} ops/s", before["ops_per_s"], stats["ops_per_s"], True))
+        for key in ("p50_ms", "p95_ms", "p99_ms"):
+            metrics.append((f"{op} {key}", before[key], stats[key], False))
+    for key in ("rss_peak_mib", "cpu_ms_per_op"):
+        metrics.append((key, baseline["server"][key], result["server"][key], False))
+
+    regressions = []
+    print(f"{'metric':<16} {'baseline':>10} {'current':>10} {'change':>8}")
+    for name, before, after, higher_is_better in metrics:
+        if not before or after is None:
+            continue
+        change = (after - before) / before
+        worse = -change if higher_is_better else change
+        flag = ""
+        if worse > tolerance and (name == "throughput" or name.endswith("p99_ms")):
+            regressions.append(name)
+            flag = "  regression"
+        print(f"{name:<16} {before:>10} {after:>10} {change:>+8.1%}{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--clients", type=int, default=32, help="concurrent simulated clients")
+    parser.add_argument("--users", type=int, default=8)
+    parser.add_argument("--decks", type=int, default=8)
+    parser.add_argument("--cards", type=int, default=2000, help="initial cards per deck")
+    parser.add_argument("--push-cards", type=int, default=10, help="cards per push")
+    parser.add_argument("--mix", type=parse_mix, default="push=0.2,delta=0.7,full=0.1",
+                        help="relative weights of the ops")
+    parser.add_argument("--think-ms", type=float, default=0, help="mean pause between the requests of a client")
+    parser.add_argument("--seconds", type=float, default=30, help="length of the measurement")
+    parser.add_argument("--warmup", type=float, default=3, help="seconds of load before measuring")
+    parser.add_argument("--port", type=int, default=9970)
+    parser.add_argument("--save", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="JSON baseline to compare the results with")
+    parser.add_argument("--tolerance", type=float, default=0.1,
+                        help="relative throughput or p99 change counted as a regression")
+    args = parser.parse_args()
+
+    result = run(args)
+    report(result)
+    if args.save:
+        with open(args.save, "w") as output:
+            json.dump(result, output, indent=2)
+    if args.compare:
+        with open(args.compare) as baseline:
+            regressions = compare(json.load(baseline), result, args.tolerance)
+        if regressions:
+            print(f"Regressions: {', '.join(regressions)}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,39 @@
+"""
+Throwaway decks directory and Django database for the benchmarks, so they never write to
+Server/Decks or WebServer/db.sqlite3. use_sandbox() has to run before server is imported:
+it points the server at a temporary directory through the environment, which the server
+processes started by a benchmark inherit.
+"""
+import atexit
+import os
+import shutil
+import tempfile
+
+
+def use_sandbox():
+    """Create the sandbox, or reuse the one of the benchmark that started this process"""
+    directory = os.environ.get("BENCH_SANDBOX")
+    if directory:
+        return directory
+
+    directory = tempfile.mkdtemp(prefix="conjoined-bench-")
+    atexit.register(shutil.rmtree, directory, ignore_errors=True)
+    os.environ.update(
+        BENCH_SANDBOX=directory,
+        DECKS_DIR=os.path.join(directory, "Decks"),
+        DJANGO_DB_PATH=os.path.join(directory, "db.sqlite3"),
+        AUTH_DB_PATH=os.path.join(directory, "db.sqlite3"),
+        PRIVILEGE_GENERATION_PATH=os.path.join(directory, "privilege_generation"),
+        SNAPSHOT_DIR=os.path.join(directory, "Snapshots"),
+        PROFILE_DIR=os.path.join(directory, "profiles"),
+    )
+    return directory
+
+
+def setup_database():
+    """Load Django and create the tables of the sandbox database on first use"""
+    import server
+    server.setup_django()
+    if not os.path.exists(os.environ["DJANGO_DB_PATH"]):
+        from django.core.management import call_command
+        call_command("migrate", verbosity=0)
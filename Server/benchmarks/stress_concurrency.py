@@ -0,0 +1,214 @@
+"""
+Stress test of concurrent pushes and pulls against a Server running in this process: client
+threads on persistent v2 connections, spread across a few decks, each one pushing or pulling
+at random. Every push adds cards with new stable_uids and bumps one of the cards shared by all
+the threads of the deck. At the end every added card must be in its deck, every shared card
+must carry the newest last_modified that was pushed for it, and pull cursors must never have
+moved back. Prints the throughput and latencies, and exits with status 1 when an update was
+lost.
+
+A stress user and its decks are created in a throwaway Django database and
+decks directory (see sandbox.py).
+
+Usage (from the Server directory):
+    python benchmarks/stress_concurrency.py [--threads 64] [--decks 8] [--seconds 10]
+"""
+import argparse
+import contextlib
+import itertools
+import json
+import os
+import random
+import socket
+import sys
+import threading
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SERVER_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, SERVER_DIR)
+
+from sandbox import use_sandbox, setup_database
+
+# The server reads its paths from the environment when it is imported
+use_sandbox()
+
+import server
+from protocol import MAGIC, REQUEST, STATUS, META, BYE, recv_exactly, send_frame, send_json_frame, \
+    expect_frame, send_message, recv_message
+from synthetic import make_card, make_deck
+
+USERNAME = "stress_user"
+SHARED_CARDS = 10
+CARDS_PER_PUSH = 5
+
+# Source of last_modified values, always increasing across threads
+clock = itertools.count(1)
+
+
+def prepare_decks(decks, cards):
+    setup_database()
+    from django.contrib.auth.models import User
+    from login.models import Deck, UserDeck
+
+    user, _ = User.objects.get_or_create(username=USERNAME)
+    store = server.open_deck_store(server.DECKS_DIR)
+    deck_codes = []
+    for number in range(decks):
+        deck_code = f"stress+concurrency+deck+{number}"
+        deck, _ = Deck.objects.get_or_create(deck_code=deck_code, defaults={"deck_name": deck_code, "deck_desc": ""})
+        UserDeck.objects.update_or_create(user=user, deck=deck, defaults={"privilege": "w"})
+        initial = make_deck(cards, deck_code, last_modified=0)
+        for i in range(SHARED_CARDS):
+            initial.append(make_card(deck_code, 0, random.Random(i), f"shared-{i}"))
+        store.create(deck_code, initial)
+        deck_codes.append(deck_code)
+    return deck_codes
+
+
+class Client:
+    def __init__(self, port):
+        self.sock = socket.create_connection(("localhost", port))
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock.sendall(MAGIC + bytes([2]))
+        recv_exactly(self.sock, 2)
+
+    def request(self, **request):
+        send_json_frame(self.sock, REQUEST, {"username": USERNAME, **request})
+        return expect_frame(self.sock, STATUS) == b"1"
+
+    def push(self, deck_code, cards):
+        if not self.request(op="0", deck_code=deck_code, deck_name=deck_code):
+            return False
+        send_message(self.sock, json.dumps(cards).encode("utf-8"))
+        return expect_frame(self.sock, STATUS) == b"1"
+
+    def pull(self, deck_code, since_seq):
+        if not self.request(op="3", deck_code=deck_code, since_seq=since_seq):
+            raise RuntimeError("pull refused")
+        high_seq = json.loads(expect_frame(self.sock, META))["high_seq"]
+        return high_seq, json.loads(recv_message(self.sock))
+
+    def close(self):
+        send_frame(self.sock, BYE)
+        self.sock.close()
+
+
+class Results:
+    def __init__(self, deck_codes):
+        self.lock = threading.Lock()
+        self.added = {deck_code: set() for deck_code in deck_codes}
+        self.newest = {deck_code: {} for deck_code in deck_codes}
+        self.latencies = {"push": [], "pull": []}
+        self.errors = []
+
+    def record_push(self, deck_code, cards, latency):
+        with self.lock:
+            self.latencies["push"].append(latency)
+            for card in cards:
+                uid = card["stable_uid"]
+                if uid.startswith("shared-"):
+                    newest = self.newest[deck_code]
+                    newest[uid] = max(newest.get(uid, 0), card["last_modified"])
+                else:
+                    self.added[deck_code].add(uid)
+
+
+def client_loop(number, port, deck_codes, initial_seq, deadline, results):
+    rng = random.Random(number)
+    client = Client(port)
+    # Clients start in sync with the initial decks, pulls only fetch what the others pushed
+    cursors = {deck_code: initial_seq for deck_code in deck_codes}
+    pushes = 0
+    try:
+        while time.monotonic() < deadline:
+            deck_code = rng.choice(deck_codes)
+            start = time.perf_counter()
+
+            if rng.random() < 0.5:
+                last_modified = next(clock)
+                cards = [make_card(deck_code, last_modified, rng, f"t{number}-{pushes}-{i}")
+                         for i in range(CARDS_PER_PUSH)]
+                cards.append(make_card(deck_code, last_modified, rng, f"shared-{rng.randrange(SHARED_CARDS)}"))
+                pushes += 1
+                if not client.push(deck_code, cards):
+                    results.errors.append(f"push to {deck_code} failed")
+                    continue
+                results.record_push(deck_code, cards, time.perf_counter() - start)
+            else:
+                high_seq, cards = client.pull(deck_code, cursors[deck_code])
+                if high_seq < cursors[deck_code]:
+                    results.errors.append(f"cursor of {deck_code} went back from {cursors[deck_code]} to {high_seq}")
+                cursors[deck_code] = high_seq
+                with results.lock:
+                    results.latencies["pull"].append(time.perf_counter() - start)
+    except Exception as e:
+        results.errors.append(f"client {number}: {e}")
+    finally:
+        client.close()
+
+
+def verify(port, deck_codes, results):
+    client = Client(port)
+    lost = 0
+    for deck_code in deck_codes:
+        _, cards = client.pull(deck_code, 0)
+        missing = results.added[deck_code] - cards.keys()
+        stale = [uid for uid, last_modified in results.newest[deck_code].items()
+                 if cards.get(uid, {}).get("last_modified") != last_modified]
+        lost += len(missing) + len(stale)
+        if missing or stale:
+            print(f"{deck_code}: {len(missing)} added cards missing, {len(stale)} shared cards stale")
+    client.close()
+    return lost
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))] * 1000 if values else float("nan")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--threads", type=int, default=64)
+    parser.add_argument("--decks", type=int, default=8)
+    parser.add_argument("--cards", type=int, default=1000, help="initial cards per deck")
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--port", type=int, default=9993)
+    args = parser.parse_args()
+
+    deck_codes = prepare_decks(args.decks, args.cards)
+    results = Results(deck_codes)
+
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        threading.Thread(target=server.Server, kwargs={"port": args.port}, daemon=True).start()
+        time.sleep(0.5)
+
+        start = time.monotonic()
+        deadline = start + args.seconds
+        clients = [threading.Thread(target=client_loop, args=(number, args.port, deck_codes, args.cards + SHARED_CARDS,
+                                                          deadline, results))
+                   for number in range(args.threads)]
+        for thread in clients:
+            thread.start()
+        for thread in clients:
+            thread.join()
+        elapsed = time.monotonic() - start
+
+        lost = verify(args.port, deck_codes, results)
+
+    for op, latencies in results.latencies.items():
+        print(f"{op:<5} {len(latencies):>7} ops {len(latencies) / elapsed:>9.1f} ops/s "
+              f"p50 {percentile(latencies, 0.5):>8.1f} ms  p99 {percentile(latencies, 0.99):>8.1f} ms")
+    print(f"group commit: {server.group_commits.stats()}")
+    print(f"syncs: {server.sync_latency.stats()}")
+    for error in results.errors[:10]:
+        print(f"error: {error}")
+    print(f"{lost} lost updates, {len(results.errors)} errors")
+
+    if lost or results.errors:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+"""Synthetic decks shaped like the cards the add-on sends (see get_cards_from_deck)."""
+import random
+import uuid
+
+WORDS = ["garden", "forest", "mountain", "river", "ocean", "desert", "valley", "creek",
+         "spring", "autumn", "winter", "summer", "morning", "evening", "night", "dawn"]
+
+
+def make_card(deck_name, last_modified, rng=random, stable_uid=None, back_words=None):
+    front = " ".join(rng.choice(WORDS) for _ in range(rng.randint(1, 4)))
+    back = " ".join(rng.choice(WORDS) for _ in range(back_words or rng.randint(8, 40)))
+    note_id = rng.randint(1_500_000_000_000, 1_700_000_000_000)
+    return {
+        "note_id": note_id,
+        "stable_uid": stable_uid or str(uuid.UUID(int=rng.getrandbits(128))),
+        "deck_name": deck_name,
+        "model_name": "Basic",
+        "fields": {
+            "Front": f"<div><b>{front}</b></div>",
+            "Back": f"<div>{back}</div><br><span style=\"color: #666;\">{rng.choice(WORDS)}</span>",
+        },
+        "tags": "sync_uid:placeholder vocabulary",
+        "created_at": note_id,
+        "last_modified": last_modified,
+        "interval": 1,
+    }
+
+
+def make_deck(size, deck_name="Benchmark", last_modified=1_700_000_000, seed=0):
+    rng = random.Random(seed)
+    return [make_card(deck_name, last_modified, rng) for _ in range(size)]
+
+
+def realistic_back_words(rng=random):
+    """
+    Length of the back field in words, long tailed like real decks: most cards hold a short
+    definition (median around 25 words), a few carry whole paragraphs of notes.
+    """
+    return max(1, min(2000, int(rng.lognormvariate(3.2, 0.9))))
+
+
+def make_realistic_card(deck_name, last_modified, rng=random, stable_uid=None):
+    return make_card(deck_name, last_modified, rng, stable_uid, realistic_back_words(rng))
+
+
+def touch_cards(cards, ratio, last_modified, seed=1):
+    """Return copies of a share of the cards with a newer last_modified"""
+    rng = random.Random(seed)
+    count = max(1, int(len(cards) * ratio))
+    changed = []
+    for card in rng.sample(cards, count):
+        card = dict(card)
+        card["last_modified"] = last_modified
+        changed.append(card)
+    return changed
@@ -0,0 +1,134 @@
+"""
+Wire compression codecs, negotiated once per connection by protocol v3 clients.
+
+Every card payload goes through its own compressor as a stream: the chunks are compressed
+as they are produced and the output is sent as DATA frames, and the receiving side feeds the
+DATA frames to a decompressor, so compression composes with chunked transfer on both ends.
+zlib is always available, zstd only when the zstandard package is installed.
+"""
+import os
+import time
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+CHUNK_SIZE = 64 * 1024
+
+
+class ZlibCodec:
+    name = "zlib"
+
+    def __init__(self, level=6):
+        self.level = level
+
+    def compressor(self):
+        return zlib.compressobj(self.level)
+
+    def decompress(self, chunks):
+        decompressor = zlib.decompressobj()
+        for chunk in chunks:
+            data = chunk
+            # Bounded output per call, a small frame can expand to a lot of JSON
+            while data:
+                yield decompressor.decompress(data, CHUNK_SIZE)
+                data = decompressor.unconsumed_tail
+        yield decompressor.flush()
+        if not decompressor.eof:
+            raise ValueError("Compressed payload ended before the end of the zlib stream")
+
+
+class ZstdCodec:
+    name = "zstd"
+
+    def __init__(self, level=3):
+        self.level = level
+
+    def compressor(self):
+        return zstandard.ZstdCompressor(level=self.level).compressobj()
+
+    def decompress(self, chunks):
+        decompressor = zstandard.ZstdDecompressor().decompressobj()
+        for chunk in chunks:
+            yield decompressor.decompress(chunk)
+
+
+def available_codecs():
+    """Codecs this side can speak, in order of preference"""
+    codecs = {}
+    if zstandard is not None:
+        codecs["zstd"] = ZstdCodec(int(os.environ.get("ZSTD_LEVEL", 3)))
+    codecs["zlib"] = ZlibCodec(int(os.environ.get("ZLIB_LEVEL", 6)))
+    return codecs
+
+
+def choose_codec(offered, allowed=None):
+    """First codec offered by the client that is available here and allowed, None to send plain JSON"""
+    codecs = available_codecs()
+    if allowed is None:
+        allowed = os.environ.get("WIRE_CODECS", ",".join(codecs)).split(",")
+    for name in offered:
+        if name in codecs and name in allowed:
+            return codecs[name]
+    return None
+
+
+class CompressionStats:
+    """Bytes before and after compression and the CPU time spent on one request"""
+
+    def __init__(self, codec):
+        self.codec = codec
+        self.raw_bytes = 0
+        self.wire_bytes = 0
+        self.cpu_time = 0.0
+        # Part of cpu_time already counted in the metrics, a cached response is sent many times
+        self.reported_cpu_time = 0.0
+
+    @property
+    def ratio(self):
+        return self.raw_bytes / self.wire_bytes if self.wire_bytes else 0.0
+
+    def __str__(self):
+        return (f"{self.codec.name} {self.raw_bytes} -> {self.wire_bytes} bytes "
+                f"({self.ratio:.1f}x), {self.cpu_time * 1000:.1f} ms CPU")
+
+
+def compress_stream(chunks, codec, stats):
+    """Compress the chunks as they come, yielding the non-empty compressed pieces"""
+    compressor = codec.compressor()
+    for chunk in chunks:
+        stats.raw_bytes += len(chunk)
+        start = time.thread_time()
+        data = compressor.compress(chunk)
+        stats.cpu_time += time.thread_time() - start
+        if data:
+            stats.wire_bytes += len(data)
+            yield data
+
+    start = time.thread_time()
+    data = compressor.flush()
+    stats.cpu_time += time.thread_time() - start
+    stats.wire_bytes += len(data)
+    yield data
+
+
+def decompress_stream(chunks, codec, stats):
+    """Decompress the chunks as they come, yielding the non-empty decompressed pieces"""
+
+    def counted(chunks):
+        for chunk in chunks:
+            stats.wire_bytes += len(chunk)
+            yield chunk
+
+    decompressed = codec.decompress(counted(chunks))
+    while True:
+        start = time.thread_time()
+        data = next(decompressed, None)
+        stats.cpu_time += time.thread_time() - start
+        if data is None:
+            return
+        if data:
+            stats.raw_bytes += len(data)
+            yield data
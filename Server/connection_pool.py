@@ -0,0 +1,200 @@
+import logging
+import select
+import selectors
+import socket
+import threading
+import time
+from collections import deque
+
+logger = logging.getLogger("connection_pool")
+
+
+def readable(sock):
+    """True when the client sent something that wasn't read yet, or hung up"""
+    poller = select.poll()
+    poller.register(sock, select.POLLIN)
+    return bool(poller.poll(0))
+
+
+class ConnectionPool:
+    """
+    Fixed set of worker threads serving accepted connections from a bounded queue. When the
+    queue is full, or a connection waited in it longer than max_wait seconds (its client has
+    most likely given up), the connection is handed to reject(conn, reason) instead, so a burst
+    of clients can't pile up threads. Kept-alive connections are parked between requests, see
+    IdleConnections, and come back through the same queue once their client sends again.
+    """
+
+    def __init__(self, workers=64, queue_size=256, max_wait=None, idle_timeout=None):
+        self.workers = workers
+        self.queue_size = queue_size
+        self.max_wait = max_wait
+        self.idle_timeout = idle_timeout
+        # Workers serving a connection
+        self.busy = 0
+
+        self._lock = threading.Lock()
+        self._available = threading.Condition()
+        self._pending = deque()
+        self._idle = None
+        self._handle = None
+        self._reject = None
+
+    @property
+    def pending(self):
+        """Connections waiting for a worker"""
+        return len(self._pending)
+
+    @property
+    def parked(self):
+        """Kept-alive connections waiting for their next request"""
+        return len(self._idle) if self._idle is not None else 0
+
+    def start(self, handle, reject, close_idle):
+        """
+        Start the workers, handle(conn, waited) serves a connection that waited `waited` seconds.
+        close_idle(conn) closes a parked connection whose client stayed idle for idle_timeout.
+        """
+        self._handle = handle
+        self._reject = reject
+        self._idle = IdleConnections(self.idle_timeout, self.submit, close_idle)
+        for number in range(self.workers):
+            threading.Thread(target=self._work, name=f"connection-worker-{number}", daemon=True).start()
+
+    def submit(self, conn):
+        """Queue the connection for a worker, returns False when it was rejected"""
+        with self._available:
+            if len(self._pending) < self.queue_size:
+                self._pending.append((conn, time.monotonic()))
+                self._available.notify()
+                return True
+        self._reject(conn, "queue_full")
+        return False
+
+    def park(self, conn):
+        """Hand a kept-alive connection back until its client sends its next request"""
+        self._idle.add(conn)
+
+    def shed(self):
+        """Reject the queued connections that waited longer than max_wait, even while every worker is busy"""
+        if self.max_wait is None:
+            return
+        expired = []
+        with self._available:
+            oldest = time.monotonic() - self.max_wait
+            while self._pending and self._pending[0][1] < oldest:
+                expired.append(self._pending.popleft()[0])
+        for conn in expired:
+            self._reject(conn, "queue_timeout")
+
+    def _work(self):
+        while True:
+            with self._available:
+                while not self._pending:
+                    self._available.wait()
+                conn, queued_at = self._pending.popleft()
+            waited = time.monotonic() - queued_at
+            if self.max_wait is not None and waited > self.max_wait:
+                self._reject(conn, "queue_timeout")
+                continue
+
+            with self._lock:
+                self.busy += 1
+            try:
+                self._handle(conn, waited)
+            except Exception:
+                logger.exception("Worker failed to serve a connection")
+            finally:
+                with self._lock:
+                    self.busy -= 1
+
+
+class IdleConnections:
+    """
+    Kept-alive connections waiting for their client's next request, watched by one selector
+    thread instead of holding a worker each. A connection goes to on_ready(conn) as soon as
+    its client sends something or hangs up, and to on_idle(conn) after timeout seconds
+    without either, None keeps it as long as the client does. Connections only need fileno().
+    """
+
+    def __init__(self, timeout, on_ready, on_idle):
+        self.timeout = timeout
+        self.on_ready = on_ready
+        self.on_idle = on_idle
+
+        self._lock = threading.Lock()
+        self._added = []
+        # conn: deadline, every connection gets the same timeout so the oldest comes first
+        self._deadlines = {}
+        self._selector = selectors.DefaultSelector()
+        self._wakeup, self._waker = socket.socketpair()
+        self._wakeup.setblocking(False)
+        self._waker.setblocking(False)
+        self._selector.register(self._wakeup, selectors.EVENT_READ)
+
+        threading.Thread(target=self._run, name="idle-connections", daemon=True).start()
+
+    def __len__(self):
+        return len(self._deadlines) + len(self._added)
+
+    def add(self, conn):
+        deadline = time.monotonic() + self.timeout if self.timeout is not None else None
+        with self._lock:
+            self._added.append((conn, deadline))
+        try:
+            self._waker.send(b"\0")
+        except BlockingIOError:
+            # The selector thread already has a wakeup to read
+            pass
+
+    def _run(self):
+        while True:
+            events = self._selector.select(self._expire())
+            for key, _ in events:
+                if key.fileobj is self._wakeup:
+                    self._drain_wakeup()
+                    continue
+                self._remove(key.fileobj)
+                self._call(self.on_ready, key.fileobj)
+
+            with self._lock:
+                added, self._added = self._added, []
+            for conn, deadline in added:
+                try:
+                    self._selector.register(conn, selectors.EVENT_READ)
+                except (ValueError, OSError):
+                    # Closed while it was being parked
+                    self._call(self.on_idle, conn)
+                    continue
+                self._deadlines[conn] = deadline
+
+    def _expire(self):
+        """Close the connections past their deadline, returns the seconds until the next one"""
+        now = time.monotonic()
+        while self._deadlines:
+            conn, deadline = next(iter(self._deadlines.items()))
+            if deadline is None:
+                return None
+            if deadline > now:
+                return deadline - now
+            self._remove(conn)
+            self._call(self.on_idle, conn)
+        return None
+
+    def _remove(self, conn):
+        del self._deadlines[conn]
+        self._selector.unregister(conn)
+
+    def _drain_wakeup(self):
+        try:
+            while self._wakeup.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+
+    @staticmethod
+    def _call(callback, conn):
+        try:
+            callback(conn)
+        except Exception:
+            logger.exception("Failed to hand over a parked connection")
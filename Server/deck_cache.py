@@ -0,0 +1,236 @@
+import json
+import threading
+from bisect import bisect_left, bisect_right, insort
+from collections import OrderedDict
+
+# Number of cards serialized to estimate the size of a cached deck
+SIZE_SAMPLE = 64
+
+
+def estimate_size(cards):
+    """Approximate the memory used by a deck from the JSON size of a sample of its cards"""
+    if not cards:
+        return 0
+
+    step = max(1, len(cards) // SIZE_SAMPLE)
+    sample = [card for i, card in enumerate(cards.values()) if i % step == 0][:SIZE_SAMPLE]
+    sample_bytes = sum(len(json.dumps(card)) for card in sample)
+    return sample_bytes * len(cards) // len(sample)
+
+
+class SeqIndex:
+    """
+    Stable uids of a deck ordered by sequence number, so a pull only touches the cards written
+    after its cursor. The seqs/uids lists are append-only and shared with the index of the next
+    version of the deck, each version only looks at its first `count` entries.
+    """
+
+    def __init__(self, seqs, uids):
+        self.seqs = seqs
+        self.uids = uids
+        self.count = len(seqs)
+
+    @classmethod
+    def build(cls, cards):
+        ordered = sorted((card.get("seq", 0), uid) for uid, card in cards.items())
+        return cls([seq for seq, _ in ordered], [uid for _, uid in ordered])
+
+    def bucket(self, since_seq):
+        """Position of a cursor in the index, cursors at the same position get the same cards"""
+        if since_seq <= 0:
+            return -1
+        return bisect_right(self.seqs, since_seq, 0, self.count)
+
+    @property
+    def high_seq(self):
+        return self.seqs[self.count - 1] if self.count else 0
+
+    def extend(self, cards, accepted):
+        """Index of the deck version that includes the accepted cards"""
+        # Rebuild when another version already appended to the shared lists, or when
+        # overwritten cards left more stale entries than live ones
+        if self.count != len(self.seqs) or self.count + len(accepted) > 2 * len(cards):
+            return SeqIndex.build(cards)
+
+        for uid, card in sorted(accepted.items(), key=lambda item: item[1].get("seq", 0)):
+            self.seqs.append(card.get("seq", 0))
+            self.uids.append(uid)
+        return SeqIndex(self.seqs, self.uids)
+
+    def since(self, cards, since_seq):
+        """Cards written after since_seq, every card of the deck for a cursor of 0"""
+        if since_seq <= 0:
+            return dict(cards)
+
+        changed = {}
+        start = bisect_right(self.seqs, since_seq, 0, self.count)
+        for position in range(start, self.count):
+            uid = self.uids[position]
+            card = cards.get(uid)
+            # Older entries of a card that was written again are skipped
+            if card is not None and card.get("seq", 0) == self.seqs[position]:
+                changed[uid] = card
+        return changed
+
+
+class CachedDeck:
+    """Parsed cards of one version of a deck, never mutated once built"""
+
+    def __init__(self, version, cards, seq_index=None, modified_times=None):
+        self.version = version
+        self.cards = cards
+        self.bytes = estimate_size(cards)
+        self._seq_index = seq_index
+        # Sorted last_modified of the cards, built by the first timestamp pull
+        self._modified_times = modified_times
+
+    @property
+    def seq_index(self):
+        if self._seq_index is None:
+            self._seq_index = SeqIndex.build(self.cards)
+        return self._seq_index
+
+    def modified_since(self, timestamp):
+        """Cards modified after the timestamp"""
+        return {uid: card for uid, card in self.cards.items() if card["last_modified"] > timestamp}
+
+    def timestamp_bucket(self, timestamp):
+        """Number of cards modified at or before the timestamp, timestamps in the same bucket get the same cards"""
+        if self._modified_times is None:
+            self._modified_times = sorted(card["last_modified"] for card in self.cards.values())
+        return bisect_right(self._modified_times, timestamp)
+
+    def next_modified_times(self, accepted):
+        """Sorted modification times once the accepted cards are written, None while they aren't built"""
+        if self._modified_times is None:
+            return None
+
+        times = list(self._modified_times)
+        for uid, card in accepted.items():
+            previous = self.cards.get(uid)
+            if previous is not None:
+                del times[bisect_left(times, previous["last_modified"])]
+            insort(times, card["last_modified"])
+        return times
+
+    def changes_since(self, since_seq):
+        """Returns (cards written after since_seq, high-water sequence number)"""
+        index = self.seq_index
+        return index.since(self.cards, since_seq), index.high_seq
+
+
+class DeckCache:
+    """
+    Process-wide cache of parsed decks, bounded by the estimated size of the cached cards.
+    Entries are tagged with the store version of the deck, a version mismatch on lookup
+    drops the entry. Cached decks are never mutated, writes replace them with an updated copy
+    so readers can keep iterating over the one they got.
+    """
+
+    def __init__(self, max_bytes=256 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get(self, deck_code, version):
+        """Return the CachedDeck of a deck if it is still at the given version"""
+        with self._lock:
+            entry = self._entries.get(deck_code)
+            if entry is not None and entry.version != version:
+                self._drop(deck_code)
+                self.invalidations += 1
+                entry = None
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(deck_code)
+            self.hits += 1
+            return entry
+
+    def peek_bytes(self, deck_code):
+        """Estimated size of the cached copy of a deck, None when it isn't cached"""
+        entry = self._entries.get(deck_code)
+        return entry.bytes if entry is not None else None
+
+    def put(self, deck_code, version, cards):
+        deck = CachedDeck(version, cards)
+        with self._lock:
+            self._drop(deck_code)
+            self._store(deck_code, deck)
+        return deck
+
+    def apply(self, deck_code, base_version, version, accepted):
+        """
+        Update the cached copy of a deck with the cards accepted by a push that moved the deck
+        from base_version to version. A cached copy of any other version may be missing
+        earlier writes (a reader can cache what it loaded before them), so it is dropped.
+        The updated copy is built outside the lock, pushes to a deck are already serialized
+        by its writer lock.
+        """
+        with self._lock:
+            entry = self._entries.get(deck_code)
+            if entry is None:
+                return
+            if entry.version != base_version:
+                self._drop(deck_code)
+                self.invalidations += 1
+                return
+
+        cards = dict(entry.cards)
+        cards.update(accepted)
+        deck = CachedDeck(version, cards, entry.seq_index.extend(cards, accepted),
+                          entry.next_modified_times(accepted))
+
+        with self._lock:
+            current = self._entries.get(deck_code)
+            if current is not entry:
+                # A reader cached the deck meanwhile, keep its copy only if it has the push
+                if current is not None and current.version != version:
+                    self._drop(deck_code)
+                    self.invalidations += 1
+                return
+            self._drop(deck_code)
+            self._store(deck_code, deck)
+
+    def invalidate(self, deck_code):
+        with self._lock:
+            if self._drop(deck_code):
+                self.invalidations += 1
+
+    def _store(self, deck_code, deck):
+        if deck.bytes > self.max_bytes:
+            return
+
+        self._entries[deck_code] = deck
+        self.total_bytes += deck.bytes
+
+        while self.total_bytes > self.max_bytes:
+            evicted_code = next(iter(self._entries))
+            self._drop(evicted_code)
+            self.evictions += 1
+
+    def _drop(self, deck_code):
+        entry = self._entries.pop(deck_code, None)
+        if entry is None:
+            return False
+        self.total_bytes -= entry.bytes
+        return True
+
+    def stats(self):
+        with self._lock:
+            return {
+                "decks": len(self._entries),
+                "bytes": self.total_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+            }
@@ -0,0 +1,731 @@
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+from DataManagement import serializer
+
+logger = logging.getLogger("deck_store")
+
+# Replays of a deck without its lock, before falling back to taking it
+LOAD_ATTEMPTS = 3
+
+
+class LatencySamples:
+    """
+    Count and percentiles over the most recent latencies, in seconds. on_record(seconds) is
+    called with every latency, to feed the server metrics.
+    """
+
+    def __init__(self, keep=1024, on_record=None):
+        self.on_record = on_record
+        self.count = 0
+        self.max = 0.0
+        self._lock = threading.Lock()
+        self._recent = deque(maxlen=keep)
+
+    def record(self, seconds):
+        with self._lock:
+            self.count += 1
+            self.max = max(self.max, seconds)
+            self._recent.append(seconds)
+        if self.on_record is not None:
+            self.on_record(seconds)
+
+    def percentile(self, fraction):
+        with self._lock:
+            recent = sorted(self._recent)
+        return recent[min(len(recent) - 1, int(len(recent) * fraction))] if recent else 0.0
+
+    def stats(self):
+        return {
+            "count": self.count,
+            "p50_ms": round(self.percentile(0.5) * 1000, 2),
+            "p99_ms": round(self.percentile(0.99) * 1000, 2),
+            "max_ms": round(self.max * 1000, 2),
+        }
+
+
+# Latency of every point where a write is made durable: fsyncs and SQLite commits
+sync_latency = LatencySamples()
+
+
+def fsync_file(outfile):
+    outfile.flush()
+    start = time.perf_counter()
+    os.fsync(outfile.fileno())
+    sync_latency.record(time.perf_counter() - start)
+
+
+def fsync_dir(path):
+    """Persist the directory entry of a file that was just created or renamed"""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class DeckLocks:
+    """One lock per deck code, created on first use"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._locks = {}
+
+    def __call__(self, deck_code):
+        with self._lock:
+            if deck_code not in self._locks:
+                self._locks[deck_code] = threading.Lock()
+            return self._locks[deck_code]
+
+
+class JsonDeckStore:
+    """
+    Stores every deck as a single Decks/<code>.json file that is rewritten on each push.
+    """
+
+    # True when retrieve() answers a delta pull without loading the whole deck
+    indexed_retrieve = False
+
+    def __init__(self, decks_dir):
+        self.decks_dir = decks_dir
+        os.makedirs(self.decks_dir, exist_ok=True)
+
+    def snapshot_path(self, deck_code):
+        return os.path.join(self.decks_dir, deck_code + ".json")
+
+    def exists(self, deck_code):
+        return os.path.exists(self.snapshot_path(deck_code))
+
+    def version(self, deck_code):
+        """Cheap token that changes whenever the deck is written, None if the deck doesn't exist"""
+        try:
+            stat = os.stat(self.snapshot_path(deck_code))
+        except FileNotFoundError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def read_snapshot(self, deck_code):
+        """Read the snapshot file of a deck as a dict keyed by stable_uid"""
+        path = self.snapshot_path(deck_code)
+        all_cards = {}
+
+        try:
+            with open(path, "rb") as infile:
+                existing_data = serializer.load(infile)
+
+            if isinstance(existing_data, list):
+                for card in existing_data:
+                    if "stable_uid" in card:
+                        all_cards[str(card["stable_uid"])] = card
+
+            elif isinstance(existing_data, dict):
+                all_cards = existing_data
+
+        except FileNotFoundError:
+            pass
+        except serializer.DecodeError:
+            logger.error("Error reading %s, will create a new file", path)
+
+        return all_cards
+
+    def write_snapshot(self, deck_code, all_cards):
+        # Written aside, synced and renamed: readers and a crash leave either the old or the new deck
+        path = self.snapshot_path(deck_code)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as outfile:
+            serializer.dump(all_cards, outfile)
+            fsync_file(outfile)
+        os.replace(tmp_path, path)
+        fsync_dir(self.decks_dir)
+
+    def load(self, deck_code):
+        return self.read_snapshot(deck_code)
+
+    def iter_cards(self, deck_code):
+        """Iterate the (stable_uid, card) pairs of a deck"""
+        return iter(self.load(deck_code).items())
+
+    def create(self, deck_code, cards):
+        all_cards = {str(card["stable_uid"]): card for card in cards}
+        assign_seqs(all_cards.values(), 0)
+        self.write_snapshot(deck_code, all_cards)
+        return len(all_cards)
+
+    def merge(self, deck_code, cards):
+        """Merge the pushed cards into the deck, returns (accepted cards by uid, new_count, updated_count)"""
+        all_cards = self.load(deck_code)
+        logger.debug("Loaded %s existing cards from %s", len(all_cards), self.snapshot_path(deck_code))
+
+        accepted, new_count, updated_count = select_accepted_cards(
+            cards, lambda uid: all_cards[uid].get("last_modified", 0) if uid in all_cards else None
+        )
+        assign_seqs(accepted.values(), high_seq_of(all_cards))
+        all_cards.update(accepted)
+        self.write_snapshot(deck_code, all_cards)
+
+        return accepted, new_count, updated_count
+
+    def retrieve(self, deck_code, timestamp):
+        """Retrieve the cards modified after the timestamp"""
+        cards = self.load(deck_code)
+        logger.debug("Loaded %s existing cards from %s", len(cards), self.snapshot_path(deck_code))
+        return {k: v for k, v in cards.items() if v["last_modified"] > timestamp}
+
+
+class LogDeckStore(JsonDeckStore):
+    """
+    Keeps the Decks/<code>.json snapshot and appends pushed cards to per-deck log segments
+    (Decks/<code>.<n>.log, one JSON card per line). Reads replay the snapshot plus the log
+    tail, and a background thread folds the segments into a new snapshot once the log grows
+    past compact_segments or compact_bytes.
+    """
+
+    def __init__(self, decks_dir, segment_bytes=1024 * 1024, compact_segments=8,
+                 compact_bytes=8 * 1024 * 1024, offload=None):
+        super().__init__(decks_dir)
+        self.segment_bytes = segment_bytes
+        self.compact_segments = compact_segments
+        self.compact_bytes = compact_bytes
+        # OffloadPool that folds the segments in a worker process, None to fold them in this one
+        self.offload = offload
+
+        self._lock = threading.Lock()
+        self._deck_locks = DeckLocks()
+        self._indexes = {}
+        # Per deck count bumped before and after the snapshot or the segments are replaced,
+        # odd while a rewrite is in progress
+        self._rewrites = {}
+        self._pending_compactions = set()
+        self._compaction_queue = queue.Queue()
+
+        self._compactor = threading.Thread(target=self._compaction_loop, daemon=True)
+        self._compactor.start()
+
+    def _deck_lock(self, deck_code):
+        return self._deck_locks(deck_code)
+
+    def version(self, deck_code):
+        # Segments are only appended by this process, so the in-memory log size is enough.
+        # log_bytes only grows once an append is synced, so reading it without the deck lock
+        # gives the last committed version instead of waiting for a merge in progress.
+        index = self._indexes.get(deck_code)
+        log_bytes = index["log_bytes"] if index else None
+        return super().version(deck_code), log_bytes
+
+    def segment_path(self, deck_code, number):
+        return segment_path(self.decks_dir, deck_code, number)
+
+    def list_segments(self, deck_code):
+        """Return the segment numbers of a deck in ascending order"""
+        prefix = deck_code + "."
+        numbers = []
+        for name in os.listdir(self.decks_dir):
+            if name.startswith(prefix) and name.endswith(".log"):
+                number = name[len(prefix):-len(".log")]
+                if number.isdigit():
+                    numbers.append(int(number))
+        return sorted(numbers)
+
+    def _replay(self, deck_code, segments):
+        if self.offload is not None and self.offload.enabled:
+            size = sum(os.path.getsize(self.segment_path(deck_code, n)) for n in segments)
+            if os.path.exists(self.snapshot_path(deck_code)):
+                size += os.path.getsize(self.snapshot_path(deck_code))
+            if size >= self.offload.threshold:
+                return self.offload.run_cards(replay_deck, self.decks_dir, deck_code, segments)
+        return replay_deck(self.decks_dir, deck_code, segments)
+
+    def _index(self, deck_code):
+        """
+        Per deck state kept in memory: last_modified of every card, the sequence number
+        high-water mark, the active segment and the size of the log. Built once from a full replay, then maintained by every append.
+        """
+        index = self._indexes.get(deck_code)
+        if index is None:
+            segments = self.list_segments(deck_code)
+            if segments:
+                # Appends go to the last segment, a crash can leave it ending in a partial line
+                trim_torn_tail(self.segment_path(deck_code, segments[-1]))
+            all_cards = self._replay(deck_code, segments)
+            sizes = [os.path.getsize(self.segment_path(deck_code, n)) for n in segments]
+            index = {
+                "modified": {uid: card.get("last_modified", 0) for uid, card in all_cards.items()},
+                "high_seq": high_seq_of(all_cards),
+                "active": segments[-1] if segments else 1,
+                "active_bytes": sizes[-1] if sizes else 0,
+                "log_segments": len(segments),
+                "log_bytes": sum(sizes),
+            }
+            self._indexes[deck_code] = index
+        return index
+
+    def _remove_segments(self, deck_code, segments):
+        """Delete the segment files, returns the number of bytes released"""
+        released = 0
+        for number in segments:
+            path = self.segment_path(deck_code, number)
+            try:
+                released += os.path.getsize(path)
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        return released
+
+    @contextmanager
+    def _rewriting(self, deck_code):
+        """Mark a rewrite of the deck files for the loads running without the deck lock"""
+        self._rewrites[deck_code] = self._rewrites.get(deck_code, 0) + 1
+        try:
+            yield
+        finally:
+            self._rewrites[deck_code] += 1
+
+    def load(self, deck_code):
+        """
+        Replay the deck without the deck lock, so a cold read doesn't wait for a merge or a
+        compaction. Appends only add lines to the segments, and a line still being written is
+        skipped as torn. A replay that overlapped a compaction or a create is done again.
+        """
+        for _ in range(LOAD_ATTEMPTS):
+            rewrites = self._rewrites.get(deck_code, 0)
+            if rewrites % 2:
+                continue
+            try:
+                all_cards = self._replay(deck_code, self.list_segments(deck_code))
+            except FileNotFoundError:
+                # A segment listed by this replay was folded and removed
+                continue
+            if self._rewrites.get(deck_code, 0) == rewrites:
+                return all_cards
+
+        with self._deck_lock(deck_code):
+            return self._replay(deck_code, self.list_segments(deck_code))
+
+    def create(self, deck_code, cards):
+        with self._deck_lock(deck_code), self._rewriting(deck_code):
+            self._remove_segments(deck_code, self.list_segments(deck_code))
+            self._indexes.pop(deck_code, None)
+            return super().create(deck_code, cards)
+
+    def merge(self, deck_code, cards):
+        """Append only the accepted cards to the active log segment"""
+        with self._deck_lock(deck_code):
+            index = self._index(deck_code)
+            modified = index["modified"]
+
+            accepted, new_count, updated_count = select_accepted_cards(cards, modified.get)
+            if accepted:
+                high_seq, offset = index["high_seq"], index["active_bytes"]
+                path = self.segment_path(deck_code, index["active"])
+                try:
+                    index["high_seq"] = assign_seqs(accepted.values(), high_seq)
+                    lines = b"".join(serializer.dumps(card) + b"\n" for card in accepted.values())
+                    with open(path, "ab") as outfile:
+                        outfile.write(lines)
+                        fsync_file(outfile)
+                    if offset == 0:
+                        fsync_dir(self.decks_dir)
+                except BaseException:
+                    # A failed merge leaves no trace, so the pushes can be merged again
+                    index["high_seq"] = high_seq
+                    self._truncate_segment(deck_code, path, offset)
+                    raise
+
+                written = len(lines)
+                if index["active_bytes"] == 0:
+                    index["log_segments"] += 1
+                index["active_bytes"] += written
+                index["log_bytes"] += written
+                for uid, card in accepted.items():
+                    modified[uid] = card.get("last_modified", 0)
+
+                if index["active_bytes"] >= self.segment_bytes:
+                    index["active"] += 1
+                    index["active_bytes"] = 0
+
+                self._maybe_schedule_compaction(deck_code, index)
+
+        return accepted, new_count, updated_count
+
+    def _truncate_segment(self, deck_code, path, offset):
+        """Cut what a failed append wrote off the end of the active segment"""
+        try:
+            if offset:
+                os.truncate(path, offset)
+            elif os.path.exists(path):
+                os.remove(path)
+        except OSError as e:
+            # Rebuild the index from whatever the log holds now
+            logger.error("Could not roll back the append to %s: %s", path, e)
+            self._indexes.pop(deck_code, None)
+
+    def _maybe_schedule_compaction(self, deck_code, index):
+        if index["log_segments"] >= self.compact_segments or index["log_bytes"] >= self.compact_bytes:
+            with self._lock:
+                if deck_code in self._pending_compactions:
+                    return
+                self._pending_compactions.add(deck_code)
+            self._compaction_queue.put(deck_code)
+
+    def _compaction_loop(self):
+        while True:
+            deck_code = self._compaction_queue.get()
+            try:
+                self.compact(deck_code)
+            except Exception as e:
+                logger.exception("Error compacting deck %s: %s", deck_code, e)
+            finally:
+                with self._lock:
+                    self._pending_compactions.discard(deck_code)
+
+    def compact(self, deck_code):
+        """Fold every closed log segment of a deck into a new snapshot"""
+        with self._deck_lock(deck_code):
+            index = self._index(deck_code)
+            if index["active_bytes"] > 0:
+                index["active"] += 1
+                index["active_bytes"] = 0
+            folded = [n for n in self.list_segments(deck_code) if n < index["active"]]
+
+        if not folded:
+            return
+
+        # Closed segments are never written again, so the merge can run without the deck lock
+        tmp_path = self.snapshot_path(deck_code) + ".compact"
+        if self.offload is not None:
+            count = self.offload.run(fold_segments, self.decks_dir, deck_code, folded, tmp_path)
+        else:
+            count = fold_segments(self.decks_dir, deck_code, folded, tmp_path)
+
+        with self._deck_lock(deck_code):
+            if self._indexes.get(deck_code) is not index:
+                # The deck was recreated while compacting, the folded segments are gone
+                os.remove(tmp_path)
+                return
+            with self._rewriting(deck_code):
+                os.replace(tmp_path, self.snapshot_path(deck_code))
+                fsync_dir(self.decks_dir)
+                index["log_bytes"] -= self._remove_segments(deck_code, folded)
+            index["log_segments"] -= len(folded)
+
+        logger.info("Compacted %s log segments of deck %s into %s cards", len(folded), deck_code, count)
+
+
+def segment_path(decks_dir, deck_code, number):
+    return os.path.join(decks_dir, f"{deck_code}.{number:08d}.log")
+
+
+def trim_torn_tail(path, block=64 * 1024):
+    """
+    Truncate a log segment after its last complete line, so the next append doesn't
+    continue a line torn by a crash. Returns the number of bytes removed.
+    """
+    with open(path, "r+b") as segment:
+        size = segment.seek(0, os.SEEK_END)
+        end = size
+        while end > 0:
+            start = max(0, end - block)
+            segment.seek(start)
+            newline = segment.read(end - start).rfind(b"\n")
+            if newline != -1:
+                end = start + newline + 1
+                break
+            end = start
+        if end == size:
+            return 0
+        segment.truncate(end)
+        fsync_file(segment)
+    logger.warning("Truncated %s torn bytes at the end of %s", size - end, path)
+    return size - end
+
+
+def replay_segment(path, all_cards):
+    """
+    Apply the cards of a log segment, in write order, to the dict of cards by stable_uid.
+    Only the last line can be torn by a crash and it is skipped, a line that doesn't decode
+    anywhere else means the segment is corrupt and raises ValueError.
+    """
+    with open(path, "rb") as infile:
+        for number, line in enumerate(infile, 1):
+            if not line.strip():
+                continue
+            try:
+                card = serializer.loads(line)
+            except serializer.DecodeError as e:
+                if not line.endswith(b"\n"):
+                    logger.warning("Skipping torn entry at the end of %s", path)
+                    continue
+                raise ValueError(f"Corrupt entry at line {number} of {path}: {e}") from e
+            all_cards[str(card["stable_uid"])] = card
+
+
+def replay_deck(decks_dir, deck_code, segments):
+    """Cards of a deck from its snapshot plus the given log segments, by stable_uid"""
+    all_cards = JsonDeckStore(decks_dir).read_snapshot(deck_code)
+    for number in segments:
+        replay_segment(segment_path(decks_dir, deck_code, number), all_cards)
+    return all_cards
+
+
+def fold_segments(decks_dir, deck_code, segments, tmp_path):
+    """
+    Write the snapshot of a deck plus its log segments to tmp_path, returns the number of cards.
+    Only reads and writes files, so it can run in a worker process.
+    """
+    all_cards = replay_deck(decks_dir, deck_code, segments)
+    with open(tmp_path, "wb") as outfile:
+        serializer.dump(all_cards, outfile)
+        fsync_file(outfile)
+    return len(all_cards)
+
+
+class SqliteDeckStore(JsonDeckStore):
+    """
+    Stores one row per card keyed by (deck_code, stable_uid) in Decks/cards.sqlite3.
+    Delta pulls are answered by a range query on the (deck_code, last_modified) index.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS decks (
+            deck_code TEXT PRIMARY KEY,
+            high_seq INTEGER NOT NULL DEFAULT 0,
+            version INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE TABLE IF NOT EXISTS cards (
+            deck_code TEXT NOT NULL,
+            stable_uid TEXT NOT NULL,
+            last_modified INTEGER NOT NULL,
+            seq INTEGER NOT NULL DEFAULT 0,
+            card TEXT NOT NULL,
+            PRIMARY KEY (deck_code, stable_uid)
+        );
+        CREATE INDEX IF NOT EXISTS cards_deck_modified ON cards (deck_code, last_modified);
+    """
+
+    # SQLite limits the number of host parameters of a single statement
+    LOOKUP_BATCH = 500
+    indexed_retrieve = True
+
+    def __init__(self, decks_dir, db_name="cards.sqlite3"):
+        super().__init__(decks_dir)
+        self.db_path = os.path.join(self.decks_dir, db_name)
+        self._local = threading.local()
+
+        with self._connection() as db:
+            db.executescript(self.SCHEMA)
+            self._add_missing_columns(db)
+
+    @staticmethod
+    def _add_missing_columns(db):
+        """Upgrade databases created before sequence numbers and deck versions were stored"""
+        deck_columns = {row[1] for row in db.execute("PRAGMA table_info(decks)")}
+        if "high_seq" not in deck_columns:
+            db.execute("ALTER TABLE decks ADD COLUMN high_seq INTEGER NOT NULL DEFAULT 0")
+        if "version" not in deck_columns:
+            db.execute("ALTER TABLE decks ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+
+        card_columns = {row[1] for row in db.execute("PRAGMA table_info(cards)")}
+        if "seq" not in card_columns:
+            db.execute("ALTER TABLE cards ADD COLUMN seq INTEGER NOT NULL DEFAULT 0")
+
+    def _connection(self):
+        """One connection per thread, sqlite3 connections can't be shared between threads"""
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.db_path, timeout=30)
+            db.execute("PRAGMA journal_mode=WAL")
+            # FULL syncs the WAL on every commit, a push is only acked once it is durable
+            db.execute("PRAGMA synchronous=FULL")
+            self._local.db = db
+        return db
+
+    def exists(self, deck_code):
+        # Decks created from the web interface only have their empty snapshot file
+        row = self._connection().execute(
+            "SELECT 1 FROM decks WHERE deck_code = ?", (deck_code,)
+        ).fetchone()
+        return row is not None or super().exists(deck_code)
+
+    def version(self, deck_code):
+        # Stored with the deck and bumped by every write, so versions don't repeat after a restart
+        row = self._connection().execute(
+            "SELECT version FROM decks WHERE deck_code = ?", (deck_code,)
+        ).fetchone()
+        return row[0] if row else 0, super().version(deck_code)
+
+    @staticmethod
+    def _commit(db):
+        start = time.perf_counter()
+        db.commit()
+        sync_latency.record(time.perf_counter() - start)
+
+    @staticmethod
+    def _rows(deck_code, cards):
+        return [
+            (deck_code, uid, card.get("last_modified", 0), card.get("seq", 0), serializer.dumps(card).decode("utf-8"))
+            for uid, card in cards.items()
+        ]
+
+    def _upsert(self, db, deck_code, cards):
+        """Write the cards with the next sequence numbers of the deck and bump its version"""
+        db.execute("INSERT OR IGNORE INTO decks (deck_code) VALUES (?)", (deck_code,))
+        high_seq = db.execute("SELECT high_seq FROM decks WHERE deck_code = ?", (deck_code,)).fetchone()[0]
+        high_seq = assign_seqs(cards.values(), high_seq)
+        db.execute("UPDATE decks SET high_seq = ?, version = version + 1 WHERE deck_code = ?", (high_seq, deck_code))
+        db.executemany(
+            "INSERT INTO cards (deck_code, stable_uid, last_modified, seq, card) VALUES (?, ?, ?, ?, ?) "
+            "ON CONFLICT (deck_code, stable_uid) DO UPDATE SET "
+            "last_modified = excluded.last_modified, seq = excluded.seq, card = excluded.card",
+            self._rows(deck_code, cards)
+        )
+
+    def _stored_modified(self, db, deck_code, uids):
+        stored = {}
+        uids = list(uids)
+        for start in range(0, len(uids), self.LOOKUP_BATCH):
+            batch = uids[start:start + self.LOOKUP_BATCH]
+            placeholders = ",".join("?" * len(batch))
+            stored.update(db.execute(
+                f"SELECT stable_uid, last_modified FROM cards "
+                f"WHERE deck_code = ? AND stable_uid IN ({placeholders})",
+                [deck_code, *batch]
+            ))
+        return stored
+
+    def load(self, deck_code):
+        rows = self._connection().execute(
+            "SELECT stable_uid, card FROM cards WHERE deck_code = ?", (deck_code,)
+        )
+        return {uid: serializer.loads(card) for uid, card in rows}
+
+    def iter_cards(self, deck_code):
+        """Stream the cards of a deck from the database without loading the whole deck"""
+        rows = self._connection().execute(
+            "SELECT stable_uid, card FROM cards WHERE deck_code = ?", (deck_code,)
+        )
+        for stable_uid, card in rows:
+            yield stable_uid, serializer.loads(card)
+
+    def create(self, deck_code, cards):
+        all_cards = {str(card["stable_uid"]): card for card in cards}
+        db = self._connection()
+        with db:
+            db.execute("DELETE FROM cards WHERE deck_code = ?", (deck_code,))
+            # The deck row keeps its version, a recreated deck must not reuse an older one
+            db.execute("UPDATE decks SET high_seq = 0 WHERE deck_code = ?", (deck_code,))
+            self._upsert(db, deck_code, all_cards)
+            self._commit(db)
+        return len(all_cards)
+
+    def merge(self, deck_code, cards):
+        """Upsert the accepted cards in a single transaction"""
+        db = self._connection()
+        with db:
+            # Take the write lock before reading so concurrent pushes can't interleave
+            db.execute("BEGIN IMMEDIATE")
+            stored = self._stored_modified(db, deck_code, {str(card["stable_uid"]) for card in cards})
+            accepted, new_count, updated_count = select_accepted_cards(cards, stored.get)
+            self._upsert(db, deck_code, accepted)
+            self._commit(db)
+
+        return accepted, new_count, updated_count
+
+    def retrieve(self, deck_code, timestamp):
+        """Retrieve the cards modified after the timestamp with an indexed range query"""
+        rows = self._connection().execute(
+            "SELECT stable_uid, card FROM cards WHERE deck_code = ? AND last_modified > ?",
+            (deck_code, timestamp)
+        )
+        return {uid: serializer.loads(card) for uid, card in rows}
+
+    def import_json_decks(self):
+        """
+        Import every Decks/<code>.json snapshot (plus its log segments, if any) that is not
+        in the database yet. Returns the number of imported decks.
+        """
+        json_store = LogDeckStore(self.decks_dir)
+        imported = 0
+
+        for name in sorted(os.listdir(self.decks_dir)):
+            if not name.endswith(".json"):
+                continue
+
+            deck_code = name[:-len(".json")]
+            row = self._connection().execute(
+                "SELECT 1 FROM decks WHERE deck_code = ?", (deck_code,)
+            ).fetchone()
+            if row is not None:
+                continue
+
+            cards = json_store.load(deck_code)
+            self.create(deck_code, cards.values())
+            imported += 1
+            logger.info("Imported deck %s with %s cards", deck_code, len(cards))
+
+        return imported
+
+
+def select_accepted_cards(cards, current_modified):
+    """
+    Decide which pushed cards win over the stored ones. current_modified(uid) returns the
+    stored last_modified of a card or None when the card is new.
+    Returns (accepted cards by uid, new_count, updated_count).
+    """
+    accepted = {}
+    new_count = 0
+    updated_count = 0
+
+    for card in cards:
+        stable_uid = str(card["stable_uid"])
+        stored = current_modified(stable_uid)
+
+        if stable_uid in accepted:
+            if card.get("last_modified", 0) > accepted[stable_uid].get("last_modified", 0):
+                accepted[stable_uid] = card
+        elif stored is None:
+            accepted[stable_uid] = card
+            new_count += 1
+        elif card.get("last_modified", 0) > stored:
+            accepted[stable_uid] = card
+            updated_count += 1
+
+    return accepted, new_count, updated_count
+
+
+def assign_seqs(cards, high_seq):
+    """Give every card the next per-deck sequence number, returns the new high-water mark"""
+    for card in cards:
+        high_seq += 1
+        card["seq"] = high_seq
+    return high_seq
+
+
+def high_seq_of(cards):
+    """Highest sequence number of a deck, cards written before sequence numbers count as 0"""
+    return max((card.get("seq", 0) for card in cards.values()), default=0)
+
+
+STORE_BACKENDS = {
+    "json": JsonDeckStore,
+    "log": LogDeckStore,
+    "sqlite": SqliteDeckStore,
+}
+
+
+def open_deck_store(decks_dir, backend=None, offload=None):
+    """
+    Build the deck store selected by the backend name or the DECK_STORE environment variable.
+    offload is the OffloadPool the log store compacts in.
+    """
+    backend = backend or os.environ.get("DECK_STORE", "log")
+    if backend not in STORE_BACKENDS:
+        raise ValueError(f"Unknown deck store '{backend}', expected one of {', '.join(STORE_BACKENDS)}")
+    if backend == "log":
+        return LogDeckStore(decks_dir, offload=offload)
+    return STORE_BACKENDS[backend](decks_dir)
@@ -0,0 +1,185 @@
+import heapq
+import itertools
+import threading
+import time
+from contextlib import contextmanager
+
+# Users whose finish tag fell behind the virtual time are forgotten past this many users
+MAX_TRACKED_USERS = 10000
+# Fixed cost of any request in bytes (connection, privilege check, deck lookup), without it a
+# tiny delta pull would cost nothing next to a download and heavy users would never get a turn
+REQUEST_COST = 64 * 1024
+
+
+class Ticket:
+    def __init__(self, user, cost, weight, finish):
+        self.user = user
+        self.cost = cost
+        self.weight = weight
+        self.finish = finish
+        self.granted = threading.Event()
+
+
+class FairScheduler:
+    """
+    Weighted fair queuing of requests across users. At most `slots` requests run at once,
+    when they are all taken the waiting request with the smallest virtual finish time goes
+    next. A request of estimated cost c from a user of weight w finishes at
+    max(virtual time, finish of the user's previous request) + c / w, so cheap requests get
+    ahead of heavy transfers and a user sending many heavy requests only delays their own.
+    Estimates are corrected with charge() once the real cost is known.
+    """
+
+    def __init__(self, slots=8, weights=None):
+        self.slots = slots
+        self.weights = weights or {}
+        self.running = 0
+        self.waited = 0
+        self.virtual_time = 0.0
+
+        self._lock = threading.Lock()
+        self._finish = {}
+        self._queue = []
+        self._order = itertools.count()
+
+    @property
+    def enabled(self):
+        return self.slots > 0
+
+    @property
+    def waiting(self):
+        return len(self._queue)
+
+    @contextmanager
+    def slot(self, user, cost):
+        """Wait for the turn of the request, yields its Ticket"""
+        if not self.enabled:
+            yield None
+            return
+
+        ticket = self._enter(user, cost)
+        try:
+            yield ticket
+        finally:
+            self._leave()
+
+    def turn(self, user, cost, on_wait=None):
+        """Turn of a request that takes its slot later, with Turn.hold()"""
+        return Turn(self, user, cost, on_wait)
+
+    def charge(self, ticket, moved):
+        """Replace the estimated cost of a request with the bytes it moved in the user's finish time"""
+        if ticket is None:
+            return
+        with self._lock:
+            if ticket.user in self._finish:
+                self._finish[ticket.user] += (REQUEST_COST + moved - ticket.cost) / ticket.weight
+
+    def _enter(self, user, cost):
+        weight = self.weights.get(user, 1.0)
+        with self._lock:
+            start = max(self.virtual_time, self._finish.get(user, 0.0))
+            finish = start + cost / weight
+            self._finish[user] = finish
+            ticket = Ticket(user, cost, weight, finish)
+            if self.running < self.slots and not self._queue:
+                self.running += 1
+                self.virtual_time = start
+                return ticket
+            heapq.heappush(self._queue, (finish, next(self._order), ticket))
+            self.waited += 1
+
+        ticket.granted.wait()
+        return ticket
+
+    def _leave(self):
+        with self._lock:
+            self.running -= 1
+            if self._queue:
+                _, _, ticket = heapq.heappop(self._queue)
+                # Virtual time follows the start of the last request sent to a slot
+                self.virtual_time = max(self.virtual_time, ticket.finish - ticket.cost / ticket.weight)
+                self.running += 1
+                ticket.granted.set()
+            if len(self._finish) > MAX_TRACKED_USERS:
+                self._finish = {user: finish for user, finish in self._finish.items()
+                                if finish > self.virtual_time}
+
+    def stats(self):
+        return {"slots": self.slots, "running": self.running, "waiting": self.waiting, "waited": self.waited}
+
+
+class Turn:
+    """
+    Scheduling of one request. hold() takes the slot only around the work that uses the
+    server (storage, merging, encoding), never while the request is still being received or
+    its response sent, so a slow client doesn't keep the others waiting. on_wait(seconds) is
+    called with the time hold() waited for the slot.
+    """
+
+    def __init__(self, scheduler, user, cost, on_wait=None):
+        self.scheduler = scheduler
+        self.user = user
+        self.cost = cost
+        self.on_wait = on_wait
+        self.ticket = None
+
+    @contextmanager
+    def hold(self):
+        """Hold a slot, the request's estimated cost is only counted the first time"""
+        start = time.perf_counter()
+        cost = self.cost if self.ticket is None else 0
+        with self.scheduler.slot(self.user, cost) as ticket:
+            if self.on_wait is not None:
+                self.on_wait(time.perf_counter() - start)
+            if self.ticket is None:
+                self.ticket = ticket
+            yield ticket
+
+    def iterate(self, chunks, batch_bytes=256 * 1024):
+        """
+        Produce the chunks of a streamed response in the slot, about batch_bytes at a time, and
+        yield each batch once the slot is given back. Reading and encoding a long stream is
+        spread over many short turns, cheaper requests waiting for a slot go in between, and
+        sending a batch never holds one.
+        """
+        chunks = iter(chunks)
+        while True:
+            batch, size = [], 0
+            with self.hold():
+                for chunk in chunks:
+                    batch.append(chunk)
+                    size += len(chunk)
+                    if size >= batch_bytes:
+                        break
+            yield from batch
+            if size < batch_bytes:
+                return
+
+    def charge(self, moved):
+        """Charge the bytes the request moved in place of its estimate, requests that never held a slot cost nothing"""
+        self.scheduler.charge(self.ticket, moved)
+
+
+class CostEstimates:
+    """Moving average of the bytes moved by the recent requests of each op on each deck"""
+
+    def __init__(self, default=64 * 1024, smoothing=0.3, max_entries=10000):
+        self.default = default
+        self.smoothing = smoothing
+        self.max_entries = max_entries
+
+        self._lock = threading.Lock()
+        self._costs = {}
+
+    def estimate(self, op, deck_code):
+        return REQUEST_COST + self._costs.get((op, deck_code), self.default)
+
+    def record(self, op, deck_code, cost):
+        key = (op, deck_code)
+        with self._lock:
+            previous = self._costs.get(key)
+            if previous is None and len(self._costs) >= self.max_entries:
+                # Forget the oldest deck, dicts keep insertion order
+                del self._costs[next(iter(self._costs))]
+            self._costs[key] = cost if previous is None else previous + self.smoothing * (cost - previous)
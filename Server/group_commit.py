@@ -0,0 +1,120 @@
+import threading
+import time
+
+from deck_store import LatencySamples
+
+
+class Batch:
+    """Pushes to one deck that are merged and persisted together"""
+
+    def __init__(self):
+        self.pushes = []
+        self.errors = []
+        self.done = threading.Event()
+
+
+class GroupCommitter:
+    """
+    Group commit of concurrent pushes to the same deck. The first push of a batch leads it:
+    it waits for the deck writer lock and then `window` more seconds, while pushes to the same
+    deck join its batch, and commits all of them with a single merge and sync. Pushes arriving
+    during a commit start the next batch. Every push still gets the outcome of its own batch.
+    on_batch(pushes, seconds) is called after every commit with the size of the batch.
+    """
+
+    def __init__(self, deck_locks, window=0.002, max_batch=64, on_batch=None):
+        self.deck_locks = deck_locks
+        self.window = window
+        self.max_batch = max_batch
+        self.on_batch = on_batch
+        self.pushes = 0
+        self.largest_batch = 0
+        # Pushes submitted and not answered yet
+        self.waiting = 0
+        self.commit_latency = LatencySamples()
+
+        self._lock = threading.Lock()
+        self._open = {}
+
+    def submit(self, deck_code, cards, commit):
+        """
+        Commit the cards of one push with whatever pushes join the batch. commit(deck_code, pushes)
+        is called by the leader with the deck writer lock held, and must leave the deck as it was
+        when it raises, the pushes are then committed one by one. Raises the error of a failed push.
+        """
+        with self._lock:
+            self.waiting += 1
+            batch = self._open.get(deck_code)
+            leader = batch is None
+            if leader:
+                batch = self._open[deck_code] = Batch()
+            position = len(batch.pushes)
+            batch.pushes.append(cards)
+            if len(batch.pushes) >= self.max_batch:
+                self._close(deck_code, batch)
+
+        try:
+            if leader:
+                self._lead(deck_code, batch, commit)
+            else:
+                batch.done.wait()
+        finally:
+            with self._lock:
+                self.waiting -= 1
+
+        if batch.errors[position] is not None:
+            raise batch.errors[position]
+
+    def _close(self, deck_code, batch):
+        if self._open.get(deck_code) is batch:
+            del self._open[deck_code]
+
+    def _lead(self, deck_code, batch, commit):
+        with self.deck_locks(deck_code):
+            if self.window:
+                time.sleep(self.window)
+            with self._lock:
+                self._close(deck_code, batch)
+
+            start = time.perf_counter()
+            try:
+                batch.errors = self._commit(deck_code, batch.pushes, commit)
+            finally:
+                elapsed = time.perf_counter() - start
+                self.commit_latency.record(elapsed)
+                if self.on_batch is not None:
+                    self.on_batch(len(batch.pushes), elapsed)
+                with self._lock:
+                    self.pushes += len(batch.pushes)
+                    self.largest_batch = max(self.largest_batch, len(batch.pushes))
+                batch.done.set()
+
+    @staticmethod
+    def _commit(deck_code, pushes, commit):
+        """Returns the error of every push, None for the committed ones"""
+        try:
+            commit(deck_code, pushes)
+            return [None] * len(pushes)
+        except Exception as e:
+            if len(pushes) == 1:
+                return [e]
+
+        # One bad push must not fail the others, commit them one by one to find it
+        errors = []
+        for cards in pushes:
+            try:
+                commit(deck_code, [cards])
+                errors.append(None)
+            except Exception as e:
+                errors.append(e)
+        return errors
+
+    def stats(self):
+        batches = self.commit_latency.count
+        return {
+            "batches": batches,
+            "pushes": self.pushes,
+            "mean_batch": round(self.pushes / batches, 2) if batches else 0.0,
+            "largest_batch": self.largest_batch,
+            "commit": self.commit_latency.stats(),
+        }
@@ -0,0 +1,112 @@
+"""
+Asynchronous structured logging for the socket server. Request threads only put the records on
+a queue (QueueHandler), a QueueListener thread formats them as one JSON object per line and
+writes them out, so a slow stdout never holds up a request. Every record carries the id of the
+request it was logged for, and DEBUG records are sampled per message so the chatty ones can be
+left on under load.
+"""
+import atexit
+import contextvars
+import copy
+import datetime
+import itertools
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+
+# Id of the request the current thread is handling, set by the server for every request
+request_id = contextvars.ContextVar("request_id", default=None)
+
+_connection_ids = itertools.count(1)
+
+# Attributes every LogRecord has, anything else was passed with extra= and goes in the JSON
+RECORD_ATTRIBUTES = set(vars(logging.makeLogRecord({}))) | {"message", "asctime", "request_id"}
+
+
+def new_connection_id():
+    return next(_connection_ids)
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "time": datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc)
+                    .isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        if getattr(record, "request_id", None) is not None:
+            entry["request_id"] = record.request_id
+        for key, value in vars(record).items():
+            if key not in RECORD_ATTRIBUTES:
+                entry[key] = value
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class DebugSampler(logging.Filter):
+    """Lets through one in `rate` DEBUG records of every message, the other levels always pass"""
+
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+        self._counts = {}
+
+    def filter(self, record):
+        if record.levelno > logging.DEBUG or self.rate <= 1:
+            return True
+        # Keyed by the unformatted message, so each call site is sampled on its own
+        key = (record.name, record.msg)
+        count = self._counts.get(key, 0)
+        self._counts[key] = count + 1
+        return count % self.rate == 0
+
+
+class RequestQueueHandler(logging.handlers.QueueHandler):
+    """
+    Queues the record with its request id and its message and traceback already rendered,
+    the arguments may change once the request moves on
+    """
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.request_id = request_id.get()
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def setup_logging(level=None, debug_sample=None, stream=None):
+    """
+    Route every log record through a queue to a JSON handler on stream (stdout by default).
+    level and debug_sample default to the LOG_LEVEL and LOG_DEBUG_SAMPLE environment variables.
+    Returns the QueueListener, which is stopped and flushed at exit.
+    """
+    level = level or os.environ.get("LOG_LEVEL", "INFO")
+    debug_sample = debug_sample or int(os.environ.get("LOG_DEBUG_SAMPLE", 100))
+
+    output = logging.StreamHandler(stream or sys.stdout)
+    output.setFormatter(JsonFormatter())
+
+    records = queue.SimpleQueue()
+    handler = RequestQueueHandler(records)
+    handler.addFilter(DebugSampler(debug_sample))
+
+    root = logging.getLogger()
+    for old in root.handlers[:]:
+        root.removeHandler(old)
+    root.addHandler(handler)
+    root.setLevel(level.upper() if isinstance(level, str) else level)
+
+    listener = logging.handlers.QueueListener(records, output, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
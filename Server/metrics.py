@@ -0,0 +1,229 @@
+"""
+Server metrics: counters, gauges and latency histograms. A small HTTP endpoint serves them in
+the Prometheus text format and a background thread logs a summary every few seconds.
+"""
+import http.server
+import logging
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+logger = logging.getLogger("metrics")
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def format_labels(names, values):
+    if not names:
+        return ""
+    pairs = ",".join(f'{name}="{value}"' for name, value in zip(names, values))
+    return "{" + pairs + "}"
+
+
+def format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels[name]) for name in self.labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        for key, value in values:
+            yield self.name + format_labels(self.labels, key), value
+
+    def summary(self):
+        with self._lock:
+            return {",".join(key) or "total": value for key, value in sorted(self._values.items())}
+
+
+class Gauge:
+    """Value read from a callback when the metrics are collected, like a queue depth"""
+    kind = "gauge"
+
+    def __init__(self, name, help, read):
+        self.name = name
+        self.help = help
+        self.read = read
+
+    def samples(self):
+        yield self.name, self.read()
+
+    def summary(self):
+        return self.read()
+
+
+class ReadCounter:
+    """
+    Counter kept by another component, read from a callback when the metrics are collected.
+    With a label, read() returns the count of every label value as a dict.
+    """
+    kind = "counter"
+
+    def __init__(self, name, help, read, label=None):
+        self.name = name
+        self.help = help
+        self.read = read
+        self.label = label
+
+    def samples(self):
+        if self.label is None:
+            yield self.name, self.read()
+            return
+        for value, count in sorted(self.read().items()):
+            yield self.name + format_labels((self.label,), (value,)), count
+
+    def summary(self):
+        return self.read()
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        # label values -> [count per bucket plus +Inf, sum, count]
+        self._series = {}
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels[name]) for name in self.labels)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def _snapshot(self):
+        with self._lock:
+            return sorted((key, (list(counts), total, count)) for key, (counts, total, count) in self._series.items())
+
+    def samples(self):
+        for key, (counts, total, count) in self._snapshot():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += bucket_count
+                labels = format_labels(self.labels + ("le",), key + (str(bound),))
+                yield f"{self.name}_bucket{labels}", cumulative
+            labels = format_labels(self.labels, key)
+            yield f"{self.name}_sum{labels}", total
+            yield f"{self.name}_count{labels}", count
+
+    def quantile(self, counts, count, fraction):
+        """Upper bound of the bucket holding the quantile"""
+        rank = fraction * count
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets, counts):
+            cumulative += bucket_count
+            if cumulative >= rank:
+                return bound
+        return float("inf")
+
+    def summary(self):
+        return {
+            ",".join(key) or "total": {
+                "count": count,
+                "mean_ms": round(total / count * 1000, 2),
+                "p50_ms": self.quantile(counts, count, 0.5) * 1000,
+                "p99_ms": self.quantile(counts, count, 0.99) * 1000,
+            }
+            for key, (counts, total, count) in self._snapshot()
+        }
+
+
+class Registry:
+    def __init__(self, prefix=""):
+        self.prefix = prefix
+        self.metrics = []
+
+    def _add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self._add(Counter(self.prefix + name, help, labels))
+
+    def gauge(self, name, help, read):
+        return self._add(Gauge(self.prefix + name, help, read))
+
+    def read_counter(self, name, help, read, label=None):
+        return self._add(ReadCounter(self.prefix + name, help, read, label))
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        return self._add(Histogram(self.prefix + name, help, labels, buckets))
+
+    def render(self):
+        """All the metrics in the Prometheus text exposition format"""
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, value in metric.samples():
+                lines.append(f"{name} {format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self):
+        return {metric.name[len(self.prefix):]: metric.summary() for metric in self.metrics}
+
+
+def serve_metrics(registry, host="localhost", port=9108):
+    """Serve GET /metrics from a daemon thread, returns the HTTP server"""
+
+    class MetricsHandler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != "/metrics":
+                self.send_error(404)
+                return
+            body = registry.render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    httpd = http.server.ThreadingHTTPServer((host, port), MetricsHandler)
+    httpd.daemon_threads = True
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    return httpd
+
+
+def dump_periodically(registry, interval):
+    """Log the summary of the metrics every interval seconds from a daemon thread"""
+
+    def dump():
+        while True:
+            time.sleep(interval)
+            logger.info("Metrics", extra={"metrics": registry.summary()})
+
+    threading.Thread(target=dump, daemon=True).start()
@@ -0,0 +1,22 @@
+"""
+Imports the existing Decks/<code>.json files into the SQLite deck store.
+
+Usage (from the Server directory):
+    python migrate_decks.py
+    DECK_STORE=sqlite python server.py
+"""
+import os
+import sys
+
+SERVER_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.dirname(SERVER_DIR))
+
+from deck_store import SqliteDeckStore
+
+DECKS_DIR = os.environ.get("DECKS_DIR", os.path.join(SERVER_DIR, "Decks"))
+
+
+if __name__ == "__main__":
+    store = SqliteDeckStore(DECKS_DIR)
+    imported = store.import_json_decks()
+    print(f"Imported {imported} decks into {store.db_path}")
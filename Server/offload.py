@@ -0,0 +1,148 @@
+"""
+Process pool for the CPU heavy work on big payloads. Decoding a large push in a handler thread
+holds the GIL for the whole parse and stalls every other connection, so payloads of at least
+OFFLOAD_BYTES are parsed in a worker process instead, and the log store replays and compacts
+big decks there. Smaller requests stay inline, the round trip to a worker costs more than they do.
+"""
+import concurrent.futures
+import multiprocessing
+import os
+import pickle
+import threading
+import time
+
+from DataManagement import serializer
+from DataManagement.cards_management import decode_spool
+
+# Cards per pickled piece sent back by a worker, they are unpickled one at a time so the
+# handler thread lets go of the GIL between pieces
+PIECE_CARDS = 1000
+
+
+def to_pieces(cards):
+    """Pickle a list or dict of cards as (container, pieces of PIECE_CARDS cards or items)"""
+    if cards is None:
+        return None, []
+    items = list(cards.items()) if isinstance(cards, dict) else cards
+    pieces = [pickle.dumps(items[start:start + PIECE_CARDS], pickle.HIGHEST_PROTOCOL)
+              for start in range(0, len(items), PIECE_CARDS)]
+    return type(cards), pieces
+
+
+def from_pieces(container, pieces):
+    if container is None:
+        return None
+    items = []
+    for piece in pieces:
+        items.extend(pickle.loads(piece))
+    return dict(items) if container is dict else items
+
+
+def decode_in_worker(path, max_memory):
+    """decode_spool() of a payload spooled to path, big ones are decoded card by card from disk"""
+    try:
+        with open(path, "rb") as spool:
+            return to_pieces(decode_spool(spool, max_memory))
+    except serializer.DecodeError as e:
+        # Decode errors keep the whole document, don't ship it back to the server
+        raise ValueError(str(e)) from None
+
+
+def cards_in_worker(fn, *args):
+    return to_pieces(fn(*args))
+
+
+class OffloadPool:
+    """
+    Runs functions in a pool of worker processes, or inline when workers is 0. The processes
+    are only started on first use, so a server that never sees a big payload never pays for them.
+    """
+
+    def __init__(self, workers=2, threshold=4 * 1024 * 1024):
+        self.workers = workers
+        self.threshold = threshold
+        self.offloaded = 0
+        self.inline = 0
+        self.in_flight = 0
+        self.worker_time = 0.0
+
+        self._lock = threading.Lock()
+        self._executor = None
+
+    @property
+    def enabled(self):
+        return self.workers > 0
+
+    def _pool(self):
+        with self._lock:
+            if self._executor is None:
+                # spawn: forking a process full of handler threads could copy a held lock
+                self._executor = concurrent.futures.ProcessPoolExecutor(
+                    self.workers, mp_context=multiprocessing.get_context("spawn"))
+            return self._executor
+
+    def run(self, fn, *args):
+        """Call fn(*args) in a worker process and wait for the result, inline when disabled"""
+        if not self.enabled:
+            with self._lock:
+                self.inline += 1
+            return fn(*args)
+
+        start = time.perf_counter()
+        executor = self._pool()
+        with self._lock:
+            self.in_flight += 1
+        try:
+            return executor.submit(fn, *args).result()
+        except concurrent.futures.process.BrokenProcessPool:
+            # A worker died (killed, out of memory), start a new pool for the next request
+            with self._lock:
+                if self._executor is executor:
+                    self._executor = None
+            raise
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+                self.offloaded += 1
+                self.worker_time += time.perf_counter() - start
+
+    def decode_spool(self, spool, max_memory):
+        """
+        decode_spool() of cards_management for a PayloadSpool, parsed in a worker when the
+        payload is big. The worker reads the spool file itself, the payload is never pickled.
+        """
+        size = spool.seek(0, os.SEEK_END)
+        spool.seek(0)
+        if not self.enabled or size < self.threshold:
+            with self._lock:
+                self.inline += 1
+            return decode_spool(spool, max_memory)
+
+        spool.rollover()
+        spool.flush()
+        return from_pieces(*self.run(decode_in_worker, spool.name, max_memory))
+
+    def run_cards(self, fn, *args):
+        """Call fn(*args), which returns a list or dict of cards, in a worker process"""
+        return from_pieces(*self.run(cards_in_worker, fn, *args))
+
+    def stats(self):
+        return {
+            "workers": self.workers,
+            "offloaded": self.offloaded,
+            "inline": self.inline,
+            "worker_ms": round(self.worker_time * 1000, 1),
+        }
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
+
+
+# Workers only help with a core to spare, on a single CPU they just compete with the server
+payload_pool = OffloadPool(
+    workers=int(os.environ.get("OFFLOAD_WORKERS", min(2, (os.cpu_count() or 1) - 1))),
+    threshold=int(os.environ.get("OFFLOAD_BYTES", 4 * 1024 * 1024)),
+)
@@ -0,0 +1,71 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class PrivilegeCache:
+    """
+    TTL + LRU cache of the privilege of a user on a deck, keyed by (username, deck_code).
+    Missing access is cached too, as None. The whole cache is dropped whenever the generation
+    token changes, so privilege changes apply on the next lookup instead of after the TTL.
+    """
+
+    def __init__(self, lookup, max_entries=10000, ttl=30, generation=None):
+        self.lookup = lookup
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.generation = generation
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._generation = generation() if generation else None
+
+    def get(self, username, deck_code):
+        key = (username, deck_code)
+        token = self.generation() if self.generation else None
+
+        with self._lock:
+            if token != self._generation:
+                self._generation = token
+                self._entries.clear()
+                self.invalidations += 1
+
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+
+        privilege = self.lookup(username, deck_code)
+
+        with self._lock:
+            # A change seen by another lookup meanwhile means this result may be stale
+            if token == self._generation:
+                self._entries[key] = (privilege, time.monotonic() + self.ttl)
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+                    self.evictions += 1
+        return privilege
+
+    def invalidate(self):
+        with self._lock:
+            self._entries.clear()
+            self.invalidations += 1
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+            }
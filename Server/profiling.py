@@ -0,0 +1,107 @@
+"""
+On-demand profiling of the socket server requests. When enabled, one in `sample` requests runs
+under cProfile and tracemalloc, and its pstats and allocation snapshot are written to a
+directory that keeps only the newest files. Profiling starts enabled with PROFILE_REQUESTS=1,
+and SIGUSR1 switches it on and off without a restart.
+
+Read the results with:
+    python -m pstats profiles/<file>.pstats
+    tracemalloc.Snapshot.load("profiles/<file>.tracemalloc").statistics("lineno")
+"""
+import cProfile
+import itertools
+import logging
+import os
+import re
+import signal
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+logger = logging.getLogger("profiling")
+
+# Frames kept per allocation in the tracemalloc snapshots
+TRACE_FRAMES = 10
+
+
+class RequestProfiler:
+    def __init__(self, directory, sample=10, keep=200, enabled=False, memory=True):
+        self.directory = directory
+        self.sample = max(1, sample)
+        self.keep = keep
+        self.enabled = enabled
+        self.memory = memory
+        self.profiled = 0
+
+        self._requests = itertools.count()
+        # cProfile and tracemalloc both see the whole process, profile one request at a time
+        self._busy = threading.Lock()
+
+    def toggle(self, *args):
+        self.enabled = not self.enabled
+        logger.warning("Request profiling %s, writing to %s", "enabled" if self.enabled else "disabled",
+                       self.directory)
+
+    def install_signal(self, signum=getattr(signal, "SIGUSR1", None)):
+        """Toggle profiling on the signal, only possible from the main thread"""
+        if signum is None or threading.current_thread() is not threading.main_thread():
+            return False
+        signal.signal(signum, self.toggle)
+        return True
+
+    @contextmanager
+    def profile(self, op, deck_code):
+        """Profile the body when profiling is on and this request is sampled"""
+        if not self.enabled or next(self._requests) % self.sample or not self._busy.acquire(blocking=False):
+            yield
+            return
+
+        try:
+            profiler = cProfile.Profile()
+            if self.memory:
+                tracemalloc.start(TRACE_FRAMES)
+            start = time.perf_counter()
+            profiler.enable()
+            try:
+                yield
+            finally:
+                profiler.disable()
+                elapsed = time.perf_counter() - start
+                snapshot = peak = None
+                if self.memory:
+                    snapshot = tracemalloc.take_snapshot()
+                    peak = tracemalloc.get_traced_memory()[1]
+                    tracemalloc.stop()
+                self.write(op, deck_code, profiler, snapshot, elapsed, peak)
+        finally:
+            self._busy.release()
+
+    def write(self, op, deck_code, profiler, snapshot, elapsed, peak):
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            safe_deck = re.sub(r"[^A-Za-z0-9_.+-]", "_", str(deck_code))[:64]
+            base = os.path.join(self.directory, f"{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}-"
+                                                f"{self.profiled}-op{op}-{safe_deck}")
+            profiler.dump_stats(base + ".pstats")
+            if snapshot is not None:
+                snapshot.dump(base + ".tracemalloc")
+            self.profiled += 1
+            self.rotate()
+            logger.info("Profiled op %s on deck %s: %.1f ms, peak %s KiB, written to %s", op, deck_code,
+                        elapsed * 1000, peak // 1024 if peak is not None else "-", base)
+        except OSError as e:
+            logger.error("Could not write the profile of op %s on deck %s: %s", op, deck_code, e)
+
+    def rotate(self):
+        """Delete the oldest profiles beyond keep files"""
+        files = [os.path.join(self.directory, name) for name in os.listdir(self.directory)
+                 if name.endswith((".pstats", ".tracemalloc"))]
+        if len(files) <= self.keep:
+            return
+        files.sort(key=os.path.getmtime)
+        for path in files[:len(files) - self.keep]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
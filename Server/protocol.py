@@ -0,0 +1,573 @@
+"""
+Wire protocol of the socket server.
+
+v1: a 1 byte op followed by 64 byte space padded size headers, the card payload is delimited
+by the client half-closing the socket, so every connection carries a single request.
+
+v2: the client opens with MAGIC + version byte and the server answers with the version it
+speaks. After that every message is a frame: 1 byte type, 4 byte big-endian length, payload.
+A request is a single REQUEST frame with the op metadata as JSON, card payloads are sent as
+DATA frames closed by an END frame, so one connection can carry many requests.
+
+v3: v2 plus a compression codec negotiated right after the handshake. The client sends a
+CODEC frame with the codecs it supports in order of preference and the server answers with
+a CODEC frame naming the one it picked, or null. The card payloads of every request are then
+sent as one compressed stream over the DATA frames (see compression.py).
+
+A server without room for a new connection answers it with the single BUSY byte, before
+reading anything, and closes it. Clients should back off and retry later.
+"""
+import os
+import socket
+import struct
+import time
+from contextlib import contextmanager
+
+from compression import choose_codec, compress_stream, decompress_stream, CompressionStats
+from DataManagement import serializer
+from DataManagement.cards_management import collect_upload, recv_chunks, PayloadTooLarge
+from offload import payload_pool
+
+MAGIC = b"V"
+VERSION = 3
+
+FRAME_HEADER = struct.Struct("!cI")
+REQUEST = b"Q"
+STATUS = b"S"
+META = b"M"
+DATA = b"D"
+END = b"E"
+BYE = b"B"
+CODEC = b"C"
+BUSY = b"!"
+
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+CHUNK_SIZE = 64 * 1024
+# Bytes handed to sendfile at once, the download deadline is checked between them
+SENDFILE_SIZE = 1024 * 1024
+V1_HEADER = 64
+
+# Card uploads above MAX_UPLOAD_SIZE are refused, above UPLOAD_SPOOL_SIZE they go to a temp file
+MAX_UPLOAD_SIZE = int(os.environ.get("MAX_UPLOAD_BYTES", 512 * 1024 * 1024))
+UPLOAD_SPOOL_SIZE = int(os.environ.get("UPLOAD_SPOOL_BYTES", 8 * 1024 * 1024))
+
+
+class ProtocolError(Exception):
+    pass
+
+
+class DeadlineExceeded(TimeoutError):
+    def __init__(self, phase, seconds):
+        super().__init__(f"The {phase} did not complete within {seconds} s")
+        self.phase = phase
+
+
+class Deadlines:
+    """
+    Seconds a client gets to complete each phase of a request: the handshake (up to the
+    request and its arguments), the upload of a push and the download of a response.
+    None leaves the phase without a limit. on_expired(phase) is called when one runs out.
+    """
+
+    def __init__(self, handshake=None, upload=None, download=None, on_expired=None):
+        self.handshake = handshake
+        self.upload = upload
+        self.download = download
+        self.on_expired = on_expired
+
+    @contextmanager
+    def phase(self, conn, name):
+        """Run the body under the deadline of the phase, on sockets that support deadlines"""
+        seconds = getattr(self, name)
+        set_deadline = getattr(conn, "set_deadline", None)
+        if seconds is None or set_deadline is None:
+            yield
+            return
+
+        set_deadline(seconds)
+        try:
+            yield
+        except TimeoutError as e:
+            if self.on_expired is not None:
+                self.on_expired(name)
+            raise DeadlineExceeded(name, seconds) from e
+        finally:
+            set_deadline(None)
+
+
+NO_DEADLINES = Deadlines()
+
+
+class DeadlineSocket:
+    """
+    Socket wrapper failing reads and writes once the deadline set for the current phase has
+    passed, however slowly the bytes trickle in. The regular timeout still applies on its own.
+    """
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.deadline = None
+        self.timeout = sock.gettimeout()
+
+    def set_deadline(self, seconds):
+        if seconds is None:
+            self.deadline = None
+            self.sock.settimeout(self.timeout)
+        else:
+            self.deadline = time.monotonic() + seconds
+
+    def settimeout(self, timeout):
+        self.timeout = timeout
+        if self.deadline is None:
+            self.sock.settimeout(timeout)
+
+    def gettimeout(self):
+        return self.timeout
+
+    def _arm(self):
+        if self.deadline is None:
+            return
+        remaining = self.deadline - time.monotonic()
+        if remaining <= 0:
+            raise TimeoutError("Deadline passed")
+        self.sock.settimeout(remaining if self.timeout is None else min(remaining, self.timeout))
+
+    def recv_into(self, buffer, nbytes=0, flags=0):
+        self._arm()
+        return self.sock.recv_into(buffer, nbytes, flags)
+
+    def sendall(self, data, flags=0):
+        self._arm()
+        self.sock.sendall(data, flags)
+
+    def sendfile(self, file, offset=0, count=None):
+        sent = 0
+        while count is None or sent < count:
+            self._arm()
+            size = SENDFILE_SIZE if count is None else min(SENDFILE_SIZE, count - sent)
+            piece = self.sock.sendfile(file, offset + sent, size)
+            if not piece:
+                break
+            sent += piece
+        return sent
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
+
+
+class CountingSocket:
+    """Socket wrapper counting the bytes received and sent, for the request metrics"""
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.bytes_received = 0
+        self.bytes_sent = 0
+
+    def recv_into(self, buffer, nbytes=0, flags=0):
+        count = self.sock.recv_into(buffer, nbytes, flags)
+        self.bytes_received += count
+        return count
+
+    def sendall(self, data, flags=0):
+        self.sock.sendall(data, flags)
+        self.bytes_sent += len(data)
+
+    def sendfile(self, file, offset=0, count=None):
+        sent = self.sock.sendfile(file, offset, count)
+        self.bytes_sent += sent
+        return sent
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
+
+
+def recv_exactly(sock, size):
+    """Read exactly size bytes, recv can return less than asked for"""
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    received = 0
+    while received < size:
+        count = sock.recv_into(view[received:], size - received)
+        if count == 0:
+            raise ConnectionError(f"Connection closed after {received} of {size} bytes")
+        received += count
+    return bytes(buffer)
+
+
+def send_frame(sock, frame_type, payload=b""):
+    sock.sendall(FRAME_HEADER.pack(frame_type, len(payload)) + payload)
+
+
+def recv_frame(sock):
+    """Returns (frame_type, payload)"""
+    frame_type, size = FRAME_HEADER.unpack(recv_exactly(sock, FRAME_HEADER.size))
+    if size > MAX_FRAME_SIZE:
+        raise ProtocolError(f"Frame of {size} bytes exceeds the {MAX_FRAME_SIZE} bytes limit")
+    return frame_type, recv_exactly(sock, size) if size else b""
+
+
+def send_json_frame(sock, frame_type, data):
+    send_frame(sock, frame_type, serializer.dumps(data))
+
+
+def expect_frame(sock, expected_type):
+    frame_type, payload = recv_frame(sock)
+    if frame_type != expected_type:
+        raise ProtocolError(f"Expected frame {expected_type!r}, got {frame_type!r}")
+    return payload
+
+
+def encode_cards(cards, chunk_size=CHUNK_SIZE):
+    """
+    Serialize a dict of cards, or an iterable of (stable_uid, card) pairs, as one JSON object.
+    Yields chunks of about chunk_size bytes as the cards are consumed, so a deck is never
+    held in memory as a single string. The output matches serializer.dumps of the same dict.
+    """
+    if isinstance(cards, dict):
+        cards = cards.items()
+
+    parts = [b"{"]
+    size = 1
+    separator = b""
+    for stable_uid, card in cards:
+        piece = separator + serializer.dumps(stable_uid) + b":" + serializer.dumps(card)
+        separator = b","
+        parts.append(piece)
+        size += len(piece)
+        if size >= chunk_size:
+            yield b"".join(parts)
+            parts = []
+            size = 0
+
+    parts.append(b"}")
+    yield b"".join(parts)
+
+
+class CountedCards:
+    """Iterates (stable_uid, card) pairs while counting them"""
+
+    def __init__(self, cards):
+        self.cards = cards.items() if isinstance(cards, dict) else cards
+        self.count = 0
+
+    def __iter__(self):
+        for item in self.cards:
+            self.count += 1
+            yield item
+
+
+class EncodedCards:
+    """
+    Cards encoded as the payload chunks of a response, compressed with codec when one is given.
+    Up to max_bytes of chunks are encoded right away and kept, so the same bytes can be sent to
+    every connection that asked for them. A bigger response is left incomplete: the rest is
+    encoded while it is sent, so it can only be sent once, by the connection that created it.
+    """
+
+    def __init__(self, cards, codec=None, max_bytes=None):
+        self._counted = CountedCards(cards)
+        chunks = encode_cards(self._counted)
+        self.compression = None
+        if codec is not None:
+            self.compression = CompressionStats(codec)
+            chunks = compress_stream(chunks, codec, self.compression)
+
+        self._kept = []
+        self.size = 0
+        self._rest = iter(chunks)
+        for chunk in self._rest:
+            self._kept.append(chunk)
+            self.size += len(chunk)
+            if max_bytes is not None and self.size > max_bytes:
+                break
+        else:
+            self._rest = None
+
+    @property
+    def complete(self):
+        """True when every chunk is kept and the response can be sent any number of times"""
+        return self._rest is None
+
+    @property
+    def count(self):
+        """Number of cards, final once an incomplete response was sent"""
+        return self._counted.count
+
+    @property
+    def chunks(self):
+        if self.complete:
+            return self._kept
+        return self._stream()
+
+    def _stream(self):
+        kept, self._kept = self._kept, []
+        yield from kept
+        for chunk in self._rest:
+            self.size += len(chunk)
+            yield chunk
+
+
+def send_message(sock, data):
+    """Send a payload as DATA frames followed by an END frame"""
+    view = memoryview(data)
+    for start in range(0, len(view), CHUNK_SIZE):
+        send_frame(sock, DATA, view[start:start + CHUNK_SIZE])
+    send_frame(sock, END)
+
+
+def recv_message(sock):
+    """Read DATA frames up to the END frame"""
+    chunks = []
+    while True:
+        frame_type, payload = recv_frame(sock)
+        if frame_type == END:
+            return b"".join(chunks)
+        if frame_type != DATA:
+            raise ProtocolError(f"Unexpected frame {frame_type!r} inside a message")
+        chunks.append(payload)
+
+
+def iter_message_chunks(sock):
+    """
+    Yield the payloads of DATA frames up to the END frame. They are received into one reusable
+    buffer, so every chunk is only valid until the next one is requested.
+    """
+    buffer = bytearray(CHUNK_SIZE)
+    while True:
+        frame_type, size = FRAME_HEADER.unpack(recv_exactly(sock, FRAME_HEADER.size))
+        if frame_type == END:
+            return
+        if frame_type != DATA:
+            raise ProtocolError(f"Unexpected frame {frame_type!r} inside a message")
+        if size > MAX_FRAME_SIZE:
+            raise ProtocolError(f"Frame of {size} bytes exceeds the {MAX_FRAME_SIZE} bytes limit")
+        if size > len(buffer):
+            buffer = bytearray(size)
+
+        view = memoryview(buffer)[:size]
+        received = 0
+        while received < size:
+            count = sock.recv_into(view[received:], size - received)
+            if count == 0:
+                raise ConnectionError(f"Connection closed after {received} of {size} bytes")
+            received += count
+        yield view
+
+
+class V1Connection:
+    """Single request connection of the original protocol, the op byte was already read"""
+
+    version = 1
+    codec = None
+    compression = None
+    # Connections sending the same bytes for the same cards share snapshot files
+    snapshot_variant = "v1"
+
+    def __init__(self, conn, op, deadlines=NO_DEADLINES):
+        self.conn = conn
+        self.op = op
+        self.deadlines = deadlines
+        self.request = None
+
+    def read_package(self):
+        size = recv_exactly(self.conn, V1_HEADER).decode("utf-8")
+        return recv_exactly(self.conn, int(size)).decode("utf-8")
+
+    def send_package(self, info):
+        info_encoded = str(info).encode("utf-8")
+        info_length = str(len(info_encoded)).encode("utf-8")
+        info_length += b' ' * (V1_HEADER - len(info_length))
+        self.conn.sendall(info_length + info_encoded)
+
+    def next_request(self):
+        """The single request of the connection, None once it was served"""
+        if self.request is not None:
+            return None
+
+        self.request = {"op": self.op}
+        with self.deadlines.phase(self.conn, "handshake"):
+            self.request["username"] = self.read_package()
+            self.request["deck_code"] = self.read_package().strip()
+            if self.op == "0":
+                self.request["deck_name"] = self.read_package()
+        return self.request
+
+    def read_argument(self, name):
+        # v1 clients send the pull cursor after the privilege check
+        with self.deadlines.phase(self.conn, "handshake"):
+            return self.read_package()
+
+    def send_status(self, ok):
+        self.conn.sendall(b"1" if ok else b"0")
+
+    def send_meta(self, name, value):
+        self.send_package(value)
+
+    def read_cards(self):
+        with self.deadlines.phase(self.conn, "upload"):
+            return collect_upload(recv_chunks(self.conn), UPLOAD_SPOOL_SIZE, MAX_UPLOAD_SIZE,
+                                  payload_pool.decode_spool)
+
+    def send_cards(self, cards, pace=None):
+        """
+        Stream the cards until the connection is closed, returns the number of cards sent.
+        pace(chunks) wraps the encoded chunks, see Turn.iterate().
+        """
+        counted = CountedCards(cards)
+        chunks = encode_cards(counted)
+        if pace is not None:
+            chunks = pace(chunks)
+        with self.deadlines.phase(self.conn, "download"):
+            for chunk in chunks:
+                self.conn.sendall(chunk)
+        return counted.count
+
+    def send_encoded(self, encoded):
+        """Send cards encoded by EncodedCards, returns the number of cards sent"""
+        with self.deadlines.phase(self.conn, "download"):
+            for chunk in encoded.chunks:
+                self.conn.sendall(chunk)
+        return encoded.count
+
+    @staticmethod
+    def write_cards(cards, file):
+        """Write what send_cards would send to a file, returns (cards written, compression stats)"""
+        counted = CountedCards(cards)
+        for chunk in encode_cards(counted):
+            file.write(chunk)
+        return counted.count, None
+
+    def send_file(self, file, compression=None):
+        """Send a file written by write_cards"""
+        with self.deadlines.phase(self.conn, "download"):
+            self.conn.sendfile(file)
+
+
+class V2Connection:
+    """Framed connection that serves requests until the client says BYE or disconnects"""
+
+    def __init__(self, conn, version=2, deadlines=NO_DEADLINES):
+        self.conn = conn
+        self.version = version
+        self.deadlines = deadlines
+        self.request = None
+        self.codec = None
+        # Compression of the current request, None while it did not move any compressed payload
+        self.compression = None
+
+    def negotiate_codec(self):
+        offered = serializer.loads(expect_frame(self.conn, CODEC))["codecs"]
+        self.codec = choose_codec(offered)
+        send_json_frame(self.conn, CODEC, {"codec": self.codec.name if self.codec else None})
+
+    def next_request(self):
+        """
+        Read the next REQUEST frame, None when the client is done. Called once the client has
+        started sending it, the frame gets the handshake deadline like the first request.
+        """
+        try:
+            with self.deadlines.phase(self.conn, "handshake"):
+                frame_type, payload = recv_frame(self.conn)
+        except ConnectionError:
+            return None
+
+        if frame_type == BYE:
+            return None
+        if frame_type != REQUEST:
+            raise ProtocolError(f"Expected a request frame, got {frame_type!r}")
+
+        self.compression = None
+        self.request = serializer.loads(payload)
+        self.request["deck_code"] = self.request["deck_code"].strip()
+        return self.request
+
+    def read_argument(self, name):
+        return self.request[name]
+
+    def send_status(self, ok):
+        send_frame(self.conn, STATUS, b"1" if ok else b"0")
+
+    def send_meta(self, name, value):
+        send_json_frame(self.conn, META, {name: value})
+
+    def read_cards(self):
+        frames = chunks = iter_message_chunks(self.conn)
+        if self.codec is not None:
+            self.compression = CompressionStats(self.codec)
+            chunks = decompress_stream(frames, self.codec, self.compression)
+        with self.deadlines.phase(self.conn, "upload"):
+            try:
+                return collect_upload(chunks, UPLOAD_SPOOL_SIZE, MAX_UPLOAD_SIZE, payload_pool.decode_spool)
+            except PayloadTooLarge:
+                # Skip the rest of the message so the connection can serve the next request
+                for _ in frames:
+                    pass
+                raise
+
+    def send_cards(self, cards, pace=None):
+        """
+        Stream the cards as DATA frames followed by END, returns the number of cards sent.
+        pace(chunks) wraps the encoded and compressed chunks, see Turn.iterate().
+        """
+        counted = CountedCards(cards)
+        chunks = encode_cards(counted)
+        if self.codec is not None:
+            self.compression = CompressionStats(self.codec)
+            chunks = compress_stream(chunks, self.codec, self.compression)
+        if pace is not None:
+            chunks = pace(chunks)
+        with self.deadlines.phase(self.conn, "download"):
+            for chunk in chunks:
+                send_frame(self.conn, DATA, chunk)
+            send_frame(self.conn, END)
+        return counted.count
+
+    def send_encoded(self, encoded):
+        """Send cards encoded by EncodedCards with the codec of this connection"""
+        self.compression = encoded.compression
+        with self.deadlines.phase(self.conn, "download"):
+            for chunk in encoded.chunks:
+                send_frame(self.conn, DATA, chunk)
+            send_frame(self.conn, END)
+        return encoded.count
+
+    @property
+    def snapshot_variant(self):
+        return f"v2-{self.codec.name if self.codec else 'raw'}"
+
+    def write_cards(self, cards, file):
+        """Write the frames send_cards would send to a file, returns (cards written, compression stats)"""
+        counted = CountedCards(cards)
+        chunks = encode_cards(counted)
+        compression = None
+        if self.codec is not None:
+            compression = CompressionStats(self.codec)
+            chunks = compress_stream(chunks, self.codec, compression)
+        for chunk in chunks:
+            file.write(FRAME_HEADER.pack(DATA, len(chunk)) + chunk)
+        file.write(FRAME_HEADER.pack(END, 0))
+        return counted.count, compression
+
+    def send_file(self, file, compression=None):
+        """Send a file written by write_cards"""
+        self.compression = compression
+        with self.deadlines.phase(self.conn, "download"):
+            self.conn.sendfile(file)
+
+
+def accept_connection(conn, deadlines=NO_DEADLINES):
+    """Read the first byte of a connection and return the matching protocol connection"""
+    with deadlines.phase(conn, "handshake"):
+        first = recv_exactly(conn, 1)
+        if first != MAGIC:
+            return V1Connection(conn, first.decode("utf-8"), deadlines)
+
+        requested = recv_exactly(conn, 1)[0]
+        version = min(requested, VERSION)
+        # Responses are several small frames, don't let Nagle hold them for the client's delayed ACK
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        conn.sendall(MAGIC + bytes([version]))
+        connection = V2Connection(conn, version, deadlines)
+        if version >= 3:
+            connection.negotiate_codec()
+        return connection
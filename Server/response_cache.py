@@ -0,0 +1,87 @@
+import threading
+from collections import OrderedDict
+
+
+class ResponseCache:
+    """
+    Encoded pull responses of recent deck versions, bounded by the size of their payloads and
+    evicted least recently used first. An entry is keyed by deck and variant (op, cursor
+    bucket, codec) and tagged with the deck version it was encoded from. Caching a response
+    of another version of the deck drops all the others, so pushes don't fill the cache with
+    responses nobody will ask for again. max_bytes of 0 disables the cache.
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        # deck_code: (version, variants cached for it)
+        self._decks = {}
+
+    def get(self, deck_code, version, variant):
+        """The response cached for the variant of a deck at the given version, or None"""
+        key = (deck_code, variant)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] != version:
+                self._drop(key)
+                self.invalidations += 1
+                entry = None
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, deck_code, version, variant, response, size):
+        if size > self.max_bytes:
+            return
+
+        key = (deck_code, variant)
+        with self._lock:
+            self._drop(key)
+            cached_version, variants = self._decks.get(deck_code, (version, set()))
+            if cached_version != version:
+                for other in list(variants):
+                    self._drop((deck_code, other))
+                self.invalidations += 1
+                variants = set()
+            self._decks[deck_code] = (version, variants)
+            self._entries[key] = (version, response, size)
+            variants.add(variant)
+            self.total_bytes += size
+
+            while self.total_bytes > self.max_bytes:
+                self._drop(next(iter(self._entries)))
+                self.evictions += 1
+
+    def _drop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        self.total_bytes -= entry[2]
+        deck_code, variant = key
+        variants = self._decks[deck_code][1]
+        variants.discard(variant)
+        if not variants:
+            del self._decks[deck_code]
+
+    def stats(self):
+        with self._lock:
+            return {
+                "responses": len(self._entries),
+                "bytes": self.total_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+            }
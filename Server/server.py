@@ -1,231 +1,776 @@
+import atexit
+import logging
 import socket
 import threading
+import time
 import os
+from contextlib import nullcontext
+import signal
 import sys
-import django
 
 SERVER_DIR = os.path.dirname(os.path.abspath(__file__))
 PROJECT_DIR = os.path.abspath(os.path.join(SERVER_DIR, 'WebServer'))
 sys.path.append(PROJECT_DIR)
+sys.path.append(os.path.dirname(SERVER_DIR))
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'WebServer.settings')
-django.setup()
 
-from django.contrib.auth.models import User
-from login.models import Deck, UserDeck
-from login.views import save_deck_user_privilege, new_deck_local, retrieve_deck_name
 from DataManagement.cards_management import *
+from auth_snapshot import MembershipSnapshot, generation_token
+from connection_pool import ConnectionPool, readable
+from deck_store import open_deck_store, DeckLocks, sync_latency
+from deck_cache import DeckCache, CachedDeck
+from fair_scheduler import FairScheduler, CostEstimates, REQUEST_COST
+from group_commit import GroupCommitter
+from log_pipeline import setup_logging, request_id, new_connection_id
+from metrics import Registry, serve_metrics, dump_periodically
+from offload import payload_pool
+from privilege_cache import PrivilegeCache
+from profiling import RequestProfiler
+from protocol import accept_connection, CountingSocket, DeadlineSocket, Deadlines, DeadlineExceeded, ProtocolError, \
+    EncodedCards, BUSY
+from response_cache import ResponseCache
+from single_flight import SingleFlight
+from snapshots import SnapshotStore
+
+logger = logging.getLogger("server")
+
+DECKS_DIR = os.environ.get("DECKS_DIR", os.path.join(SERVER_DIR, "Decks"))
+# DATABASES and PRIVILEGE_GENERATION_FILE of WebServer/settings.py, importing it loads half of Django
+AUTH_DB_PATH = os.environ.get("AUTH_DB_PATH",
+                              os.environ.get("DJANGO_DB_PATH", os.path.join(PROJECT_DIR, "db.sqlite3")))
+PRIVILEGE_GENERATION_PATH = os.environ.get("PRIVILEGE_GENERATION_PATH",
+                                           os.path.join(PROJECT_DIR, "privilege_generation"))
+
+deck_cache = DeckCache(int(os.environ.get("DECK_CACHE_BYTES", 256 * 1024 * 1024)))
+# Pushes to the same deck are serialized, pulls never take these and read the cached snapshot
+deck_writers = DeckLocks()
+# Concurrent pushes to a deck are merged and synced together
+group_commits = GroupCommitter(
+    deck_writers,
+    window=float(os.environ.get("GROUP_COMMIT_WINDOW_MS", 2)) / 1000,
+    max_batch=int(os.environ.get("GROUP_COMMIT_MAX_BATCH", 64)),
+    on_batch=lambda pushes, seconds: group_commit_batches.observe(pushes),
+)
+# Sampled requests run under cProfile and tracemalloc when profiling is on, SIGUSR1 toggles it
+request_profiler = RequestProfiler(
+    os.environ.get("PROFILE_DIR", os.path.join(SERVER_DIR, "profiles")),
+    sample=int(os.environ.get("PROFILE_SAMPLE", 10)),
+    keep=int(os.environ.get("PROFILE_KEEP", 200)),
+    enabled=os.environ.get("PROFILE_REQUESTS", "0") == "1",
+    memory=os.environ.get("PROFILE_MEMORY", "1") != "0",
+)
+
+# Accepted connections wait here for a worker thread, when the queue is full they are turned away
+connection_pool = ConnectionPool(
+    workers=int(os.environ.get("SERVER_WORKERS", 64)),
+    queue_size=int(os.environ.get("SERVER_QUEUE", 256)),
+    # The add-on waits 2 seconds for the handshake, past that nobody is waiting for the answer
+    max_wait=float(os.environ.get("SERVER_QUEUE_WAIT", 2)),
+    # Kept-alive connections are closed after this many seconds without a request
+    idle_timeout=float(os.environ.get("SERVER_IDLE_TIMEOUT", 60)),
+)
+deadlines = Deadlines(
+    handshake=float(os.environ.get("HANDSHAKE_TIMEOUT", 10)),
+    upload=float(os.environ.get("UPLOAD_TIMEOUT", 300)),
+    download=float(os.environ.get("DOWNLOAD_TIMEOUT", 300)),
+    on_expired=lambda phase: deadlines_expired.inc(phase=phase),
+)
+
+
+def parse_weights(text):
+    """FAIR_WEIGHTS: comma separated username=weight pairs"""
+    weights = {}
+    for pair in filter(None, text.split(",")):
+        username, _, weight = pair.partition("=")
+        weights[username.strip()] = float(weight)
+    return weights
+
+
+# Requests wait for one of FAIR_SLOTS slots in weighted fair order across users, cheapest first
+fair_scheduler = FairScheduler(
+    slots=int(os.environ.get("FAIR_SLOTS", 2 * (os.cpu_count() or 1))),
+    weights=parse_weights(os.environ.get("FAIR_WEIGHTS", "")),
+)
+request_costs = CostEstimates()
+# Identical pulls in flight share one retrieval and encoding
+pull_flights = SingleFlight()
+# Encoded pull responses of recent deck versions, bounded by their size
+response_cache = ResponseCache(int(os.environ.get("RESPONSE_CACHE_BYTES", 64 * 1024 * 1024)))
+# Bigger responses are encoded while they are sent, never kept in memory to be cached or shared
+MAX_SHARED_RESPONSE_BYTES = int(os.environ.get("MAX_SHARED_RESPONSE_BYTES", 8 * 1024 * 1024))
+# Seconds op 1 pull timestamps are rounded down to, so more of them coalesce. 0 keeps them exact
+PULL_TIMESTAMP_BUCKET = int(os.environ.get("PULL_TIMESTAMP_BUCKET", 0))
+
+OPS = ("0", "1", "2", "3")
+open_connections = set()
+
+metrics = Registry("conjoined_")
+request_latency = metrics.histogram("request_seconds", "Time to handle a request, by op", ["op"])
+request_errors = metrics.counter("request_errors_total", "Requests that failed with an error, by op", ["op"])
+request_bytes = metrics.counter("request_bytes_total", "Bytes received from clients, by op", ["op"])
+response_bytes = metrics.counter("response_bytes_total", "Bytes sent to clients, by op", ["op"])
+push_failures = metrics.counter("push_failures_total", "Pushes answered with a failure status")
+cards_pushed = metrics.counter("cards_total", "Pushed cards by outcome: received, new, updated or skipped",
+                               ["outcome"])
+privilege_latency = metrics.histogram("privilege_check_seconds", "Time to check the privilege of a user on a deck")
+storage_latency = metrics.histogram("storage_seconds", "Time spent in the deck store, by operation", ["operation"])
+metrics.gauge("connections", "Open client connections", lambda: len(open_connections))
+metrics.gauge("group_commit_waiting", "Pushes waiting for their group commit", lambda: group_commits.waiting)
+metrics.gauge("offload_in_flight", "Payloads being processed by the offload workers", lambda: payload_pool.in_flight)
+metrics.gauge("deck_cache_bytes", "Estimated size of the cached decks", lambda: deck_cache.total_bytes)
+metrics.gauge("response_cache_bytes", "Size of the cached pull responses", lambda: response_cache.total_bytes)
+metrics.gauge("pending_connections", "Accepted connections waiting for a worker", lambda: connection_pool.pending)
+metrics.gauge("parked_connections", "Kept-alive connections waiting for their next request",
+              lambda: connection_pool.parked)
+metrics.gauge("busy_workers", "Workers serving a connection", lambda: connection_pool.busy)
+metrics.gauge("fair_queue_waiting", "Requests waiting for a fair scheduler slot", lambda: fair_scheduler.waiting)
+cached_pulls = metrics.counter("pulls_cached_total", "Pulls answered from the response cache, by op", ["op"])
+snapshot_sends = metrics.counter("snapshot_downloads_total", "Full downloads sent from a snapshot file")
+snapshot_builds = metrics.counter("snapshot_builds_total", "Snapshot files written")
+encoded_pulls = metrics.counter("pull_encodes_total", "Pull responses retrieved and encoded, by op", ["op"])
+coalesced_pulls = metrics.counter("pulls_coalesced_total",
+                                  "Pulls answered with the response encoded for an identical one, by op", ["op"])
+coalesced_bytes = metrics.counter("coalesced_bytes_total", "Response bytes that didn't have to be encoded again, by op",
+                                  ["op"])
+schedule_wait = metrics.histogram("schedule_wait_seconds", "Time requests waited for a fair scheduler slot, by op",
+                                  ["op"])
+queue_wait = metrics.histogram("queue_wait_seconds", "Time accepted connections waited for a worker")
+rejected_connections = metrics.counter("rejected_connections_total",
+                                       "Connections answered BUSY, by reason: queue_full or queue_timeout",
+                                       ["reason"])
+deadlines_expired = metrics.counter("deadlines_expired_total",
+                                    "Connections closed because a phase ran out of time, by phase", ["phase"])
+compression_raw_bytes = metrics.counter("compression_raw_bytes_total",
+                                        "Payload bytes before compression, by codec and direction",
+                                        ["codec", "direction"])
+compression_wire_bytes = metrics.counter("compression_wire_bytes_total",
+                                         "Compressed payload bytes on the wire, by codec and direction",
+                                         ["codec", "direction"])
+compression_cpu = metrics.counter("compression_cpu_seconds_total",
+                                  "CPU time spent compressing and decompressing payloads, by codec and direction",
+                                  ["codec", "direction"])
+metrics.read_counter("deck_cache_lookups_total", "Deck cache lookups, by result: hit or miss",
+                     lambda: {"hit": deck_cache.hits, "miss": deck_cache.misses}, label="result")
+metrics.read_counter("deck_cache_evictions_total", "Decks evicted from the deck cache to make room",
+                     lambda: deck_cache.evictions)
+metrics.read_counter("deck_cache_invalidations_total", "Cached decks dropped because the deck changed",
+                     lambda: deck_cache.invalidations)
+group_commit_batches = metrics.histogram("group_commit_batch_size", "Pushes committed together by one group commit",
+                                         buckets=(1, 2, 4, 8, 16, 32, 64, 128))
+sync_seconds = metrics.histogram("sync_seconds", "Time to make a deck write durable: fsyncs and SQLite commits")
+sync_latency.on_record = sync_seconds.observe
+
+_django_lock = threading.Lock()
+_django_ready = False
+
+
+def setup_django():
+    """
+    Load Django on first use. The web app is only needed to create decks and their
+    privileges, so the socket accepts connections before it is imported.
+    """
+    global _django_ready
+    if _django_ready:
+        return
+    with _django_lock:
+        if not _django_ready:
+            import django
+            django.setup()
+            _django_ready = True
+
+
+def new_deck_local(deck_name, deck_code):
+    setup_django()
+    from login import views
+    return views.new_deck_local(deck_name, deck_code)
+
+
+def save_deck_user_privilege(username, deck_code, privilege):
+    setup_django()
+    from login import views
+    return views.save_deck_user_privilege(username, deck_code, privilege)
+
+
+def retrieve_deck_name(deck_code):
+    setup_django()
+    from login import views
+    return views.retrieve_deck_name(deck_code)
+
+
+def lookup_privilege(username, deck_code):
+    """Privilege of the user on the deck in a single query, None without access"""
+    setup_django()
+    from login.models import UserDeck
+    return (UserDeck.objects
+            .filter(user__username=username, deck__deck_code=deck_code)
+            .values_list("privilege", flat=True)
+            .first())
+
+
+def open_privileges():
+    """
+    Source of the privilege checks: a membership snapshot read from the SQLite database of
+    the web app without Django, or the cached ORM lookup when AUTH_SNAPSHOT=0 (the web app
+    uses another database)
+    """
+    if os.environ.get("AUTH_SNAPSHOT", "1") != "0":
+        return MembershipSnapshot(AUTH_DB_PATH, PRIVILEGE_GENERATION_PATH,
+                                  float(os.environ.get("AUTH_SNAPSHOT_REFRESH", 30)))
+
+    return PrivilegeCache(
+        lookup_privilege,
+        max_entries=int(os.environ.get("PRIVILEGE_CACHE_SIZE", 10000)),
+        ttl=float(os.environ.get("PRIVILEGE_CACHE_TTL", 30)),
+        generation=lambda: generation_token(PRIVILEGE_GENERATION_PATH),
+    )
+
+
+privileges = open_privileges()
+
+
+def privilege_lookups():
+    """Privilege checks by where they were answered: the cache (hit or miss) or the membership snapshot"""
+    if isinstance(privileges, PrivilegeCache):
+        return {"cache_hit": privileges.hits, "cache_miss": privileges.misses}
+    return {"snapshot": privileges.lookups}
+
+
+metrics.read_counter("privilege_lookups_total", "Privilege checks by result: cache_hit, cache_miss or snapshot",
+                     privilege_lookups, label="result")
+
+
+def check_for_privilege(username, deck_code, privileges_needed):
+    try:
+        with privilege_latency.time():
+            privilege = privileges.get(username, deck_code)
+    except Exception as e:
+        logger.error("Error checking privileges: %s", e)
+        return False
+
+    if privilege is None:
+        logger.info("User %s not found or doesn't have access to deck %s", username, deck_code)
+        return False
+    return privilege in privileges_needed
+
+
+def start_metrics():
+    """Serve /metrics on METRICS_PORT (0 to disable) and print a summary every METRICS_DUMP_INTERVAL seconds"""
+    port = int(os.environ.get("METRICS_PORT", 9108))
+    if port:
+        try:
+            serve_metrics(metrics, os.environ.get("METRICS_HOST", "localhost"), port)
+            logger.info("Metrics on http://localhost:%s/metrics", port)
+        except OSError as e:
+            logger.error("Error serving metrics on port %s: %s", port, e)
 
+    interval = float(os.environ.get("METRICS_DUMP_INTERVAL", 60))
+    if interval:
+        dump_periodically(metrics, interval)
 
-def check_for_privilege(username, deck_code, privileges):
+
+def warm_up():
+    """Load the membership snapshot and Django in the background once the socket is listening"""
     try:
-        user = User.objects.get(username=username)
-        user_deck = UserDeck.objects.get(user=user, deck__deck_code=deck_code)
-        return user_deck.privilege in privileges
-    except (User.DoesNotExist, UserDeck.DoesNotExist, Deck.DoesNotExist):
-        print(f"User {username} not found or doesn't have access to deck {deck_code}")
-        return False
+        privileges.get("", "")
+        setup_django()
     except Exception as e:
-        print(f"Error checking privileges: {str(e)}")
-        return False
+        logger.error("Error warming up: %s", e)
+
+
+def held(turn):
+    """The fair scheduler slot of a request, nothing for calls made outside of a request"""
+    return turn.hold() if turn is not None else nullcontext()
+
+
+class Session:
+    """An accepted connection and the protocol it speaks, kept between requests"""
+
+    def __init__(self, conn, connection, connection_id):
+        self.conn = conn
+        self.connection = connection
+        self.connection_id = connection_id
+        self.requests = 0
+
+    def fileno(self):
+        return self.conn.fileno()
+
+    def close(self):
+        open_connections.discard(self.conn)
+        self.conn.close()
 
 
 class Server:
     HEADER = 64
+    # Seconds between two checks of the connection queue while no client connects
+    SHED_INTERVAL = 0.5
+    # SnapshotStore the full downloads are sent from, None encodes them for every download
+    snapshots = None
 
-    def __init__(self, host="localhost", port=9999):
+    def __init__(self, host="localhost", port=9999, store=None):
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.sock.bind((host, port))
         self.sock.listen()
-        self.json_file = ""
-
-        try:
-            os.makedirs(SERVER_DIR + "/Decks")
-        except FileExistsError:
-            pass
-
-        print(f"Server listening on {host}:{port}")
-
+        self.store = store or open_deck_store(DECKS_DIR, offload=payload_pool)
+        # Created here and not on import: offload workers and benchmarks import this module too
+        if os.environ.get("SNAPSHOTS", "1") != "0":
+            self.snapshots = SnapshotStore(os.environ.get("SNAPSHOT_DIR", os.path.join(SERVER_DIR, "Snapshots")))
+            atexit.register(self.snapshots.close)
+
+        logger.info("Server listening on %s:%s", host, port)
+        threading.Thread(target=warm_up, daemon=True).start()
+        start_metrics()
+        request_profiler.install_signal()
+        if threading.current_thread() is threading.main_thread():
+            # Stop through the KeyboardInterrupt path, so the atexit cleanups run
+            signal.signal(signal.SIGTERM, signal.default_int_handler)
+        connection_pool.start(self.serve_connection, self.reject_connection, self.close_idle)
+
+        # Accept with a timeout, so connections stuck in the queue are turned away on time
+        # even while every worker is busy
+        self.sock.settimeout(self.SHED_INTERVAL)
         try:
             while True:
-                conn, addr = self.sock.accept()
-                print(f"\n\n\nConnected to {addr}")
-                threading.Thread(target=self.handle_client, args=(conn,)).start()
+                try:
+                    conn, addr = self.sock.accept()
+                except TimeoutError:
+                    conn = None
+                connection_pool.shed()
+                if conn is not None:
+                    logger.debug("Connected to %s", addr)
+                    connection_pool.submit(conn)
         except KeyboardInterrupt:
-            print("Closing server")
+            logger.info("Closing server")
             self.sock.close()
 
-    def handle_client(self, conn):
+    def serve_connection(self, conn, waited):
+        queue_wait.observe(waited)
+        if isinstance(conn, Session):
+            self.serve_session(conn)
+        else:
+            self.handle_client(conn)
+
+    @staticmethod
+    def reject_connection(conn, reason):
+        """Answer BUSY and close the connection, so the client backs off instead of hanging"""
+        rejected_connections.inc(reason=reason)
+        logger.debug("Rejecting connection: %s", reason)
+        if isinstance(conn, Session):
+            # Between two framed requests a lone BUSY byte can't be read, the client reconnects
+            conn.close()
+            return
         try:
-            choice = conn.recv(1).decode("utf-8")
-            username_size = conn.recv(self.HEADER).decode("utf-8")
-            username = conn.recv(int(username_size)).decode("utf-8")
-            deck_code_size = conn.recv(self.HEADER).decode("utf-8")
-            deck_code = conn.recv(int(deck_code_size)).decode("utf-8").strip()
-            self.json_file = "./Decks/" + deck_code + ".json"
-
-            match choice:
-                case "0":
-                    print("User is trying to send their updated/new cards")
-                    print("Checking for privilege...")
-                    deck_name_size = conn.recv(self.HEADER).decode("utf-8")
-                    deck_name = conn.recv(int(deck_name_size)).decode("utf-8")
-
-                    if not os.path.exists(self.json_file):
-                        print("Creating new deck...")
-                        conn.sendall(str(1).encode("utf-8"))
-                        self.add_cards(conn, True)
-                        new_deck_local(deck_name, deck_code)
-                        save_deck_user_privilege(username, deck_code, "c")
-
-                    elif check_for_privilege(username, deck_code, ["c", "m", "w"]):
-                        print("Privilege found, sending ok...")
-                        conn.sendall(str(1).encode("utf-8"))
-                        self.add_cards(conn, False)
-
-
-                    else:
-                        print("Privilege not found or invalid, sending fail...")
-                        conn.sendall(str(0).encode("utf-8"))
-
-                case "1":
-                    print("Trying to send the updated/new cards based on the user's timestamp")
-                    print("Checking for privilege...")
-
-                    if check_for_privilege(username, deck_code, ["c", "m", "w", "r"]):
-                        print("Privilege found, sending ok...")
-                        conn.sendall(str(1).encode("utf-8"))
-                        timestamp_length = conn.recv(int(self.HEADER)).decode("utf-8")
-                        timestamp = conn.recv(int(timestamp_length)).decode("utf-8")
-                        cards = self.retrieve_cards_from_json(int(timestamp))
-                        conn.send(json.dumps(cards).encode("utf-8"))
-
-                    else:
-                        print("Privilege not found, sending fail...")
-                        conn.sendall(str(0).encode("utf-8"))
-
-                case "2":
-                    print("Trying to send new deck to the user")
-                    print("Checking for privilege...")
-
-                    if check_for_privilege(username, deck_code, ["c", "m", "w", "r"]):
-                        print("Privilege found, sending ok...")
-                        conn.sendall(str(1).encode("utf-8"))
-                        deck_name = retrieve_deck_name(deck_code)
-                        self.send_size_and_package_server(conn, deck_name)
-                        cards = self.retrieve_cards_from_json(0)
-                        conn.send(json.dumps(cards).encode("utf-8"))
-
-                    else:
-                        print("Privilege not found, sending fail...")
-                        conn.sendall(str(0).encode("utf-8"))
-
-                case _:
-                    print("Invalid choice")
-        except Exception as e:
-            print(f"Error: {e}")
+            conn.sendall(BUSY)
+            conn.shutdown(socket.SHUT_WR)
+        except OSError:
+            pass
         finally:
             conn.close()
 
-    def add_cards(self, conn, new):
+    def handle_client(self, conn):
+        conn = DeadlineSocket(CountingSocket(conn))
+        open_connections.add(conn)
+        connection_id = new_connection_id()
+        request_id.set(str(connection_id))
         try:
-            cards = collect_cards(conn)
-            if new:
-                self.create_deck(cards)
-            else:
-                self.save_cards_to_json(cards)
-            print("Sending success response (1)")
-            conn.sendall(str(1).encode("utf-8"))
-
+            connection = accept_connection(conn, deadlines)
+            logger.debug("Client speaks protocol v%s", connection.version)
         except Exception as e:
-            print(f"Error: {e}")
-            print("Sending error response (0)")
-            conn.sendall(str(0).encode("utf-8"))
-
-    def save_cards_to_json(self, new_cards):
-        """Save cards to JSON file, merging with existing data if the file exists."""
-        all_cards = {}
-
+            self.log_closing(e)
+            open_connections.discard(conn)
+            conn.close()
+            return
+        self.serve_session(Session(conn, connection, connection_id))
+
+    def serve_session(self, session):
+        """
+        Serve the requests the client has sent. A kept-alive connection is parked as soon as
+        its client has nothing more to send, instead of holding the worker while it is idle.
+        """
+        conn, connection = session.conn, session.connection
+        request_id.set(str(session.connection_id))
         try:
-            with open(self.json_file, "r") as infile:
-                existing_data = json.load(infile)
-
-                if isinstance(existing_data, list):
-                    for card in existing_data:
-                        if "stable_uid" in card:
-                            all_cards[str(card["stable_uid"])] = card
-
-                elif isinstance(existing_data, dict):
-                    all_cards = existing_data
-
-            print(f"Loaded {len(all_cards)} existing cards from {self.json_file}")
-        except json.JSONDecodeError:
-            print(f"Error reading {self.json_file}, will create a new file")
-
-        updated_count = 0
-        new_count = 0
-
-        for card in new_cards:
-            stable_uid = str(card.get("stable_uid", ""))
-
-            if not stable_uid:
-                card["stable_uid"] = generate_stable_uid()
-                stable_uid = card["stable_uid"]
+            while True:
+                if connection.version >= 2 and not readable(conn):
+                    connection_pool.park(session)
+                    return
+                received, sent = conn.bytes_received, conn.bytes_sent
+                request = connection.next_request()
+                if request is None:
+                    break
+                session.requests += 1
+                request_id.set(f"{session.connection_id}.{session.requests}")
+                self.measure_request(connection, request, received, sent)
+                if connection.compression is not None:
+                    self.record_compression(request["op"], connection.compression)
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug("Privileges: %s", privileges.stats())
 
-            if stable_uid in all_cards:
-                if card.get("last_modified", 0) > all_cards[stable_uid].get("last_modified", 0):
-                    all_cards[stable_uid] = card
-                    updated_count += 1
+        except Exception as e:
+            self.log_closing(e)
+        session.close()
+
+    @staticmethod
+    def record_compression(op, stats):
+        logger.debug("Compression: %s", stats)
+        labels = {"codec": stats.codec.name, "direction": "upload" if op == "0" else "download"}
+        compression_raw_bytes.inc(stats.raw_bytes, **labels)
+        compression_wire_bytes.inc(stats.wire_bytes, **labels)
+        cpu_time, stats.reported_cpu_time = stats.cpu_time - stats.reported_cpu_time, stats.cpu_time
+        compression_cpu.inc(cpu_time, **labels)
+
+    @staticmethod
+    def log_closing(error):
+        if isinstance(error, DeadlineExceeded):
+            logger.warning("Closing connection: %s", error)
+        else:
+            logger.error("Error: %s", error)
+
+    @staticmethod
+    def close_idle(session):
+        logger.debug("Closing connection %s, idle for too long", session.connection_id)
+        session.close()
+
+    def measure_request(self, connection, request, received, sent):
+        """handle_request() recording its latency, errors and bytes in the metrics"""
+        conn = connection.conn
+        op = request["op"] if request["op"] in OPS else "invalid"
+        deck_code = request.get("deck_code")
+        start = time.perf_counter()
+        turn = fair_scheduler.turn(request.get("username"), self.estimate_cost(op, deck_code),
+                                   on_wait=lambda waited: schedule_wait.observe(waited, op=op))
+        try:
+            with request_profiler.profile(op, deck_code):
+                self.handle_request(connection, request, turn)
+        except Exception:
+            request_errors.inc(op=op)
+            raise
+        finally:
+            request_latency.observe(time.perf_counter() - start, op=op)
+            request_bytes.inc(conn.bytes_received - received, op=op)
+            response_bytes.inc(conn.bytes_sent - sent, op=op)
+            moved = conn.bytes_received - received + conn.bytes_sent - sent
+            turn.charge(moved)
+            request_costs.record(op, deck_code, moved)
+
+    @staticmethod
+    def estimate_cost(op, deck_code):
+        """Bytes the request is expected to move, the size of the cached deck for a full download"""
+        if op == "2":
+            cached = deck_cache.peek_bytes(deck_code)
+            if cached is not None:
+                return REQUEST_COST + cached
+        return request_costs.estimate(op, deck_code)
+
+    def pull_response(self, connection, op, deck_code, version, bucket, retrieve):
+        """
+        Encoded response of a pull on a deck version. Pulls with the same op, deck version, cursor
+        bucket and wire codec get the same response: from the response cache, or retrieved and
+        encoded once for all of them while they are in flight. Responses over
+        MAX_SHARED_RESPONSE_BYTES are neither cached nor shared, each pull streams its own.
+        retrieve() returns (meta, cards), the result is a (meta, EncodedCards) pair.
+        """
+        codec = connection.codec
+        variant = (op, bucket, codec.name if codec else None)
+        response = response_cache.get(deck_code, version, variant)
+        if response is not None:
+            cached_pulls.inc(op=op)
+            return response
+
+        (meta, encoded), shared = pull_flights.do(
+            (deck_code, version, variant), lambda: self.encode_pull(deck_code, version, variant, retrieve, codec))
+        if shared and not encoded.complete:
+            # Only the pull that encoded it can send the rest of a big response
+            meta, cards = retrieve()
+            encoded = EncodedCards(cards, codec, MAX_SHARED_RESPONSE_BYTES)
+            shared = False
+        if shared:
+            coalesced_pulls.inc(op=op)
+            coalesced_bytes.inc(encoded.size, op=op)
+        else:
+            encoded_pulls.inc(op=op)
+        return meta, encoded
+
+    @staticmethod
+    def encode_pull(deck_code, version, variant, retrieve, codec):
+        meta, cards = retrieve()
+        encoded = EncodedCards(cards, codec, MAX_SHARED_RESPONSE_BYTES)
+        if encoded.complete:
+            response_cache.put(deck_code, version, variant, (meta, encoded), encoded.size)
+        return meta, encoded
+
+    def handle_request(self, connection, request, turn):
+        """
+        Answer one request. The fair scheduler slot of the request is only held between
+        reading the request body and sending the response, see Turn.hold().
+        """
+        username = request["username"]
+        deck_code = request["deck_code"]
+
+        match request["op"]:
+            case "0":
+                logger.debug("User %s is pushing cards to deck %s", username, deck_code)
+                deck_name = request["deck_name"]
+
+                if not self.store.exists(deck_code):
+                    logger.info("Creating new deck %s", deck_code)
+                    connection.send_status(True)
+                    self.add_cards(connection, deck_code, True, turn)
+                    new_deck_local(deck_name, deck_code)
+                    save_deck_user_privilege(username, deck_code, "c")
+
+                elif check_for_privilege(username, deck_code, ["c", "m", "w"]):
+                    logger.debug("Privilege found, sending ok")
+                    connection.send_status(True)
+                    self.add_cards(connection, deck_code, False, turn)
+
+                else:
+                    logger.info("User %s can't push to deck %s, sending fail", username, deck_code)
+                    connection.send_status(False)
+
+            case "1":
+                logger.debug("User %s is pulling the cards of deck %s by timestamp", username, deck_code)
+
+                if check_for_privilege(username, deck_code, ["c", "m", "w", "r"]):
+                    logger.debug("Privilege found, sending ok")
+                    connection.send_status(True)
+                    timestamp = int(connection.read_argument("timestamp"))
+                    if PULL_TIMESTAMP_BUCKET:
+                        # The client skips the cards it already has, rounding down only makes identical pulls
+                        timestamp -= timestamp % PULL_TIMESTAMP_BUCKET
+                    with turn.hold():
+                        _, encoded = self.timestamp_response(connection, deck_code, timestamp)
+                    sent = connection.send_encoded(encoded)
+                    logger.info("Sent %s cards of deck %s modified after %s", sent, deck_code, timestamp)
+                    if logger.isEnabledFor(logging.DEBUG):
+                        logger.debug("Deck cache: %s", deck_cache.stats())
+
+                else:
+                    logger.info("User %s can't read deck %s, sending fail", username, deck_code)
+                    connection.send_status(False)
+
+            case "3":
+                logger.debug("User %s is pulling the cards of deck %s by sequence number", username, deck_code)
+
+                if check_for_privilege(username, deck_code, ["c", "m", "w", "r"]):
+                    logger.debug("Privilege found, sending ok")
+                    connection.send_status(True)
+                    since_seq = int(connection.read_argument("since_seq"))
+                    with turn.hold():
+                        high_seq, encoded = self.seq_response(connection, deck_code, since_seq)
+                    connection.send_meta("high_seq", high_seq)
+                    sent = connection.send_encoded(encoded)
+                    logger.info("Sent %s cards of deck %s up to sequence number %s", sent, deck_code, high_seq)
+                    if logger.isEnabledFor(logging.DEBUG):
+                        logger.debug("Deck cache: %s", deck_cache.stats())
+
+                else:
+                    logger.info("User %s can't read deck %s, sending fail", username, deck_code)
+                    connection.send_status(False)
+
+            case "2":
+                logger.debug("User %s is downloading deck %s", username, deck_code)
+
+                if check_for_privilege(username, deck_code, ["c", "m", "w", "r"]):
+                    logger.debug("Privilege found, sending ok")
+                    connection.send_status(True)
+                    deck_name = retrieve_deck_name(deck_code)
+                    connection.send_meta("deck_name", deck_name)
+                    sent = self.send_deck(connection, deck_code, turn)
+                    logger.info("Sent the whole deck %s, %s cards", deck_code, sent)
+                    if logger.isEnabledFor(logging.DEBUG):
+                        logger.debug("Deck cache: %s", deck_cache.stats())
+
+                else:
+                    logger.info("User %s can't read deck %s, sending fail", username, deck_code)
+                    connection.send_status(False)
+
+            case _:
+                logger.warning("Invalid op %r", request["op"])
+                raise ProtocolError(f"Invalid op {request['op']!r}")
+
+    def add_cards(self, connection, deck_code, new, turn):
+        try:
+            cards = connection.read_cards()
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Offload: %s", payload_pool.stats())
+            if new:
+                self.create_deck(deck_code, cards, turn)
             else:
-                all_cards[stable_uid] = card
-                new_count += 1
-
-        with open(self.json_file, "w") as outfile:
-            json.dump(all_cards, outfile, indent=4)
-
-        print(f"JSON updated: {new_count} new cards, {updated_count} cards updated")
-
-    def create_deck(self, new_cards):
-        all_cards = {}
+                self.save_cards_to_json(deck_code, cards, turn)
+            logger.debug("Sending success response (1)")
+            connection.send_status(True)
 
-        for card in new_cards:
-            stable_uid = str(card.get("stable_uid", ""))
-
-            if not stable_uid:
+        except DeadlineExceeded:
+            # The rest of the upload is still on the way, the connection can't be reused
+            raise
+        except Exception as e:
+            logger.error("Push to deck %s failed, sending error response (0): %s", deck_code, e)
+            push_failures.inc()
+            connection.send_status(False)
+
+    @staticmethod
+    def assign_stable_uids(cards):
+        for card in cards:
+            if not str(card.get("stable_uid", "")):
                 card["stable_uid"] = generate_stable_uid()
-                stable_uid = card["stable_uid"]
-
-            all_cards[stable_uid] = card
-
-        with open(self.json_file, "w") as outfile:
-            json.dump(all_cards, outfile, indent=4)
-
-        print(f"JSON created: {len(new_cards)} new cards")
-
-    def retrieve_cards_from_json(self, timestamp):
-        """Retrieve the newer/updated cards from JSON file based on the timestamp introduced as parameter."""
-        cards = {}
-        try:
-            with open(self.json_file, "r") as infile:
-                cards = json.load(infile)
-            print(f"Loaded {len(cards)} existing cards from {self.json_file}")
-        except json.JSONDecodeError:
-            print(f"Error reading {self.json_file}, will create a new file")
-
-        return {k: v for k, v in cards.items() if v["last_modified"] > timestamp}
-
-    def send_size_and_package_server(self, conn, info):
-        """Send data size followed by data"""
-        if not isinstance(info, str):
-            info = str(info)
-
-        info_encoded = info.encode("utf-8")
-        info_length = str(len(info_encoded)).encode("utf-8")
-        info_length += b' ' * (self.HEADER - len(info_length))
-        conn.sendall(info_length)
-        conn.sendall(info_encoded)
-
+        return cards
+
+    def save_cards_to_json(self, deck_code, new_cards, turn=None):
+        """
+        Save cards to the deck store, merging with existing data if the deck exists. Only the
+        push leading the group commit takes its fair scheduler slot, for the commit itself, the
+        pushes waiting for it don't hold one.
+        """
+        def commit(deck_code, pushes):
+            with held(turn):
+                self.commit_pushes(deck_code, pushes)
+
+        group_commits.submit(deck_code, self.assign_stable_uids(new_cards), commit)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Group commit: %s, syncs: %s", group_commits.stats(), sync_latency.stats())
+
+    def commit_pushes(self, deck_code, pushes):
+        if len(pushes) > 1:
+            logger.debug("Committing %s pushes to deck %s together", len(pushes), deck_code)
+        self.merge_cards(deck_code, [card for cards in pushes for card in cards])
+
+    def merge_cards(self, deck_code, new_cards):
+        """Merge a push and publish the new snapshot of the deck, the deck writer lock is held"""
+        base_version = self.store.version(deck_code)
+        with storage_latency.time(operation="merge"):
+            accepted, new_count, updated_count = self.store.merge(deck_code, self.assign_stable_uids(new_cards))
+        deck_cache.apply(deck_code, base_version, self.store.version(deck_code), accepted)
+        self.count_cards(len(new_cards), new_count, updated_count)
+        logger.info("Deck %s updated: %s new cards, %s cards updated", deck_code, new_count, updated_count)
+
+    def create_deck(self, deck_code, new_cards, turn=None):
+        # The slot is taken with the writer lock held, like group commits do
+        with deck_writers(deck_code), held(turn):
+            if self.store.exists(deck_code):
+                # Another push created the deck after this one checked, merge instead of replacing it
+                logger.info("Deck %s was created by another push, merging", deck_code)
+                self.merge_cards(deck_code, new_cards)
+                return
+
+            with storage_latency.time(operation="create"):
+                created = self.store.create(deck_code, self.assign_stable_uids(new_cards))
+            deck_cache.invalidate(deck_code)
+        self.count_cards(len(new_cards), created, 0)
+        logger.info("Deck %s created: %s new cards", deck_code, created)
+
+    @staticmethod
+    def count_cards(received, new, updated):
+        cards_pushed.inc(received, outcome="received")
+        cards_pushed.inc(new, outcome="new")
+        cards_pushed.inc(updated, outcome="updated")
+        cards_pushed.inc(received - new - updated, outcome="skipped")
+
+    def load_deck(self, deck_code):
+        """Return the CachedDeck of a deck from the deck cache, loading it from the store on a miss"""
+        version = self.store.version(deck_code)
+        return deck_cache.get(deck_code, version) or self.read_deck(deck_code, version)
+
+    def read_deck(self, deck_code, version):
+        """Load a deck missing from the deck cache and cache it"""
+        with storage_latency.time(operation="load"):
+            cards = self.store.load(deck_code)
+        if self.store.version(deck_code) == version:
+            deck = deck_cache.put(deck_code, version, cards)
+        else:
+            # A push landed during the load, caching it would only be dropped by the push
+            deck = CachedDeck(version, cards)
+        logger.debug("Loaded %s existing cards of deck %s", len(cards), deck_code)
+        return deck
+
+    def timestamp_pull(self, deck_code, timestamp):
+        """
+        (deck version, cursor bucket, retrieve) of a pull by timestamp, see pull_response().
+        A deck missing from the deck cache is answered by a range query when the store has an
+        index for it, without loading the whole deck.
+        """
+        version = self.store.version(deck_code)
+        deck = deck_cache.get(deck_code, version)
+        if deck is None and self.store.indexed_retrieve:
+            def retrieve():
+                with storage_latency.time(operation="retrieve"):
+                    return None, self.store.retrieve(deck_code, timestamp)
+            # Exact timestamps, cached decks bucket them by their cards
+            return version, ("since", timestamp), retrieve
+
+        if deck is None:
+            deck = self.read_deck(deck_code, version)
+        return deck.version, deck.timestamp_bucket(timestamp), lambda: (None, deck.modified_since(timestamp))
+
+    def timestamp_response(self, connection, deck_code, timestamp):
+        """(None, EncodedCards) answering a pull by timestamp, see pull_response()"""
+        version, bucket, retrieve = self.timestamp_pull(deck_code, timestamp)
+        return self.pull_response(connection, "1", deck_code, version, bucket, retrieve)
+
+    def seq_response(self, connection, deck_code, since_seq):
+        """(high_seq, EncodedCards) answering a pull by sequence number, see pull_response()"""
+        deck = self.load_deck(deck_code)
+        return self.pull_response(connection, "3", deck_code, deck.version, deck.seq_index.bucket(since_seq),
+                                  lambda: deck.changes_since(since_seq)[::-1])
+
+    def cached_deck_response(self, connection, deck_code, version):
+        """EncodedCards of the full download of a cached deck version, None when it isn't cached"""
+        deck = deck_cache.get(deck_code, version)
+        if deck is None:
+            return None
+        return self.pull_response(connection, "2", deck_code, version, None, lambda: (None, deck.cards))[1]
+
+    def retrieve_cards_from_json(self, deck_code, timestamp):
+        """Retrieve the newer/updated cards of the deck based on the timestamp introduced as parameter."""
+        _, _, retrieve = self.timestamp_pull(deck_code, timestamp)
+        return retrieve()[1]
+
+    def send_deck(self, connection, deck_code, turn):
+        """
+        Send a whole deck, from the snapshot file of its version when snapshots are on.
+        Otherwise cached decks are sent from the response cache, or encoded once for all the
+        downloads in flight, others are streamed from the store so a big deck is never held
+        in memory. The slot is held while the snapshot or response is built. A streamed deck
+        is read and encoded in the slot one batch at a time, see Turn.iterate().
+        """
+        version = self.store.version(deck_code)
+        if self.snapshots is not None:
+            def write(file):
+                snapshot_builds.inc()
+                return connection.write_cards(self.iter_deck_cards(deck_code), file)
+
+            with turn.hold():
+                snapshot = self.snapshots.get(deck_code, version, connection.snapshot_variant, write)
+            try:
+                with open(snapshot.path, "rb") as file:
+                    connection.send_file(file, snapshot.compression)
+                snapshot_sends.inc()
+                return snapshot.count
+            except FileNotFoundError:
+                # A newer version replaced it since, send what the store holds now
+                return connection.send_cards(self.iter_deck_cards(deck_code), pace=turn.iterate)
+
+        with turn.hold():
+            encoded = self.cached_deck_response(connection, deck_code, version)
+        if encoded is None:
+            return connection.send_cards(self.store.iter_cards(deck_code), pace=turn.iterate)
+        return connection.send_encoded(encoded)
+
+    def iter_deck_cards(self, deck_code):
+        """
+        Iterate every card of a deck for a full download. Cached decks are served from memory,
+        otherwise the cards are streamed from the store without filling the cache.
+        """
+        deck = deck_cache.get(deck_code, self.store.version(deck_code))
+        if deck is not None:
+            return iter(deck.cards.items())
+        return self.store.iter_cards(deck_code)
+
+    def retrieve_cards_since_seq(self, deck_code, since_seq):
+        """Retrieve the cards written after the sequence number, returns (cards, high-water mark)"""
+        return self.load_deck(deck_code).changes_since(since_seq)
 
 
 if __name__ == "__main__":
+    setup_logging()
     server = Server()
@@ -0,0 +1,54 @@
+import threading
+
+
+class Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Concurrent calls with the same key share a single execution: the first caller runs the
+    function, the callers arriving while it runs wait for it and get the same result, or the
+    same exception. Nothing is kept once the call returns.
+    """
+
+    def __init__(self):
+        self.leaders = 0
+        self.followers = 0
+
+        self._lock = threading.Lock()
+        self._flights = {}
+
+    def do(self, key, fn):
+        """Returns (fn(), shared), shared is True when another caller ran fn"""
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = Flight()
+                self.leaders += 1
+            else:
+                self.followers += 1
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result, True
+
+        try:
+            flight.result = fn()
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+        return flight.result, False
+
+    def stats(self):
+        return {"leaders": self.leaders, "followers": self.followers, "in_flight": len(self._flights)}
@@ -0,0 +1,111 @@
+import glob
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+
+from single_flight import SingleFlight
+
+logger = logging.getLogger("snapshots")
+
+
+class Snapshot:
+    """Immutable file holding the exact bytes of the full download of one deck version"""
+
+    def __init__(self, path, version, count, size, compression):
+        self.path = path
+        self.version = version
+        self.count = count
+        self.size = size
+        self.compression = compression
+
+
+class SnapshotStore:
+    """
+    Full deck downloads written once per deck version and wire variant (protocol and codec),
+    already framed and compressed, so every download of that version is a sendfile of the
+    file. A snapshot is built by the first download after a write, under a temporary name
+    renamed once complete. Building one drops the files of the older versions of the deck,
+    downloads still sending them keep their open file.
+
+    Files are named after the process that wrote them and a store only ever reads or removes
+    its own, so processes sharing the directory don't touch each other's snapshots. Deck
+    versions don't all survive a restart, close() removes the files when the server stops.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.builds = 0
+        self.prefix = f"{os.getpid()}-"
+
+        self._lock = threading.Lock()
+        # deck_code: {variant: Snapshot}
+        self._decks = {}
+        self._flights = SingleFlight()
+
+        os.makedirs(directory, exist_ok=True)
+        # Left by a process that had the same pid and didn't stop cleanly
+        self._remove_files()
+
+    def get(self, deck_code, version, variant, write):
+        """
+        The snapshot of a deck version for a wire variant, built with write(file) on a miss.
+        write returns (cards written, compression stats).
+        """
+        with self._lock:
+            snapshot = self._decks.get(deck_code, {}).get(variant)
+        if snapshot is not None and snapshot.version == version:
+            return snapshot
+
+        snapshot, _ = self._flights.do((deck_code, version, variant),
+                                       lambda: self._build(deck_code, version, variant, write))
+        return snapshot
+
+    def _build(self, deck_code, version, variant, write):
+        name = hashlib.sha1(repr((deck_code, version, variant)).encode("utf-8")).hexdigest()
+        path = os.path.join(self.directory, f"{self.prefix}{name}.snapshot")
+        fd, temporary = tempfile.mkstemp(dir=self.directory, prefix=self.prefix, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as file:
+                count, compression = write(file)
+            os.replace(temporary, path)
+        except BaseException:
+            os.unlink(temporary)
+            raise
+
+        snapshot = Snapshot(path, version, count, os.path.getsize(path), compression)
+        with self._lock:
+            self.builds += 1
+            snapshots = self._decks.setdefault(deck_code, {})
+            stale = [other for other in snapshots.values() if other.version != version]
+            if stale:
+                snapshots.clear()
+            snapshots[variant] = snapshot
+
+        for other in stale:
+            try:
+                os.unlink(other.path)
+            except FileNotFoundError:
+                pass
+        logger.debug("Built the %s snapshot of deck %s: %s cards, %s bytes", variant, deck_code, count, snapshot.size)
+        return snapshot
+
+    def close(self):
+        """Forget every snapshot and remove the files of this store"""
+        with self._lock:
+            self._decks.clear()
+        self._remove_files()
+
+    def _remove_files(self):
+        for pattern in ("*.snapshot", "*.tmp"):
+            for path in glob.glob(os.path.join(glob.escape(self.directory), glob.escape(self.prefix) + pattern)):
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+
+    def stats(self):
+        with self._lock:
+            snapshots = [snapshot for variants in self._decks.values() for snapshot in variants.values()]
+        return {"snapshots": len(snapshots), "bytes": sum(s.size for s in snapshots), "builds": self.builds}
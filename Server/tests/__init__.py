@@ -0,0 +1,20 @@
+"""
+Tests of the socket server. Run them from the Server directory with:
+    python -m unittest
+"""
+import os
+import sys
+import time
+
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, SERVER_DIR)
+sys.path.append(os.path.dirname(SERVER_DIR))
+
+
+def wait_until(condition, timeout=5):
+    """Poll condition() until it is true, fails the test after timeout seconds"""
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError("condition not met in time")
+        time.sleep(0.001)
@@ -0,0 +1,75 @@
+import importlib
+import json
+import os
+import sys
+import types
+import unittest
+
+from tests import SERVER_DIR
+from DataManagement import cards_management
+
+
+def load_addon_protocol():
+    """
+    The add-on's protocol module, which has its own copy of the decoder. The package __init__
+    starts the add-on inside Anki, so the package is set up without running it.
+    """
+    if "card_sync_server" not in sys.modules:
+        package = types.ModuleType("card_sync_server")
+        package.__path__ = [os.path.join(os.path.dirname(SERVER_DIR), "card_sync_server")]
+        sys.modules["card_sync_server"] = package
+    return importlib.import_module("card_sync_server.protocol")
+
+
+class CardStreamDecoderTest(unittest.TestCase):
+    module = cards_management
+    cards = [{"stable_uid": f"uid{i}", "front": 'say "hi" \\ {[,]} é', "tags": [1, None, {"a": []}]}
+             for i in range(5)]
+
+    def decode(self, payload, size):
+        decoder = self.module.CardStreamDecoder()
+        items = []
+        for start in range(0, len(payload), size):
+            items.extend(decoder.feed(payload[start:start + size]))
+        items.extend(decoder.feed(b"", final=True))
+        return decoder.container, items
+
+    def test_array_in_any_chunk_size(self):
+        payload = json.dumps(self.cards).encode("utf-8")
+        for size in (1, 2, 7, 64, len(payload)):
+            self.assertEqual(self.decode(payload, size), (list, [(None, card) for card in self.cards]))
+
+    def test_object_in_any_chunk_size(self):
+        payload = json.dumps({card["stable_uid"]: card for card in self.cards}, indent=2).encode("utf-8")
+        for size in (1, 3, 64, len(payload)):
+            self.assertEqual(self.decode(payload, size),
+                             (dict, [(card["stable_uid"], card) for card in self.cards]))
+
+    def test_card_spread_over_many_chunks(self):
+        card = {"stable_uid": "big", "front": "word \\\"quoted\\\" " * 50000}
+        self.assertEqual(self.decode(json.dumps([card, card]).encode("utf-8"), 1024), (list, [(None, card)] * 2))
+
+    def test_empty_containers(self):
+        self.assertEqual(self.decode(b" [ ] \n", 1), (list, []))
+        self.assertEqual(self.decode(b"{}", 1), (dict, []))
+
+    def test_malformed_payloads(self):
+        for payload in (b"[1,,2]", b"[1,]", b"[1 2]", b'{"a" 1}', b"[{]}]", b"[1}", b"[1", b"x",
+                        b"[1] x", b"[] []", b'{"a": 1}}'):
+            for size in (1, len(payload)):
+                with self.assertRaises(ValueError, msg=payload):
+                    self.decode(payload, size)
+
+    def test_decode_cards(self):
+        self.assertEqual(self.module.decode_cards([b'{"a": ', b'{"front": 1}}']), {"a": {"front": 1}})
+        self.assertIsNone(self.module.decode_cards([b""]))
+        with self.assertRaises(ValueError):
+            self.module.decode_cards([b"[1] x"])
+
+
+class AddonCardStreamDecoderTest(CardStreamDecoderTest):
+    module = load_addon_protocol()
+
+
+if __name__ == "__main__":
+    unittest.main()
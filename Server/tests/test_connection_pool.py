@@ -0,0 +1,93 @@
+import socket
+import threading
+import time
+import unittest
+
+from tests import wait_until
+from connection_pool import ConnectionPool, readable
+
+
+class ConnectionPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.handled = []
+        self.rejected = []
+        self.closed = []
+
+    def start(self, pool, handle=None):
+        pool.start(handle or (lambda conn, waited: self.handled.append(conn)),
+                   lambda conn, reason: self.rejected.append((conn, reason)),
+                   self.closed.append)
+        return pool
+
+    def socketpair(self):
+        client, server = socket.socketpair()
+        self.addCleanup(client.close)
+        self.addCleanup(server.close)
+        return client, server
+
+    def test_workers_serve_submitted_connections(self):
+        pool = self.start(ConnectionPool(workers=2))
+        for conn in ("a", "b", "c"):
+            self.assertTrue(pool.submit(conn))
+        wait_until(lambda: len(self.handled) == 3)
+        self.assertCountEqual(self.handled, ["a", "b", "c"])
+        self.assertEqual(self.rejected, [])
+
+    def test_full_queue_rejects(self):
+        # No workers, connections stay queued
+        pool = self.start(ConnectionPool(workers=0, queue_size=2))
+        self.assertTrue(pool.submit("a"))
+        self.assertTrue(pool.submit("b"))
+        self.assertFalse(pool.submit("c"))
+        self.assertEqual(self.rejected, [("c", "queue_full")])
+        self.assertEqual(pool.pending, 2)
+
+    def test_shed_rejects_connections_queued_too_long(self):
+        pool = self.start(ConnectionPool(workers=0, max_wait=0.05))
+        pool.submit("old")
+        time.sleep(0.1)
+        pool.submit("new")
+        pool.shed()
+        self.assertEqual(self.rejected, [("old", "queue_timeout")])
+        self.assertEqual(pool.pending, 1)
+
+    def test_busy_counts_the_workers_serving(self):
+        release = threading.Event()
+        pool = self.start(ConnectionPool(workers=2), handle=lambda conn, waited: release.wait(5))
+        pool.submit("a")
+        wait_until(lambda: pool.busy == 1)
+        release.set()
+        wait_until(lambda: pool.busy == 0)
+
+    def test_parked_connection_comes_back_when_its_client_sends(self):
+        pool = self.start(ConnectionPool(workers=1))
+        client, server = self.socketpair()
+        pool.park(server)
+        wait_until(lambda: pool.parked == 1)
+        self.assertFalse(readable(server))
+
+        client.sendall(b"3")
+        wait_until(lambda: self.handled == [server])
+        self.assertTrue(readable(server))
+        self.assertEqual(pool.parked, 0)
+        self.assertEqual(self.closed, [])
+
+    def test_parked_connection_comes_back_when_its_client_hangs_up(self):
+        pool = self.start(ConnectionPool(workers=1))
+        client, server = self.socketpair()
+        pool.park(server)
+        wait_until(lambda: pool.parked == 1)
+        client.close()
+        wait_until(lambda: self.handled == [server])
+
+    def test_idle_parked_connection_is_closed(self):
+        pool = self.start(ConnectionPool(workers=1, idle_timeout=0.05))
+        _, server = self.socketpair()
+        pool.park(server)
+        wait_until(lambda: self.closed == [server])
+        self.assertEqual(pool.parked, 0)
+        self.assertEqual(self.handled, [])
+
+
+if __name__ == "__main__":
+    unittest.main()
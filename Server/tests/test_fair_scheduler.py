@@ -0,0 +1,100 @@
+import threading
+import unittest
+
+from tests import wait_until
+from fair_scheduler import FairScheduler, REQUEST_COST
+
+
+class FairSchedulerTest(unittest.TestCase):
+    def test_cheapest_waiting_request_goes_first(self):
+        scheduler = FairScheduler(slots=1)
+        order = []
+
+        def request(user, cost):
+            with scheduler.slot(user, cost):
+                order.append(user)
+
+        with scheduler.slot("running", 10):
+            heavy = threading.Thread(target=request, args=("heavy", 10 * 1024 * 1024))
+            heavy.start()
+            wait_until(lambda: scheduler.waiting == 1)
+            light = threading.Thread(target=request, args=("light", 1024))
+            light.start()
+            wait_until(lambda: scheduler.waiting == 2)
+
+        heavy.join()
+        light.join()
+        self.assertEqual(order, ["light", "heavy"])
+        self.assertEqual(scheduler.stats(), {"slots": 1, "running": 0, "waiting": 0, "waited": 2})
+
+    def test_heavy_user_only_delays_their_own_requests(self):
+        scheduler = FairScheduler(slots=1)
+        order = []
+
+        def request(user):
+            with scheduler.slot(user, 1000):
+                order.append(user)
+
+        with scheduler.slot("running", 10):
+            threads = []
+            for number, user in enumerate(["heavy", "heavy", "heavy", "light"], start=1):
+                thread = threading.Thread(target=request, args=(user,))
+                thread.start()
+                threads.append(thread)
+                wait_until(lambda: scheduler.waiting == number)
+
+        for thread in threads:
+            thread.join()
+        self.assertEqual(order, ["heavy", "light", "heavy", "heavy"])
+
+    def test_charge_replaces_the_estimate(self):
+        scheduler = FairScheduler(slots=1)
+        with scheduler.slot("user", 100) as ticket:
+            self.assertEqual(ticket.finish, 100)
+            scheduler.charge(ticket, 5000)
+        with scheduler.slot("user", 100) as ticket:
+            self.assertEqual(ticket.finish, REQUEST_COST + 5000 + 100)
+
+    def test_weight_divides_the_cost(self):
+        scheduler = FairScheduler(slots=1, weights={"premium": 4.0})
+        with scheduler.slot("premium", 1000) as ticket:
+            self.assertEqual(ticket.finish, 250)
+
+    def test_disabled_scheduler_never_waits(self):
+        scheduler = FairScheduler(slots=0)
+        with scheduler.slot("user", 100) as outer, scheduler.slot("user", 100) as inner:
+            self.assertIsNone(outer)
+            self.assertIsNone(inner)
+        turn = scheduler.turn("user", 100)
+        with turn.hold():
+            pass
+        turn.charge(1000)
+        self.assertEqual(scheduler.stats()["waited"], 0)
+
+    def test_turn_reports_its_wait_and_charges_its_ticket(self):
+        scheduler = FairScheduler(slots=1)
+        waits = []
+        turn = scheduler.turn("user", 100, on_wait=waits.append)
+        # A turn that never held a slot costs nothing
+        turn.charge(1000)
+        with turn.hold() as ticket:
+            self.assertIs(turn.ticket, ticket)
+        turn.charge(0)
+        self.assertEqual(len(waits), 1)
+        with scheduler.slot("user", 100) as ticket:
+            self.assertEqual(ticket.finish, REQUEST_COST + 100)
+
+    def test_turn_held_twice_counts_its_cost_once(self):
+        scheduler = FairScheduler(slots=1)
+        turn = scheduler.turn("user", 100)
+        with turn.hold():
+            pass
+        with turn.hold() as ticket:
+            self.assertEqual(ticket.finish, 100)
+        turn.charge(5000)
+        with scheduler.slot("user", 100) as ticket:
+            self.assertEqual(ticket.finish, REQUEST_COST + 5000 + 100)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,89 @@
+import os
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+import deck_store
+from tests import wait_until
+from deck_store import DeckLocks, LogDeckStore
+from group_commit import GroupCommitter
+
+
+def card(uid, modified=1):
+    return {"stable_uid": uid, "last_modified": modified, "front": uid}
+
+
+class GroupCommitTest(unittest.TestCase):
+    def setUp(self):
+        decks_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(decks_dir.cleanup)
+        self.store = LogDeckStore(decks_dir.name)
+        self.store.create("deck", {})
+        self.locks = DeckLocks()
+        self.committer = GroupCommitter(self.locks, window=0)
+        self.commits = []
+
+    def commit(self, deck_code, pushes):
+        self.commits.append(len(pushes))
+        self.store.merge(deck_code, [card for cards in pushes for card in cards])
+
+    def submit_together(self, pushes):
+        """Submit the pushes so they all join one batch, returns the error or None of each"""
+        errors = [None] * len(pushes)
+
+        def submit(position):
+            try:
+                self.committer.submit("deck", pushes[position], self.commit)
+            except Exception as e:
+                errors[position] = e
+
+        threads = [threading.Thread(target=submit, args=(position,)) for position in range(len(pushes))]
+        # The leader waits for the deck lock while the other pushes join its batch
+        with self.locks("deck"):
+            for thread in threads:
+                thread.start()
+            wait_until(lambda: self.committer.waiting == len(pushes))
+        for thread in threads:
+            thread.join()
+        return errors
+
+    def test_pushes_are_committed_together(self):
+        self.assertEqual(self.submit_together([[card("a")], [card("b")], [card("c")]]), [None] * 3)
+        self.assertEqual(self.commits, [3])
+        self.assertEqual(sorted(self.store.load("deck")), ["a", "b", "c"])
+
+    def test_bad_push_only_fails_itself(self):
+        errors = self.submit_together([[card("a")], [{"front": "no uid"}], [card("c")]])
+        self.assertIsNone(errors[0])
+        self.assertIsInstance(errors[1], KeyError)
+        self.assertIsNone(errors[2])
+        self.assertEqual(sorted(self.store.load("deck")), ["a", "c"])
+
+    def test_failed_batch_leaves_no_trace_before_the_retry(self):
+        fsync_file = deck_store.fsync_file
+        calls = []
+
+        def fail_first_sync(outfile):
+            calls.append(outfile)
+            if len(calls) == 1:
+                raise OSError("disk full")
+            fsync_file(outfile)
+
+        with mock.patch("deck_store.fsync_file", fail_first_sync):
+            errors = self.submit_together([[card("a")], [card("b")]])
+
+        self.assertEqual(errors, [None, None])
+        self.assertEqual(self.commits, [2, 1, 1])
+        cards = self.store.load("deck")
+        self.assertEqual({uid: cards[uid]["seq"] for uid in cards}, {"a": 1, "b": 2})
+        # Only the retried appends are in the log
+        segments = self.store.list_segments("deck")
+        with open(self.store.segment_path("deck", segments[-1]), "rb") as segment:
+            self.assertEqual(len(segment.read().splitlines()), 2)
+        self.assertEqual(self.store.version("deck")[1],
+                         sum(os.path.getsize(self.store.segment_path("deck", n)) for n in segments))
+
+
+if __name__ == "__main__":
+    unittest.main()
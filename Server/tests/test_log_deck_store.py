@@ -0,0 +1,57 @@
+import tempfile
+import threading
+import unittest
+
+from deck_store import LogDeckStore
+
+
+def card(uid, modified, front):
+    return {"stable_uid": uid, "last_modified": modified, "front": front}
+
+
+class LogDeckStoreTest(unittest.TestCase):
+    def setUp(self):
+        decks_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(decks_dir.cleanup)
+        self.store = LogDeckStore(decks_dir.name, segment_bytes=100, compact_segments=1000)
+        self.store.create("deck", {})
+
+    def test_load_does_not_wait_for_the_deck_lock(self):
+        self.store.merge("deck", [card("a", 1, "a")])
+        loaded = []
+        with self.store._deck_lock("deck"):
+            reader = threading.Thread(target=lambda: loaded.append(self.store.load("deck")))
+            reader.start()
+            reader.join(5)
+            self.assertEqual([sorted(cards) for cards in loaded], [["a"]])
+
+    def test_load_during_compactions_sees_every_committed_card(self):
+        for modified in range(1, 21):
+            self.store.merge("deck", [card(uid, modified, f"{uid}{modified}") for uid in "abc"])
+
+        committed = [20]
+        stop = threading.Event()
+
+        def write():
+            while not stop.is_set():
+                modified = committed[0] + 1
+                self.store.merge("deck", [card("a", modified, f"a{modified}")])
+                committed[0] = modified
+                self.store.compact("deck")
+
+        writer = threading.Thread(target=write)
+        writer.start()
+        try:
+            while committed[0] < 500:
+                floor = committed[0]
+                cards = self.store.load("deck")
+                self.assertEqual(sorted(cards), ["a", "b", "c"])
+                self.assertEqual(cards["c"]["front"], "c20")
+                self.assertGreaterEqual(cards["a"]["last_modified"], floor)
+        finally:
+            stop.set()
+            writer.join()
+
+
+if __name__ == "__main__":
+    unittest.main()
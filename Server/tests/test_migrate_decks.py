@@ -0,0 +1,32 @@
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+
+from tests import SERVER_DIR
+from deck_store import SqliteDeckStore
+
+
+class MigrateDecksTest(unittest.TestCase):
+    def test_imports_json_decks_from_the_server_directory(self):
+        with tempfile.TemporaryDirectory() as decks_dir:
+            cards = {uid: {"stable_uid": uid, "last_modified": 1, "front": uid} for uid in ("a", "b")}
+            with open(os.path.join(decks_dir, "deck+one.json"), "w") as deck:
+                json.dump(cards, deck)
+
+            # Run like the README says, so the script has to find DataManagement by itself
+            result = subprocess.run([sys.executable, "migrate_decks.py"], cwd=SERVER_DIR,
+                                    env={**os.environ, "DECKS_DIR": decks_dir},
+                                    capture_output=True, text=True)
+            self.assertEqual(result.returncode, 0, result.stderr)
+            self.assertIn("Imported 1 decks", result.stdout)
+
+            imported = SqliteDeckStore(decks_dir).load("deck+one")
+            self.assertEqual(sorted(imported), ["a", "b"])
+            self.assertEqual(imported["a"]["front"], "a")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,68 @@
+import threading
+import unittest
+
+from tests import wait_until
+from single_flight import SingleFlight
+
+
+class SingleFlightTest(unittest.TestCase):
+    def setUp(self):
+        self.flights = SingleFlight()
+        self.release = threading.Event()
+        self.calls = 0
+
+    def slow(self, result):
+        def fn():
+            self.calls += 1
+            self.release.wait(5)
+            if isinstance(result, Exception):
+                raise result
+            return result
+        return fn
+
+    def follow(self, results, fn):
+        try:
+            results.append(self.flights.do("deck", fn))
+        except Exception as e:
+            results.append(e)
+
+    def test_concurrent_callers_share_one_call(self):
+        results = []
+        leader = threading.Thread(target=self.follow, args=(results, self.slow("cards")))
+        leader.start()
+        wait_until(lambda: self.flights.stats()["in_flight"] == 1)
+        follower = threading.Thread(target=self.follow, args=(results, self.slow("other")))
+        follower.start()
+        wait_until(lambda: self.flights.followers == 1)
+
+        self.release.set()
+        leader.join()
+        follower.join()
+        self.assertEqual(self.calls, 1)
+        self.assertCountEqual(results, [("cards", False), ("cards", True)])
+
+    def test_followers_get_the_same_exception(self):
+        error = ValueError("corrupt deck")
+        results = []
+        leader = threading.Thread(target=self.follow, args=(results, self.slow(error)))
+        leader.start()
+        wait_until(lambda: self.flights.stats()["in_flight"] == 1)
+        follower = threading.Thread(target=self.follow, args=(results, self.slow("other")))
+        follower.start()
+        wait_until(lambda: self.flights.followers == 1)
+
+        self.release.set()
+        leader.join()
+        follower.join()
+        self.assertEqual(results, [error, error])
+        self.assertEqual(self.calls, 1)
+
+    def test_nothing_is_kept_after_the_call(self):
+        self.release.set()
+        self.assertEqual(self.flights.do("deck", self.slow(1)), (1, False))
+        self.assertEqual(self.flights.do("deck", self.slow(2)), (2, False))
+        self.assertEqual(self.flights.stats(), {"leaders": 2, "followers": 0, "in_flight": 0})
+
+
+if __name__ == "__main__":
+    unittest.main()
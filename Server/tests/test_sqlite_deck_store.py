@@ -0,0 +1,36 @@
+import tempfile
+import unittest
+
+from deck_store import SqliteDeckStore
+
+
+def card(uid, modified=1):
+    return {"stable_uid": uid, "last_modified": modified, "front": uid}
+
+
+class SqliteDeckStoreTest(unittest.TestCase):
+    def setUp(self):
+        decks_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(decks_dir.cleanup)
+        self.decks_dir = decks_dir.name
+
+    def test_versions_do_not_repeat_after_a_restart(self):
+        store = SqliteDeckStore(self.decks_dir)
+        store.create("deck", [card("a")])
+        store.merge("deck", [card("b")])
+        seen = {store.version("deck")}
+
+        # A new process opening the same database
+        store = SqliteDeckStore(self.decks_dir)
+        self.assertIn(store.version("deck"), seen)
+        store.merge("deck", [card("c")])
+        self.assertNotIn(store.version("deck"), seen)
+        seen.add(store.version("deck"))
+
+        store.create("deck", [card("d")])
+        self.assertNotIn(store.version("deck"), seen)
+        self.assertEqual(list(store.load("deck")), ["d"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,75 @@
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+from tests import SERVER_DIR
+
+# Loose bounds for a slow CI machine, the server imports in about 60 ms and accepts in well
+# under 200 ms here
+MAX_SECONDS_TO_IMPORT = 1.0
+MAX_SECONDS_TO_ACCEPT = 2.0
+
+
+class StartupTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.env = {
+            **os.environ,
+            "DECKS_DIR": os.path.join(directory.name, "Decks"),
+            "DJANGO_DB_PATH": os.path.join(directory.name, "db.sqlite3"),
+            "AUTH_DB_PATH": os.path.join(directory.name, "db.sqlite3"),
+            "PRIVILEGE_GENERATION_PATH": os.path.join(directory.name, "privilege_generation"),
+            "SNAPSHOT_DIR": os.path.join(directory.name, "Snapshots"),
+            "PROFILE_DIR": os.path.join(directory.name, "profiles"),
+        }
+
+    def test_import_does_not_load_django(self):
+        result = subprocess.run(
+            [sys.executable, "-c",
+             "import sys, server; print(sorted(m for m in sys.modules if m.split('.')[0] in ('django', 'login')))"],
+            cwd=SERVER_DIR, env=self.env, capture_output=True, text=True)
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertEqual(result.stdout.strip(), "[]")
+
+    def test_import_time(self):
+        result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import server"],
+                                cwd=SERVER_DIR, env=self.env, capture_output=True, text=True)
+        self.assertEqual(result.returncode, 0, result.stderr)
+        # Lines of -X importtime are "import time: self [us] | cumulative | imported package"
+        times = {}
+        for line in result.stderr.splitlines():
+            if line.startswith("import time:") and "cumulative" not in line:
+                _, cumulative, name = line[len("import time:"):].split("|")
+                times[name.strip()] = int(cumulative)
+        self.assertLess(times["server"] / 1e6, MAX_SECONDS_TO_IMPORT)
+        self.assertEqual([name for name in times if name.split(".")[0] in ("django", "login")], [])
+
+    def test_accepts_connections_quickly(self):
+        port = random.randint(20000, 40000)
+        start = time.perf_counter()
+        process = subprocess.Popen([sys.executable, "-c", f"from server import Server; Server(port={port})"],
+                                   cwd=SERVER_DIR, env=self.env,
+                                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            while True:
+                elapsed = time.perf_counter() - start
+                self.assertLess(elapsed, MAX_SECONDS_TO_ACCEPT, "server did not accept a connection in time")
+                self.assertIsNone(process.poll(), "server exited during startup")
+                try:
+                    socket.create_connection(("localhost", port), timeout=1).close()
+                    break
+                except OSError:
+                    time.sleep(0.005)
+        finally:
+            process.terminate()
+            process.wait()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,5 +1,4 @@
 import socket
-import json
 import time
 import os
 from aqt import mw
@@ -8,6 +7,13 @@ from aqt.utils import showWarning
 
 from .auth_manager import AuthManager
 from .login_dialog import LoginDialog
+from .protocol import (
+    MAGIC, VERSION, REQUEST, STATUS, META, BYE, CODEC, BUSY, ServerBusy,
+    recv_exactly, send_frame, send_json_frame, expect_frame, send_chunks, split_chunks,
+    iter_message_chunks, recv_chunks, decode_cards
+)
+from . import serializer
+from .compression import available_codecs, compress_stream, decompress_stream, CompressionStats
 from .testAnkiConnected import (
     get_cards_from_deck, sync_card, update_json,
     get_value_from_json, sync_anki, check_for_deck_existence,
@@ -18,7 +24,10 @@ from .testAnkiConnected import (
 
 ADDON_DIR = os.path.dirname(os.path.abspath(__file__))
 SYNC_FILE_PATH = os.path.join(ADDON_DIR, "sync_log.json")
+SYNC_CURSOR_PATH = os.path.join(ADDON_DIR, "sync_cursor.json")
 DECKS_CODES_PATH = os.path.join(ADDON_DIR, "decks_codes.json")
+# Seconds to wait for the answer to the protocol handshake, servers that answer it do so at once
+HANDSHAKE_TIMEOUT = 2
 
 
 class Client(QObject):
@@ -34,6 +43,13 @@ class Client(QObject):
 
         self.auth_manager = AuthManager(ADDON_DIR)
         self.sock = None
+        # Protocol version spoken on the open connection, None until the first one negotiates it
+        self.protocol_version = None
+        # Set once the server has shown it only speaks v1, new connections then skip the handshake
+        self.server_v1_only = False
+        self.reused_connection = False
+        # Compression codec picked by the server for the open connection, None for plain JSON
+        self.codec = None
 
     def ensure_authenticated(self, parent=None):
         """Make sure user is authenticated before performing operations"""
@@ -45,11 +61,14 @@ class Client(QObject):
         return LoginDialog.get_credentials(parent)
 
     def connect_to_server(self):
-        """Connect to the server"""
+        """Connect to the server, reusing the open connection when the server speaks v2"""
+        if self.sock and self.protocol_version >= 2:
+            self.reused_connection = True
+            return True
+
         try:
-            self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.sock.connect((self.server_host, self.server_port))
-            print(f"Connected to server at {self.server_host}:{self.server_port}")
+            self.open_connection()
+            print(f"Connected to server at {self.server_host}:{self.server_port} (protocol v{self.protocol_version})")
             return True
         except Exception as e:
             error_msg = f"Server connection failed: {str(e)}"
@@ -57,6 +76,154 @@ class Client(QObject):
             showWarning(f"Could not connect to the sync server.\n\n{error_msg}")
             return False
 
+    def open_connection(self):
+        """Open a new connection and negotiate v3, falling back to v1 for older servers"""
+        self.reused_connection = False
+        self.codec = None
+        self.sock = socket.create_connection((self.server_host, self.server_port))
+
+        if self.server_v1_only:
+            self.protocol_version = 1
+            return
+
+        try:
+            self.sock.settimeout(HANDSHAKE_TIMEOUT)
+            self.sock.sendall(MAGIC + bytes([VERSION]))
+            reply = recv_exactly(self.sock, 1)
+            if reply == BUSY:
+                self.sock.close()
+                self.sock = None
+                raise ServerBusy()
+            if reply != MAGIC:
+                raise ConnectionError(f"Unexpected handshake reply {reply!r}")
+            self.protocol_version = recv_exactly(self.sock, 1)[0]
+            # Requests are several small frames, send them without waiting for ACKs
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            if self.protocol_version >= 3:
+                self.negotiate_codec()
+            self.sock.settimeout(None)
+        except ConnectionError as e:
+            # Servers that only know v1 close the connection on the handshake or answer something else
+            print(f"Server does not speak protocol v{VERSION} ({e}), falling back to v1")
+            self.server_v1_only = True
+            self.reconnect_v1()
+        except TimeoutError:
+            # Servers that ignore the handshake wait for the rest of a v1 request, don't pay the timeout again
+            print(f"No answer to the protocol v{VERSION} handshake, falling back to v1")
+            self.server_v1_only = True
+            self.reconnect_v1()
+        except OSError:
+            self.sock.close()
+            self.sock = None
+            raise
+
+    def reconnect_v1(self):
+        self.sock.close()
+        self.protocol_version = 1
+        self.codec = None
+        self.sock = socket.create_connection((self.server_host, self.server_port))
+
+    def negotiate_codec(self):
+        codecs = available_codecs()
+        send_json_frame(self.sock, CODEC, {"codecs": list(codecs)})
+        chosen = serializer.loads(expect_frame(self.sock, CODEC))["codec"]
+        self.codec = codecs.get(chosen)
+        print(f"Wire compression: {chosen or 'none'}")
+
+    def release_connection(self, keep_alive):
+        """Keep v2 connections open for the next request, close everything else"""
+        if not self.sock:
+            return
+        if keep_alive and self.protocol_version >= 2:
+            return
+
+        try:
+            self.sock.close()
+        except:
+            pass
+        self.sock = None
+
+    def close_connection(self):
+        if self.sock and self.protocol_version >= 2:
+            try:
+                send_frame(self.sock, BYE)
+            except OSError:
+                pass
+        self.release_connection(False)
+
+    def start_request(self, op, deck_code, **arguments):
+        """Send a request, returns True if the server accepted it"""
+        username = self.auth_manager.get_username()
+
+        if self.protocol_version >= 2:
+            request = {"op": str(op), "username": username, "deck_code": deck_code, **arguments}
+            try:
+                send_json_frame(self.sock, REQUEST, request)
+                status = expect_frame(self.sock, STATUS)
+            except (OSError, ConnectionError):
+                if not self.reused_connection:
+                    raise
+                # The server dropped the idle connection, retry once on a new one
+                print("Reused connection was closed by the server, reconnecting...")
+                self.release_connection(False)
+                self.open_connection()
+                return self.start_request(op, deck_code, **arguments)
+            return status == b"1"
+
+        self.sock.sendall(str(op).encode("utf-8"))
+        self.send_size_and_package(username)
+        self.send_size_and_package(deck_code)
+        if "deck_name" in arguments:
+            self.send_size_and_package(arguments["deck_name"])
+
+        response = self.sock.recv(1)
+        if response == BUSY:
+            raise ServerBusy()
+        if response != b"1":
+            return False
+
+        # v1 servers read the pull cursor after the privilege check
+        for name in ("timestamp", "since_seq"):
+            if name in arguments:
+                self.send_size_and_package(arguments[name])
+        return True
+
+    def read_meta(self, name):
+        if self.protocol_version >= 2:
+            return serializer.loads(expect_frame(self.sock, META))[name]
+
+        size = self.sock.recv(self.HEADER).decode("utf-8")
+        return self.sock.recv(int(size)).decode("utf-8")
+
+    def send_payload(self, cards):
+        """Send the cards, returns True if the server stored them"""
+        data = serializer.dumps(cards)
+
+        if self.protocol_version >= 2:
+            chunks = split_chunks(data)
+            if self.codec is not None:
+                stats = CompressionStats(self.codec)
+                chunks = compress_stream(chunks, self.codec, stats)
+            send_chunks(self.sock, chunks)
+            if self.codec is not None:
+                print(f"Compression: {stats}")
+            return expect_frame(self.sock, STATUS) == b"1"
+
+        self.sock.sendall(data)
+        self.sock.shutdown(socket.SHUT_WR)
+        return self.sock.recv(1).decode("utf-8") == "1"
+
+    def receive_payload(self):
+        if self.protocol_version >= 2:
+            chunks = iter_message_chunks(self.sock)
+            if self.codec is not None:
+                chunks = decompress_stream(chunks, self.codec, CompressionStats(self.codec))
+            cards = decode_cards(chunks)
+            print(f"Received {len(cards) if cards else 0} cards")
+            return cards
+
+        return collect_cards(self.sock)
+
     def send_cards(self, deck_name, callback=None):
         if not self.ensure_authenticated(mw):
             if callback:
@@ -70,6 +237,7 @@ class Client(QObject):
                 return
 
             def send_to_server():
+                keep_alive = False
                 try:
                     from aqt.utils import tooltip
                     tooltip("Sending cards to server...", period=2000)
@@ -79,30 +247,25 @@ class Client(QObject):
                             callback(False, "Failed to connect to server")
                         return
 
-                    self.sock.sendall(str(0).encode("utf-8"))
-
-                    username = self.auth_manager.get_username()
-                    self.send_size_and_package(username)
-
                     deck_code = get_code_from_deck(deck_name)
-                    self.send_size_and_package(deck_code)
-
-                    self.send_size_and_package(deck_name)
-
-                    json_data = json.dumps(cards)
-                    self.sock.sendall(json_data.encode("utf-8"))
-                    self.sock.shutdown(socket.SHUT_WR)
+                    if not self.start_request(0, deck_code, deck_name=deck_name):
+                        print("Error: Server denied the push")
+                        keep_alive = True
+                        if callback:
+                            callback(False, "Server error: access denied")
+                        return
 
-                    response = self.sock.recv(1).decode("utf-8")
-                    if response == "1":
+                    stored = self.send_payload(cards)
+                    keep_alive = True
+                    if stored:
                         print("Cards sent and stored successfully.")
                         tooltip("✅ Cards sent successfully!", period=3000)
                         if callback:
                             callback(True, "Cards sent successfully")
                     else:
-                        print(f"Error: Server returned '{response}'")
+                        print("Error: Server could not store the cards")
                         if callback:
-                            callback(False, f"Server error: {response}")
+                            callback(False, "Server error: cards not stored")
 
                 except Exception as e:
                     error_msg = f"Error sending cards: {str(e)}"
@@ -110,12 +273,7 @@ class Client(QObject):
                     if callback:
                         callback(False, error_msg)
                 finally:
-                    if self.sock:
-                        try:
-                            self.sock.close()
-                        except:
-                            pass
-                    self.sock = None
+                    self.release_connection(keep_alive)
 
             cards_needing_uid = []
 
@@ -205,6 +363,7 @@ class Client(QObject):
                 callback(False, "Authentication required")
             return
 
+        keep_alive = False
         try:
             from aqt.utils import tooltip
             tooltip("📥 Connecting to server...", period=2000)
@@ -217,29 +376,35 @@ class Client(QObject):
 
             tooltip("🔄 Requesting cards from server...", period=2000)
 
-            self.sock.sendall(str(1).encode("utf-8"))
-
-            username = self.auth_manager.get_username()
-            self.send_size_and_package(username)
-
             deck_code = get_code_from_deck(deck_name)
-            self.send_size_and_package(deck_code)
-
-            timestamp = get_value_from_json(SYNC_FILE_PATH, deck_name)
-            self.send_size_and_package(timestamp)
+            # Servers spoken to over v1 may not know sequence numbers, pull by the last sync time
+            by_seq = self.protocol_version >= 2
+            if by_seq:
+                accepted = self.start_request(3, deck_code, since_seq=get_value_from_json(SYNC_CURSOR_PATH, deck_name))
+            else:
+                accepted = self.start_request(1, deck_code, timestamp=get_value_from_json(SYNC_FILE_PATH, deck_name))
 
-            response = self.sock.recv(1).decode("utf-8")
-            if response != "1":
+            if not accepted:
+                keep_alive = True
                 tooltip("❌ Access denied", period=3000)
                 if callback:
                     callback(False, "Access denied or server error")
                 return
 
+            high_seq = int(self.read_meta("high_seq")) if by_seq else None
+
+            def save_cursor():
+                # A pull by timestamp leaves the cursor where it was, the next pull by sequence
+                # number only gets a few cards again
+                if high_seq is not None:
+                    update_json(SYNC_CURSOR_PATH, deck_name, high_seq)
+
             tooltip("📦 Downloading card data...", period=3000)
             print("Starting to collect cards from server...")
 
             try:
-                cards = collect_cards(self.sock)
+                cards = self.receive_payload()
+                keep_alive = True
             except Exception as e:
                 tooltip(f"❌ Download error: {str(e)}", period=4000)
                 print(f"Error collecting cards: {e}")
@@ -248,6 +413,7 @@ class Client(QObject):
                 return
 
             if not cards:
+                save_cursor()
                 tooltip("ℹ️ No new cards to sync", period=3000)
                 if callback:
                     callback(False, "No cards received from server")
@@ -271,6 +437,7 @@ class Client(QObject):
                     sync_count += 1
 
                     if sync_count >= total_cards:
+                        save_cursor()
                         print("All cards collected and synced.")
                         tooltip("🎉 All cards synced successfully!", period=4000)
                         if callback:
@@ -328,12 +495,7 @@ class Client(QObject):
             if callback:
                 callback(False, error_msg)
         finally:
-            if self.sock:
-                try:
-                    self.sock.close()
-                except:
-                    pass
-            self.sock = None
+            self.release_connection(keep_alive)
 
     def receive_deck_from_code(self, deck_code, callback=None):
         """Receive a new deck from server using its code (async)"""
@@ -351,6 +513,7 @@ class Client(QObject):
                     callback(False, "The deck already exists")
                 return
 
+            keep_alive = False
             try:
                 from aqt.utils import tooltip
                 tooltip("📥 Connecting to server...", period=2000)
@@ -362,27 +525,21 @@ class Client(QObject):
                     return
 
                 tooltip("🔍 Requesting deck from server...", period=2000)
-                self.sock.sendall(str(2).encode("utf-8"))
-
-                username = self.auth_manager.get_username()
-                self.send_size_and_package(username)
-
-                self.send_size_and_package(deck_code)
 
-                response = self.sock.recv(1).decode("utf-8")
-                if response != "1":
+                if not self.start_request(2, deck_code):
+                    keep_alive = True
                     tooltip("❌ Access denied or deck not found", period=3000)
                     if callback:
                         callback(False, "Access denied or server error")
                     return
 
-                deck_name_size = self.sock.recv(self.HEADER).decode("utf-8")
-                deck_name = self.sock.recv(int(deck_name_size)).decode("utf-8")
+                deck_name = self.read_meta("deck_name")
 
                 tooltip(f"📦 Downloading deck: {deck_name}...", period=3000)
                 print(f"Downloading deck: {deck_name}")
 
-                cards = collect_cards(self.sock)
+                cards = self.receive_payload()
+                keep_alive = True
                 if not cards:
                     print(f"No cards in deck with code {deck_code}, creating empty deck")
                     tooltip(f"📁 Creating empty deck: {deck_name}", period=3000)
@@ -402,6 +559,7 @@ class Client(QObject):
                     return
 
                 total_cards = len(cards)
+                high_seq = max(card.get("seq", 0) for card in cards.values())
                 print(f"Downloaded {total_cards} cards for deck: {deck_name}")
                 tooltip(f"✅ Downloaded {total_cards} cards. Creating deck...", period=3000)
 
@@ -417,6 +575,7 @@ class Client(QObject):
                         if sync_count >= total_cards:
                             update_json(DECKS_CODES_PATH, deck_name, deck_code)
                             update_json(SYNC_FILE_PATH, deck_name, int(time.time()))
+                            update_json(SYNC_CURSOR_PATH, deck_name, high_seq)
 
                             def on_anki_synced(success):
                                 tooltip("🎉 Deck imported successfully!", period=4000)
@@ -475,12 +634,7 @@ class Client(QObject):
                 if callback:
                     callback(False, error_msg)
             finally:
-                if self.sock:
-                    try:
-                        self.sock.close()
-                    except:
-                        pass
-                self.sock = None
+                self.release_connection(keep_alive)
 
         check_for_deck_in_json(deck_code, on_deck_checked)
 
@@ -497,6 +651,7 @@ class Client(QObject):
 
     def logout(self):
         """Log out the current user"""
+        self.close_connection()
         self.auth_manager.logout()
         QMessageBox.information(
             mw,
@@ -573,19 +728,12 @@ def workflow_simulation(client, create, receive, deck_name, new, delete, final_c
 
 def collect_cards(soc):
     try:
-        data_chunks = []
-        while True:
-            chunk = soc.recv(4096)
-            if not chunk:
-                break
-            data_chunks.append(chunk)
-
-        if not data_chunks:
+        cards = decode_cards(recv_chunks(soc))
+
+        if cards is None:
             print("No data received")
             return
 
-        decoded_data = b''.join(data_chunks).decode("utf-8")
-        cards = json.loads(decoded_data)
         print(f"Received {len(cards)} cards")
 
         return cards
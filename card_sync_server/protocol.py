@@ -0,0 +1,325 @@
+"""
+Client side of the socket server wire protocol, kept in sync with Server/protocol.py.
+
+v1: a 1 byte op followed by 64 byte space padded size headers, the card payload is delimited
+by half-closing the socket, so every connection carries a single request.
+
+v2: the client opens with MAGIC + version byte and the server answers with the version it
+speaks. After that every message is a frame: 1 byte type, 4 byte big-endian length, payload.
+A request is a single REQUEST frame with the op metadata as JSON, card payloads are sent as
+DATA frames closed by an END frame, so one connection can carry many requests.
+
+v3: v2 plus a compression codec negotiated right after the handshake. The client sends a
+CODEC frame with the codecs it supports in order of preference and the server answers with
+a CODEC frame naming the one it picked, or null. The card payloads of every request are then
+sent as one compressed stream over the DATA frames (see compression.py).
+
+A server without room for a new connection answers it with the single BUSY byte, before
+reading anything, and closes it.
+"""
+import codecs
+import json
+import re
+import struct
+
+from . import serializer
+
+MAGIC = b"V"
+VERSION = 3
+
+FRAME_HEADER = struct.Struct("!cI")
+REQUEST = b"Q"
+STATUS = b"S"
+META = b"M"
+DATA = b"D"
+END = b"E"
+BYE = b"B"
+CODEC = b"C"
+BUSY = b"!"
+
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+CHUNK_SIZE = 64 * 1024
+RECV_BUFFER_SIZE = 64 * 1024
+
+WHITESPACE = re.compile(r"[ \t\n\r]*")
+# Characters that can end a card outside of a string, and inside of one
+STRUCTURE = re.compile(r'[][{}",]')
+STRING_SPECIAL = re.compile(r'["\\]')
+
+
+class ProtocolError(Exception):
+    pass
+
+
+class ServerBusy(Exception):
+    """The server turned the connection away, try again in a moment"""
+
+    def __init__(self):
+        super().__init__("The sync server is busy, try again in a moment")
+
+
+def recv_exactly(sock, size):
+    """Read exactly size bytes, recv can return less than asked for"""
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    received = 0
+    while received < size:
+        count = sock.recv_into(view[received:], size - received)
+        if count == 0:
+            raise ConnectionError(f"Connection closed after {received} of {size} bytes")
+        received += count
+    return bytes(buffer)
+
+
+def send_frame(sock, frame_type, payload=b""):
+    sock.sendall(FRAME_HEADER.pack(frame_type, len(payload)) + payload)
+
+
+def recv_frame(sock):
+    """Returns (frame_type, payload)"""
+    frame_type, size = FRAME_HEADER.unpack(recv_exactly(sock, FRAME_HEADER.size))
+    if size > MAX_FRAME_SIZE:
+        raise ProtocolError(f"Frame of {size} bytes exceeds the {MAX_FRAME_SIZE} bytes limit")
+    return frame_type, recv_exactly(sock, size) if size else b""
+
+
+def send_json_frame(sock, frame_type, data):
+    send_frame(sock, frame_type, serializer.dumps(data))
+
+
+def expect_frame(sock, expected_type):
+    frame_type, payload = recv_frame(sock)
+    if frame_type != expected_type:
+        raise ProtocolError(f"Expected frame {expected_type!r}, got {frame_type!r}")
+    return payload
+
+
+def send_message(sock, data):
+    """Send a payload as DATA frames followed by an END frame"""
+    view = memoryview(data)
+    for start in range(0, len(view), CHUNK_SIZE):
+        send_frame(sock, DATA, view[start:start + CHUNK_SIZE])
+    send_frame(sock, END)
+
+
+def send_chunks(sock, chunks):
+    """Send an iterable of chunks as DATA frames followed by an END frame"""
+    for chunk in chunks:
+        if chunk:
+            send_frame(sock, DATA, chunk)
+    send_frame(sock, END)
+
+
+def split_chunks(data, chunk_size=CHUNK_SIZE):
+    view = memoryview(data)
+    for start in range(0, len(view), chunk_size):
+        yield view[start:start + chunk_size]
+
+
+def recv_message(sock):
+    """Read DATA frames up to the END frame"""
+    chunks = []
+    while True:
+        frame_type, payload = recv_frame(sock)
+        if frame_type == END:
+            return b"".join(chunks)
+        if frame_type != DATA:
+            raise ProtocolError(f"Unexpected frame {frame_type!r} inside a message")
+        chunks.append(payload)
+
+
+def iter_message_chunks(sock):
+    """
+    Yield the payloads of DATA frames up to the END frame. They are received into one reusable
+    buffer, so every chunk is only valid until the next one is requested.
+    """
+    buffer = bytearray(CHUNK_SIZE)
+    while True:
+        frame_type, size = FRAME_HEADER.unpack(recv_exactly(sock, FRAME_HEADER.size))
+        if frame_type == END:
+            return
+        if frame_type != DATA:
+            raise ProtocolError(f"Unexpected frame {frame_type!r} inside a message")
+        if size > MAX_FRAME_SIZE:
+            raise ProtocolError(f"Frame of {size} bytes exceeds the {MAX_FRAME_SIZE} bytes limit")
+        if size > len(buffer):
+            buffer = bytearray(size)
+
+        view = memoryview(buffer)[:size]
+        received = 0
+        while received < size:
+            count = sock.recv_into(view[received:], size - received)
+            if count == 0:
+                raise ConnectionError(f"Connection closed after {received} of {size} bytes")
+            received += count
+        yield view
+
+
+class CardStreamDecoder:
+    """
+    Incremental decoder for a JSON array of cards or a JSON object of stable_uid -> card.
+    feed() takes the raw bytes as they arrive and returns the (stable_uid, card) pairs
+    completed so far, stable_uid is None for the cards of an array.
+
+    A card cut by the end of a chunk is scanned once, keeping the bracket depth and string
+    state across chunks, and only decoded once the ',' or bracket closing it arrived, so a
+    card spread over many chunks doesn't get parsed again from its start on each of them.
+    """
+
+    def __init__(self):
+        self.container = None
+        self.done = False
+        self._utf8 = codecs.getincrementaldecoder("utf-8")()
+        self._json = json.JSONDecoder()
+        self._closing = None
+        self._empty = True
+        # Text of the card being received, joined once it is complete
+        self._pieces = []
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+
+    def feed(self, data, final=False):
+        text = self._utf8.decode(data, final)
+        items = []
+        pos = self._scan(text, items) if not self.done else 0
+        if self.done:
+            pos = WHITESPACE.match(text, pos).end()
+            if pos < len(text):
+                raise ValueError(f"Unexpected {text[pos]!r} after the card payload")
+
+        if final and not self.done:
+            raise ValueError("Card payload ended before the closing bracket")
+        return items
+
+    def _scan(self, text, items):
+        """Decode the cards completed by text, returns the position after the payload once it is done"""
+        pos = 0
+        if self._closing is None:
+            pos = WHITESPACE.match(text).end()
+            if pos >= len(text):
+                return pos
+            if text[pos] not in "[{":
+                raise ValueError(f"Expected a JSON array or object of cards, got {text[pos]!r}")
+            self.container = list if text[pos] == "[" else dict
+            self._closing = "]" if text[pos] == "[" else "}"
+            pos += 1
+
+        start = pos
+        while pos < len(text):
+            if pos == start and not self._pieces:
+                # Cards arriving whole skip the scan
+                end = self._decode_whole(text, pos, items)
+                if end is not None:
+                    pos = start = end
+                    if self.done:
+                        return pos
+                    continue
+
+            if self._escape:
+                self._escape = False
+                pos += 1
+            elif self._in_string:
+                match = STRING_SPECIAL.search(text, pos)
+                if match is None:
+                    break
+                pos = match.end()
+                self._escape = match.group() == "\\"
+                self._in_string = self._escape
+            else:
+                match = STRUCTURE.search(text, pos)
+                if match is None:
+                    break
+                pos = match.end()
+                char = match.group()
+                if char == '"':
+                    self._in_string = True
+                elif char in "[{":
+                    self._depth += 1
+                elif self._depth:
+                    if char != ",":
+                        self._depth -= 1
+                else:
+                    self._pieces.append(text[start:pos - 1])
+                    start = pos
+                    self._end_card(char, items)
+                    if self.done:
+                        return pos
+        if start < len(text):
+            self._pieces.append(text[start:])
+        return len(text)
+
+    def _decode_whole(self, text, pos, items):
+        """Decode the card at pos if it is followed by its separator, returns the position after it"""
+        try:
+            stable_uid, card, end = self._decode_card(text, pos)
+        except ValueError:
+            return None
+        if end >= len(text) or text[end] not in (",", self._closing):
+            return None
+
+        self._empty = False
+        self.done = text[end] == self._closing
+        items.append((stable_uid, card))
+        return end + 1
+
+    def _end_card(self, separator, items):
+        text = "".join(self._pieces)
+        self._pieces = []
+        if separator not in (",", self._closing):
+            raise ValueError(f"Unexpected {separator!r} in card payload")
+        if separator == self._closing:
+            self.done = True
+            if self._empty and WHITESPACE.fullmatch(text):
+                return
+
+        stable_uid, card, end = self._decode_card(text, 0)
+        if end < len(text):
+            raise ValueError(f"Unexpected {text[end]!r} in card payload")
+        self._empty = False
+        items.append((stable_uid, card))
+
+    def _decode_card(self, text, pos):
+        """Returns (stable_uid, card, position of the next non-whitespace character)"""
+        pos = WHITESPACE.match(text, pos).end()
+        stable_uid = None
+        if self._closing == "}":
+            stable_uid, pos = self._json.raw_decode(text, pos)
+            pos = WHITESPACE.match(text, pos).end()
+            if text[pos:pos + 1] != ":":
+                raise ValueError(f"Expected ':' in card payload, got {text[pos:pos + 1]!r}")
+            pos = WHITESPACE.match(text, pos + 1).end()
+        card, pos = self._json.raw_decode(text, pos)
+        return stable_uid, card, WHITESPACE.match(text, pos).end()
+
+
+def recv_chunks(soc, buffer_size=RECV_BUFFER_SIZE):
+    """
+    Yield what arrives on the socket until the peer closes it. Every chunk is a view of the
+    same reusable buffer, so it is only valid until the next one is requested.
+    """
+    buffer = bytearray(buffer_size)
+    view = memoryview(buffer)
+    while True:
+        count = soc.recv_into(buffer)
+        if not count:
+            return
+        yield view[:count]
+
+
+def decode_cards(chunks):
+    """Decode a card payload into a list or dict of cards, None if nothing was received"""
+    decoder = CardStreamDecoder()
+    received = False
+    items = []
+    for chunk in chunks:
+        received = received or len(chunk) > 0
+        items.extend(decoder.feed(chunk))
+
+    if not received:
+        return None
+
+    items.extend(decoder.feed(b"", final=True))
+    if decoder.container is list:
+        return [card for _, card in items]
+    return {stable_uid: card for stable_uid, card in items}
@@ -0,0 +1,106 @@
+"""
+Add-on copy of DataManagement/serializer.py, keep both in sync.
+
+JSON encoding of cards, decks and protocol metadata. Uses orjson or msgspec when one of them
+is installed and the standard library json module otherwise, the JSON_BACKEND environment
+variable forces one. Output is always compact UTF-8 bytes, with no indentation or spaces.
+"""
+import json
+import os
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+
+class StdlibBackend:
+    name = "json"
+    errors = (ValueError,)
+
+    def __init__(self):
+        self._encoder = json.JSONEncoder(ensure_ascii=False, separators=(",", ":"))
+
+    def dumps(self, obj):
+        return self._encoder.encode(obj).encode("utf-8")
+
+    def loads(self, data):
+        return json.loads(data)
+
+
+class OrjsonBackend:
+    name = "orjson"
+    errors = (orjson.JSONDecodeError,) if orjson is not None else ()
+
+    def dumps(self, obj):
+        return orjson.dumps(obj)
+
+    def loads(self, data):
+        return orjson.loads(data)
+
+
+class MsgspecBackend:
+    name = "msgspec"
+    errors = (msgspec.DecodeError,) if msgspec is not None else ()
+
+    def __init__(self):
+        self._encoder = msgspec.json.Encoder()
+        self._decoder = msgspec.json.Decoder()
+
+    def dumps(self, obj):
+        return self._encoder.encode(obj)
+
+    def loads(self, data):
+        return self._decoder.decode(data)
+
+
+def available_backends():
+    """Backends that can be used here, fastest first"""
+    backends = {}
+    if orjson is not None:
+        backends["orjson"] = OrjsonBackend()
+    if msgspec is not None:
+        backends["msgspec"] = MsgspecBackend()
+    backends["json"] = StdlibBackend()
+    return backends
+
+
+def choose_backend(name=None):
+    backends = available_backends()
+    if name is None:
+        name = os.environ.get("JSON_BACKEND")
+    if name:
+        if name not in backends:
+            raise ValueError(f"JSON backend {name!r} is not available, use one of {', '.join(backends)}")
+        return backends[name]
+    return next(iter(backends.values()))
+
+
+backend = choose_backend()
+# Raised by loads() on invalid JSON, whatever the backend
+DecodeError = (ValueError,) + backend.errors
+
+
+def dumps(obj):
+    """Compact JSON of obj as UTF-8 bytes"""
+    return backend.dumps(obj)
+
+
+def loads(data):
+    """Parse JSON from bytes or str"""
+    return backend.loads(data)
+
+
+def dump(obj, outfile):
+    """Write obj to a file opened in binary mode"""
+    outfile.write(backend.dumps(obj))
+
+
+def load(infile):
+    """Read a JSON document from a file opened in binary mode"""
+    return backend.loads(infile.read())
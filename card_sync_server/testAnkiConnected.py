@@ -8,8 +8,11 @@ from threading import Thread
 from aqt.qt import QObject, pyqtSignal
 from aqt import mw
 
+from . import serializer
+
 ADDON_DIR = os.path.dirname(__file__)
 SYNC_FILE_PATH = os.path.join(ADDON_DIR, "sync_log.json")
+SYNC_CURSOR_PATH = os.path.join(ADDON_DIR, "sync_cursor.json")
 DECKS_CODES_PATH = os.path.join(ADDON_DIR, "decks_codes.json")
 ERROR_LOG_PATH = os.path.join(ADDON_DIR, "error_log.txt")
 ANKI_CONNECT_URL = "http://127.0.0.1:8765"
@@ -118,8 +121,8 @@ def read_json_file(file_path, default=None):
     
     try:
         if os.path.exists(file_path):
-            with open(file_path, "r", encoding="utf-8") as f:
-                return json.load(f)
+            with open(file_path, "rb") as f:
+                return serializer.load(f)
         return default
     except Exception as e:
         log_error(f"Error reading JSON file {file_path}: {str(e)}")
@@ -128,8 +131,8 @@ def read_json_file(file_path, default=None):
 def write_json_file(file_path, data):
     """Write to a JSON file with error handling"""
     try:
-        with open(file_path, "w", encoding="utf-8") as f:
-            json.dump(data, f, indent=4)
+        with open(file_path, "wb") as f:
+            serializer.dump(data, f)
         return True
     except Exception as e:
         log_error(f"Error writing to JSON file {file_path}: {str(e)}")
@@ -413,6 +416,7 @@ def delete_deck_information(deck_name, callback=None):
     """Deletes a deck and its sync information (async)"""
     def on_deck_deleted(result):
         delete_key_from_json(deck_name, SYNC_FILE_PATH)
+        delete_key_from_json(deck_name, SYNC_CURSOR_PATH)
         delete_key_from_json(deck_name, DECKS_CODES_PATH)
         if callback:
             callback(result)